@@ -0,0 +1,129 @@
+"""Measures how long liftoff takes to launch a run.
+
+We compare the old shell pipeline (`date`, `nohup sh -c`, `echo $!`) with the
+native launcher in `liftoff.liftoff.launch_run` and with runs forked from a
+warm fork server (`--warm-workers`). The launched script exits
+right away. For each run we time the launch call itself and the time until
+the end marker is written, which includes all the helper processes (and the
+interpreter startup, the same for everybody). Runs are launched one after
+the other so the machine is idle before each one.
+
+    python benchmarks/launch_latency.py --runs 50 --imports numpy scipy
+"""
+
+import contextlib
+import os
+import select
+import statistics
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+
+import yaml
+
+from liftoff.liftoff import launch_run, start_fork_server
+
+
+def old_launch_run(run_path, py_script, session_id):
+    """The shell pipeline used by liftoff <= 0.5.1."""
+    err_path = os.path.join(run_path, "err")
+    out_path = os.path.join(run_path, "out")
+    cfg_path = os.path.join(run_path, "cfg.yaml")
+    start_path = os.path.join(run_path, ".__start")
+    end_path = os.path.join(run_path, ".__end")
+    crash_path = os.path.join(run_path, ".__crash")
+    py_cmd = f"python -u {py_script:s} {cfg_path:s} --session-id {session_id}"
+    cmd = (
+        f" date +%s 1> {start_path:s} 2>/dev/null &&"
+        f" nohup sh -c '{py_cmd:s}"
+        f" 2>{err_path:s} 1>{out_path:s}"
+        f" && date +%s > {end_path:s}"
+        f" || date +%s > {crash_path:s}'"
+        f" 1> {run_path}/nohup.out 2> {run_path}/nohup.err"
+        f" & echo $!"
+    )
+    proc = subprocess.Popen(
+        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True
+    )
+    out, _ = proc.communicate()
+    return int(out.decode("utf-8").strip())
+
+
+def wait_for_markers(run_path):
+    """Waits until the run wrote .__end or .__crash."""
+    while not any(
+        os.path.exists(os.path.join(run_path, m)) for m in (".__end", ".__crash")
+    ):
+        time.sleep(0.005)
+
+
+def make_run(root, idx):
+    """Creates a run folder with a minimal config."""
+    run_path = os.path.join(root, f"{idx:d}")
+    os.mkdir(run_path)
+    with open(os.path.join(run_path, "cfg.yaml"), "w") as handler:
+        yaml.safe_dump({"title": f"run_{idx:d}", "out_dir": run_path}, handler)
+    return run_path
+
+
+def bench(name, launch, runs, root, script):
+    """Launches `runs` runs one after the other and prints the latencies."""
+    latencies, totals = [], []
+    for idx in range(runs):
+        run_path = make_run(root, idx)
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            child = launch(run_path, script)
+            latencies.append(1000 * (time.perf_counter() - start))
+            if hasattr(child, "poll"):
+                # Attached runs get their markers when liftoff reaps them.
+                select.select([child], [], [])
+                child.poll()
+            wait_for_markers(run_path)
+            totals.append(1000 * (time.perf_counter() - start))
+    print(
+        f"{name:>16s}: launch call median {statistics.median(latencies):6.2f} ms"
+        f" (mean {statistics.mean(latencies):6.2f})"
+        f" | launch to end marker median {statistics.median(totals):6.2f} ms"
+        f" (mean {statistics.mean(totals):6.2f})"
+    )
+
+
+def main():
+    """Entry point."""
+    parser = ArgumentParser("launch_latency")
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument(
+        "--imports", nargs="*", default=[], help="Modules the script imports."
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        script = os.path.join(tmp, "noop.py")
+        with open(script, "w") as handler:
+            for module in ["sys", *args.imports]:
+                handler.write(f"import {module:s}\n")
+            handler.write("\n\ndef run(opts):\n    pass\n")
+        os.chdir(tmp)  # the fork server imports the script from here
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            fork_server = start_fork_server(
+                Namespace(script="noop.py", no_detach=False)
+            )
+        for name, launch in [
+            ("shell", lambda r, s: old_launch_run(r, s, "bench")),
+            ("native detached", lambda r, s: launch_run(r, s, "bench")),
+            ("native attached", lambda r, s: launch_run(r, s, "b", do_nohup=False)),
+            (
+                "warm worker",
+                lambda r, s: launch_run(r, s, "b", fork_server=fork_server),
+            ),
+        ]:
+            root = os.path.join(tmp, name.replace(" ", "_"))
+            os.mkdir(root)
+            bench(name, launch, args.runs, root, script)
+        fork_server.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,12 @@ from importlib.metadata import PackageNotFoundError, version
 
 import yaml
 
+from .asha import milestone  # noqa: F401  (for the scripts)
 from .common.liftopt import LO
 from .common.options_parser import OptionParser
+from .deadlines import time_left  # noqa: F401  (for the scripts)
+from .metrics import report  # noqa: F401  (for the scripts)
+from .startup import ready  # noqa: F401  (for the scripts)
 
 try:
     __version__ = version("liftoff")
@@ -35,4 +39,5 @@ def parse_opts():
         raise RuntimeError("No out_dir in config file.")
     if not os.path.isdir(opts.out_dir):  # pylint: disable=no-member
         raise RuntimeError("Out dir does not exist.")
+    os.environ.setdefault("LIFTOFF_OUT_DIR", opts.out_dir)  # for report()
     return opts
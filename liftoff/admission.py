@@ -0,0 +1,177 @@
+"""Here we keep liftoff from starting runs the machine has no memory for
+(--mem-guard RESERVE_GB), so they do not all end up killed by the OOM
+killer when they reach their peaks at the same time.
+
+A run is expected to need as much memory as the largest peak RSS among the
+runs of its sub-experiment, finished (see `usage`) or running, or among all
+runs seen so far if none of its sub-experiment finished yet. This is what
+it asks for, unless its config asks for more (`liftoff: mem_gb`). A run is
+started only if
+
+- the memory available (MemAvailable) minus what the running runs are still
+  expected to grow, minus what the run needs, stays above RESERVE_GB, and
+- the memory pressure (/proc/pressure/memory, `some` avg10) is below 10%.
+
+With --mem-suspend, when memory gets scarce anyway (less than half the
+reserve is available, or tasks are stalled on memory `full` more than 10%
+of the time), the youngest run is suspended with SIGSTOP (with its process
+group), at most one every 10 s. No run is started while some are
+suspended. A suspended run is resumed with SIGCONT once there is room for it
+again (if liftoff dies meanwhile, resume it with `kill -CONT -<pid>`).
+"""
+
+import os
+import signal
+import time
+
+from termcolor import colored as clr
+
+from .common.sysinfo import meminfo, pressure
+from .usage import read_usage
+
+PRESSURE_LIMIT = 10.0  # memory `some` (%) above which nothing is started
+SEVERE_PRESSURE = 10.0  # memory `full` (%) above which runs are suspended
+PEAKS_TTL = 30  # seconds we trust the learned peaks of a sub-experiment
+POLL_EVERY = 5  # seconds between two looks at the memory while blocked
+SUSPEND_EVERY = 10  # seconds between two suspensions
+
+GB = 2**30
+
+
+class MemoryGuard:
+    """Decides if the memory of the machine allows another run and suspends
+    runs when it does not.
+    """
+
+    def __init__(  # pylint: disable=bad-continuation
+        self, experiment_path: str, reserve_gb: float, suspend: bool = False
+    ) -> None:
+        self.experiment_path = experiment_path
+        self.reserve_gb = reserve_gb
+        self.suspend = suspend
+        self.peaks = {}  # sub-experiment -> (time read, peak RSS in GB)
+        self.live_peaks = {}  # sub-experiment -> peak RSS of its running runs
+        self.running = set()  # run paths seen running at the last refresh
+        self.max_peak = 0.0  # the largest peak RSS seen in the experiment
+        self.available_gb = None
+        self.stall = {}
+        self.blocked = False  # refused a run since the last refresh
+        self.nsuspended = 0
+        self.last_suspend = float("-inf")
+
+    def expected_gb(self, run_path: str) -> float:
+        """The peak RSS we expect from a run (0 if we know nothing)."""
+        subexperiment = os.path.dirname(run_path)
+        read_at, peak = self.peaks.get(subexperiment, (None, None))
+        if read_at is None or time.monotonic() - read_at > PEAKS_TTL:
+            peak = None
+            with os.scandir(subexperiment) as fit:
+                for entry in fit:
+                    if entry.name.startswith(".") or not entry.is_dir():
+                        continue
+                    record = read_usage(entry.path)
+                    if record is not None and record.get("max_rss_mb"):
+                        peak = max(peak or 0, record["max_rss_mb"] / 1024)
+            self.peaks[subexperiment] = (time.monotonic(), peak)
+            self.max_peak = max(self.max_peak, peak or 0.0)
+        live_peak = self.live_peaks.get(subexperiment, 0.0)
+        if peak is None:  # none of them finished: assume the worst we saw
+            return max(live_peak, self.max_peak)
+        return max(peak, live_peak)
+
+    def refresh(self, children: list) -> None:
+        """Reads the memory available and what the running runs (`children`
+        with their `request` and sampled `usage`) may still grow.
+        """
+        # Runs that ended since the last time wrote their `.__usage`.
+        run_paths = {child.run_path for child in children}
+        for run_path in self.running - run_paths:
+            self.peaks.pop(os.path.dirname(run_path), None)
+            self.expected_gb(run_path)
+        self.running = run_paths
+
+        available = meminfo().get("MemAvailable")
+        self.stall = pressure("memory")
+        self.blocked = False
+        if available is None:
+            self.available_gb = None
+            return
+        growth = 0.0
+        self.live_peaks = {}
+        for child in children:
+            used = child.usage.get("rss", 0) / GB
+            subexperiment = os.path.dirname(child.run_path)
+            self.live_peaks[subexperiment] = max(
+                self.live_peaks.get(subexperiment, 0.0), used
+            )
+            self.max_peak = max(self.max_peak, used)
+            if getattr(child, "request", None):
+                growth += max(child.request["mem_gb"] - used, 0.0)
+        self.available_gb = available / (1024 * 1024) - growth
+
+    def _has_room(self, mem_gb: float) -> bool:
+        if self.stall.get("some", 0.0) > PRESSURE_LIMIT:
+            return False
+        if self.available_gb is None:
+            return True
+        return self.available_gb - mem_gb >= self.reserve_gb
+
+    def admits(self, request: dict) -> bool:
+        """Checks if a run asking for `request` may start now."""
+        if self.nsuspended or not self._has_room(request["mem_gb"]):
+            self.blocked = True
+            return False
+        return True
+
+    def reserve(self, request: dict) -> None:
+        """Takes a run that was just placed out of the available memory."""
+        if self.available_gb is not None:
+            self.available_gb -= request["mem_gb"]
+
+    def severe(self) -> bool:
+        """Checks if memory is so scarce that runs should be suspended."""
+        if self.stall.get("full", 0.0) > SEVERE_PRESSURE:
+            return True
+        return self.available_gb is not None and (
+            self.available_gb < self.reserve_gb / 2
+        )
+
+    def suspend_or_resume(self, children: list) -> None:
+        """Suspends the youngest running run under severe pressure, or
+        resumes the oldest suspended one if there is room for it again.
+        """
+        running = [c for c in children if not getattr(c, "suspended", False)]
+        stopped = [c for c in children if getattr(c, "suspended", False)]
+        self.nsuspended = len(stopped)
+        if not self.suspend:
+            return
+        if self.severe():
+            if (
+                len(running) > 1
+                and time.monotonic() - self.last_suspend > SUSPEND_EVERY
+            ):
+                child = max(running, key=lambda c: c.started)
+                child.send_signal(signal.SIGSTOP)
+                child.suspended = True
+                self.nsuspended += 1
+                self.last_suspend = time.monotonic()
+                msg = clr(f"Suspending {child.title} (low memory).", "yellow")
+                print(f"[{time.strftime(time.ctime())}] {msg:s}")
+        elif stopped and self._has_room(0.0):
+            child = min(stopped, key=lambda c: c.started)
+            child.send_signal(signal.SIGCONT)
+            child.suspended = False
+            self.nsuspended -= 1
+            print(f"[{time.strftime(time.ctime())}] Resuming {child.title}.")
+
+    @property
+    def state(self) -> str:
+        """What the guard knows about the memory, for the logs."""
+        if self.available_gb is None:
+            return "Available: unknown"
+        msg = f"Available: {self.available_gb:.1f} GB"
+        if self.stall:
+            msg += f" (stalled {self.stall.get('some', 0.0):.0f}%)"
+        if self.nsuspended:
+            msg += f" | Suspended: {self.nsuspended:d}"
+        return msg
@@ -0,0 +1,130 @@
+"""Here we stop unpromising runs early by asynchronous successive halving
+(ASHA, Li et al. 2018).
+
+Runs report a metric at some steps with `milestone(opts.out_dir, step,
+value)`, which appends a line to `.__milestones` in the run folder. Rung k
+is reached at step `min_step * eta ** k`. When a run reaches a rung, its
+value is compared with the values of all runs (of the whole experiment)
+that reached the same rung before it: it goes on only if it is among the
+best 1 / eta of them (the first eta - 1 runs at a rung always go on, as
+1 / eta of them is less than one run). Otherwise it is pruned:
+liftoff marks it with `.__pruned` and stops it, and its slot goes to a
+pending run. Nobody waits for a rung to fill up, hence asynchronous.
+
+The values at each rung are kept in the experiment's `.__rungs` file, so
+they are shared by all sessions and survive restarts.
+"""
+
+import bisect
+import math
+import os
+
+MILESTONES_FILE = ".__milestones"
+RUNGS_FILE = ".__rungs"
+
+
+def milestone(out_dir: str, step: int, value: float) -> None:
+    """Reports the metric of a run at some step (e.g. the validation loss
+    after an epoch). Called from the script of the run.
+    """
+    with open(os.path.join(out_dir, MILESTONES_FILE), "a") as handler:
+        handler.write(f"{int(step):d} {float(value)!r}\n")
+
+
+def _read_new_lines(path: str, offset: int) -> tuple[list[str], int]:
+    """Reads the complete lines appended to a file after `offset`."""
+    try:
+        if os.path.getsize(path) <= offset:
+            return [], offset
+        with open(path, "rb") as handler:
+            handler.seek(offset)
+            data = handler.read()
+    except FileNotFoundError:
+        return [], offset
+    data = data[: data.rfind(b"\n") + 1]
+    return data.decode("utf-8").splitlines(), offset + len(data)
+
+
+class Asha:
+    """Decides which runs to prune. `goal` is `min` if smaller values are
+    better (e.g. a loss) and `max` otherwise.
+    """
+
+    def __init__(  # pylint: disable=bad-continuation
+        self, experiment_path: str, min_step: float, eta: int = 3, goal: str = "min"
+    ) -> None:
+        self.experiment_path = experiment_path
+        self.path = os.path.join(experiment_path, RUNGS_FILE)
+        self.min_step = min_step
+        self.eta = eta
+        self.sign = 1 if goal == "min" else -1
+        self.rungs = {}  # rung -> sorted values (smaller is better)
+        self.reached = set()  # (rung, run) pairs already recorded
+        self.offsets = {}  # run path -> offset in its milestones file
+        self._offset = 0
+
+    def rung(self, step: float) -> int:
+        """The highest rung reached at `step` (-1 if none)."""
+        if step < self.min_step:
+            return -1
+        rung = int(math.log(step / self.min_step, self.eta) + 1e-9)
+        while self.min_step * self.eta ** (rung + 1) <= step:
+            rung += 1
+        return rung
+
+    def refresh(self) -> None:
+        """Reads the values recorded at the rungs since the last call."""
+        lines, self._offset = _read_new_lines(self.path, self._offset)
+        for line in lines:
+            try:
+                rung, value, rel_path = line.split(" ", 2)
+                self._add(int(rung), float(value), rel_path)
+            except ValueError:
+                continue
+
+    def _add(self, rung: int, value: float, rel_path: str) -> None:
+        if (rung, rel_path) in self.reached:
+            return
+        self.reached.add((rung, rel_path))
+        value = self.sign * value if not math.isnan(value) else math.inf
+        bisect.insort(self.rungs.setdefault(rung, []), value)
+
+    def _goes_on(self, rung: int, value: float) -> bool:
+        values = self.rungs[rung]
+        if len(values) < self.eta:
+            return True
+        best = values[len(values) // self.eta - 1]
+        value = self.sign * value if not math.isnan(value) else math.inf
+        return value <= best
+
+    def should_prune(self, run_path: str) -> bool:
+        """Reads the new milestones of a run and records those that reached
+        new rungs. Returns True if the run should be stopped.
+        """
+        path = os.path.join(run_path, MILESTONES_FILE)
+        lines, self.offsets[run_path] = _read_new_lines(
+            path, self.offsets.get(run_path, 0)
+        )
+        if not lines:
+            return False
+        self.refresh()
+        rel_path = os.path.relpath(run_path, self.experiment_path)
+        new = []
+        for line in lines:
+            try:
+                step, value = line.split()
+                step, value = float(step), float(value)
+            except ValueError:
+                continue
+            for rung in range(self.rung(step) + 1):
+                if (rung, rel_path) not in self.reached:
+                    self._add(rung, value, rel_path)
+                    new.append((rung, value))
+        if new:
+            with open(self.path, "a") as handler:
+                handler.writelines(f"{r:d} {v!r} {rel_path:s}\n" for r, v in new)
+        return not all(self._goes_on(rung, value) for rung, value in new)
+
+    def forget(self, run_path: str) -> None:
+        """Called when a run is over."""
+        self.offsets.pop(run_path, None)
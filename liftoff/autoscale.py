@@ -0,0 +1,170 @@
+"""Here we choose the number of concurrent runs by ourselves (--procs-no auto).
+
+Every `interval` seconds the tuner looks at how much work got done and at how
+loaded the machine is, and moves the limit up or down by a step (a quarter
+of the limit, at least one), within --procs-bounds:
+
+- work done is the number of records the running runs wrote with
+  `liftoff.report` (a proxy for their steps), or, if they report nothing,
+  the number of runs that ended;
+- if the CPU, memory or I/O pressure (/proc/pressure, Linux PSI) is above
+  its limit, or the load average is well above the number of cores, the
+  limit goes down;
+- otherwise it hill-climbs: it keeps moving in the same direction while the
+  throughput holds and turns back when it drops. It does not go up while
+  there are slots nobody uses.
+
+Each decision is appended to the experiment's `.__autoscale` file as a line
+of JSON, with what it was based on. `liftoff-ctl <exp> procs_no N` sets the
+limit by hand and turns the tuner off, `procs_no auto` turns it back on.
+"""
+
+import json
+import os
+import time
+
+from termcolor import colored as clr
+
+from .common.sysinfo import cpu_count, load_average, pressure
+from .metrics import METRICS_FILE, RECORD
+
+AUTOSCALE_FILE = ".__autoscale"
+
+# Stall (PSI avg10, %) above which we have too many runs.
+PRESSURE_LIMITS = {
+    "cpu": ("some", 40.0),
+    "memory": ("some", 10.0),
+    "io": ("full", 20.0),
+}
+LOAD_LIMIT = 1.5  # times the number of cores
+TOLERANCE = 0.05  # relative drop in throughput we treat as noise
+
+
+def _metrics_size(run_path: str) -> int:
+    try:
+        return os.path.getsize(os.path.join(run_path, METRICS_FILE))
+    except FileNotFoundError:
+        return 0
+
+
+class ConcurrencyTuner:
+    """Hill-climbs the limit on concurrent runs of a LiftoffResources."""
+
+    def __init__(  # pylint: disable=bad-continuation
+        self,
+        experiment_path: str,
+        session_id: str,
+        bounds: tuple[int, int] = None,
+        interval: float = 60,
+    ) -> None:
+        self.path = os.path.join(experiment_path, AUTOSCALE_FILE)
+        self.session_id = session_id
+        self.low, self.high = bounds or (1, cpu_count())
+        self.interval = interval
+        self.direction = 1
+        self.previous = None  # throughput of the last window (per hour)
+        self.unit = "runs"  # or "records" once runs report something
+        self.sizes = {}  # run path -> size of its metrics file
+        self.ended_runs = 0  # runs that ended in this window
+        self.ended_bytes = 0  # what they wrote in this window
+        self.running = False  # True while the limit is ours to move
+        self.last = time.monotonic()
+
+    def timeout(self) -> float:
+        """Seconds until the next decision."""
+        return max(0.0, self.last + self.interval - time.monotonic())
+
+    def ended(self, run_path: str) -> None:
+        """Called when a run is over, so runs that start and end within one
+        window count too.
+        """
+        size = _metrics_size(run_path)
+        self.ended_bytes += max(size - self.sizes.pop(run_path, 0), 0)
+        self.ended_runs += 1
+
+    def _measure(self, children: list) -> tuple[int, int]:
+        """Records written and runs ended since the last call."""
+        written, ended = self.ended_bytes, self.ended_runs
+        self.ended_bytes, self.ended_runs = 0, 0
+        sizes = {}
+        for child in children:
+            size = _metrics_size(child.run_path)
+            written += max(size - self.sizes.get(child.run_path, 0), 0)
+            sizes[child.run_path] = size
+        self.sizes = sizes
+        return written // RECORD.size, ended
+
+    def _overloaded(self, load: float | None, stalls: dict) -> str | None:
+        for resource, (kind, limit) in PRESSURE_LIMITS.items():
+            value = stalls.get(resource, {}).get(kind)
+            if value is not None and value > limit:
+                return f"{resource:s} pressure {value:.0f}% > {limit:.0f}%"
+        if load is not None and load > LOAD_LIMIT * cpu_count():
+            return f"load {load:.1f} > {LOAD_LIMIT:g} x {cpu_count():d} cores"
+        return None
+
+    def update(self, resources, children: list) -> None:
+        """Moves the limit of `resources` if it is time to."""
+        if not resources.auto_procs:
+            self.running = False
+            return
+        if not self.running:
+            # Just turned on (at start or with liftoff-ctl): a fresh window.
+            self.running = True
+            self._measure(children)
+            self.last, self.previous = time.monotonic(), None
+            return
+        if self.timeout() > 0:
+            return
+        elapsed = time.monotonic() - self.last
+        self.last = time.monotonic()
+        records, ended = self._measure(children)
+        if records and self.unit != "records":
+            self.unit, self.previous = "records", None
+        work = records if self.unit == "records" else ended
+        throughput = work / elapsed * 3600  # per hour
+        load = load_average()
+        stalls = {resource: pressure(resource) for resource in PRESSURE_LIMITS}
+
+        limit = resources.procs_no
+        step = max(1, limit // 4)
+        saturated = resources.running_procs >= limit
+        reason = self._overloaded(load, stalls)
+        if reason is not None:
+            self.direction = -1
+            new_limit = limit - step
+        elif not saturated:
+            new_limit, reason = limit, "free slots"
+        elif self.previous is None:
+            new_limit, reason = limit + self.direction * step, "exploring"
+        elif throughput < self.previous * (1 - TOLERANCE):
+            self.direction = -self.direction
+            new_limit = limit + self.direction * step
+            reason = f"throughput fell from {self.previous:.3g}"
+        else:
+            new_limit = limit + self.direction * step
+            reason = f"throughput held (was {self.previous:.3g})"
+        new_limit = min(max(new_limit, self.low), self.high)
+        self.previous = throughput
+
+        decision = {
+            "time": int(time.time()),
+            "session": self.session_id,
+            "procs_no": limit,
+            "new_procs_no": new_limit,
+            "throughput": round(throughput, 3),
+            "unit": f"{self.unit:s}/h",
+            "running": resources.running_procs,
+            "load": load,
+            "pressure": {r: s for r, s in stalls.items() if s},
+            "reason": reason,
+        }
+        with open(self.path, "a") as handler:
+            handler.write(json.dumps(decision) + "\n")
+        if new_limit != limit:
+            resources.set_procs_no(new_limit)
+            msg = clr(f"procs_no {limit:d} -> {new_limit:d}", attrs=["bold"])
+            print(
+                f"[{time.strftime(time.ctime())}] Autoscale: {msg:s} ({reason:s},"
+                f" {throughput:.3g} {self.unit:s}/h)."
+            )
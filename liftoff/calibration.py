@@ -0,0 +1,173 @@
+"""Here we profile each sub-experiment with one short run before the sweep
+(--calibrate SECONDS).
+
+Before launching anything else, liftoff starts one run of each
+sub-experiment that was not calibrated yet and stops it once its budget is
+spent, like --run-timeout would (the run sees the budget in `ENDBY` and
+`liftoff.time_left()`). For each of them it appends a line of JSON to the
+experiment's `.__calibration` file:
+
+    {"subexperiment": "0001_lr_0.1", "run": "0001_lr_0.1/0", "budget": 60,
+     "wall_s": 60.3, "max_rss_mb": 812.4, "steps": 1200, "steps_per_s": 19.9,
+     "progress": 0.05, "ended": false, "expected_s": 1206.0}
+
+`steps` is the last step the run reported with `liftoff.report`. Runs that
+also report a `progress` scalar (the fraction done) get an expected
+duration; so do runs that end within the budget. Runs stopped by the budget
+are pending again, as if they never ran (their metrics are removed).
+
+The expected durations order the runs with the `sjf` policy (used by
+default with --calibrate) and the peak RSS is what each run asks for when
+runs are packed. The file stays in the experiment, so sub-experiments added
+later with `liftoff-prepare --append-to` are the only ones calibrated next
+time.
+"""
+
+import contextlib
+import json
+import os
+import time
+
+from .asha import MILESTONES_FILE
+from .common.run_index import PENDING
+from .metrics import KEYS_FILE, METRICS_FILE, latest_metrics
+from .startup import READY_FILE
+from .usage import USAGE_FILE, read_usage
+
+CALIBRATION_FILE = ".__calibration"
+
+
+def read_calibration(experiment_path: str) -> dict:
+    """The calibration records of an experiment, by sub-experiment."""
+    records = {}
+    try:
+        with open(os.path.join(experiment_path, CALIBRATION_FILE)) as handler:
+            for line in handler:
+                try:
+                    record = json.loads(line)
+                    records[record["subexperiment"]] = record
+                except (ValueError, KeyError, TypeError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return records
+
+
+class Calibration:
+    """Picks the calibration runs and keeps what we learnt from them."""
+
+    def __init__(self, experiment_path: str, budget: float) -> None:
+        self.experiment_path = experiment_path
+        self.path = os.path.join(experiment_path, CALIBRATION_FILE)
+        self.budget = budget
+        self.records = read_calibration(experiment_path)
+        self.active = True  # until all sub-experiments are calibrated
+        self.probing = set()  # sub-experiments with a calibration run going
+        self.waiting = {}  # sub-experiment -> its pending runs, last one first
+        self.known = None  # how many runs the index had when we listed them
+
+    def subexperiment(self, run_path: str) -> str:
+        """The sub-experiment of a run."""
+        return os.path.relpath(os.path.dirname(run_path), self.experiment_path)
+
+    def candidates(self, index, run_filter=None) -> list[str]:
+        """One pending run for each sub-experiment that still needs
+        calibrating (and has no calibration run going). The pending runs of
+        each sub-experiment are listed once, so this does not go through the
+        whole queue every time.
+        """
+        if self.known != len(index.states):
+            self.known = len(index.states)
+            self.waiting = {}
+            for rel_path, state in index.states.items():
+                if state == PENDING:
+                    name = os.path.dirname(rel_path)
+                    self.waiting.setdefault(name, []).append(rel_path)
+            for runs in self.waiting.values():
+                runs.reverse()
+        picked = []
+        for name in list(self.waiting):
+            if name in self.records:
+                del self.waiting[name]
+                continue
+            if name in self.probing:
+                continue
+            runs = self.waiting[name]
+            while runs and (
+                index.states.get(runs[-1]) != PENDING
+                or (
+                    run_filter is not None
+                    and not run_filter.matches_run(index.abspath(runs[-1]))
+                )
+            ):
+                runs.pop()
+            if runs:
+                picked.append(index.abspath(runs[-1]))
+            else:
+                del self.waiting[name]
+        return picked
+
+    def start(self, run_path: str) -> None:
+        """Notes that a calibration run was started."""
+        self.probing.add(self.subexperiment(run_path))
+
+    def record(self, child, session_id: str) -> dict:
+        """Records what a calibration run (now over) did. If it did not end
+        by itself, it is made pending again.
+        """
+        run_path = child.run_path
+        usage = read_usage(run_path) or {}
+        latest = latest_metrics(run_path)
+        steps = max((step for step, _ in latest.values()), default=None)
+        progress = latest.get("progress", (None, None))[1]
+        wall = usage.get("wall_s") or time.time() - child.started
+        ended = os.path.exists(os.path.join(run_path, ".__end"))
+        if ended:
+            expected = wall
+        elif progress:
+            expected = wall / progress
+        else:
+            expected = None
+        record = {
+            "subexperiment": self.subexperiment(run_path),
+            "run": os.path.relpath(run_path, self.experiment_path),
+            "budget": self.budget,
+            "wall_s": round(wall, 3),
+            "max_rss_mb": usage.get("max_rss_mb"),
+            "steps": steps,
+            "steps_per_s": round(steps / wall, 3) if steps and wall else None,
+            "progress": progress,
+            "ended": ended,
+            "expected_s": round(expected, 3) if expected else None,
+        }
+        with open(self.path, "a") as handler:
+            handler.write(json.dumps(record) + "\n")
+        self.records[record["subexperiment"]] = record
+        self.probing.discard(record["subexperiment"])
+        if not ended and os.path.exists(os.path.join(run_path, ".__timeout")):
+            self._reset(run_path, session_id)
+        return record
+
+    def _reset(self, run_path: str, session_id: str) -> None:
+        names = (".__timeout", ".__start", ".__cpus", READY_FILE, USAGE_FILE)
+        for name in (*names, METRICS_FILE, KEYS_FILE, MILESTONES_FILE):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(run_path, name))
+        with open(os.path.join(run_path, ".__journal"), "a") as handler:
+            handler.write(
+                f"[{time.strftime(time.ctime())}][{session_id}] Calibrated"
+                f" for {self.budget:g} s, pending again.\n"
+            )
+
+    def durations(self) -> dict:
+        """Expected durations (seconds) by sub-experiment, where known."""
+        return {
+            name: record["expected_s"]
+            for name, record in self.records.items()
+            if record.get("expected_s")
+        }
+
+    def peak_gb(self, run_path: str) -> float:
+        """The peak RSS of the calibration run of a run's sub-experiment."""
+        record = self.records.get(self.subexperiment(run_path)) or {}
+        return (record.get("max_rss_mb") or 0) / 1024
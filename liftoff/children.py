@@ -0,0 +1,537 @@
+"""Here we keep track of the processes liftoff launches.
+
+The launcher owns its children, so it learns that a run is over without
+asking `ps`. Attached runs are spawned directly and reaped with `os.wait4`
+as soon as their pidfd becomes readable. Detached runs (the default, the old
+`nohup` behaviour) get a small monitor process, forked in a new session,
+which waits for the run and reports its exit status and resource usage
+through a pipe. If liftoff dies, the monitor and the run carry on.
+
+Whoever reaps the process (liftoff or the monitor) calls `on_exit` with the
+exit code, so the end / crash markers are written even without liftoff. It
+also renews the lease on the run's lock (the `heartbeat`) for as long as the
+run lives, so other sessions do not take over a run that outlived liftoff.
+
+With `--warm-workers` runs are forked from a ForkServer which has imported
+the user's script once, instead of starting a new interpreter each time.
+"""
+
+import contextlib
+import json
+import os
+import random
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+from .common.leases import LeaseKeeper, renew
+from .common.liftopt import LO
+from .placement import limit_threads
+
+RUSAGE_FIELDS = [
+    "ru_utime",
+    "ru_stime",
+    "ru_maxrss",
+    "ru_minflt",
+    "ru_majflt",
+    "ru_inblock",
+    "ru_oublock",
+    "ru_nvcsw",
+    "ru_nivcsw",
+]
+
+
+def rusage_to_dict(rusage) -> dict:
+    """Keeps the interesting fields of a `resource.struct_rusage`."""
+    return {field: getattr(rusage, field) for field in RUSAGE_FIELDS}
+
+
+class Child:
+    """A process launched by liftoff. `fd` becomes readable once the process
+    is over, so children can be passed directly to `select`.
+    """
+
+    def __init__(  # pylint: disable=bad-continuation
+        self,
+        pid: int,
+        fd: int = None,
+        detached: bool = False,
+        on_exit=None,
+        buffer: bytes = b"",
+        monitor: int = None,
+    ) -> None:
+        self.pid = pid
+        self.fd = fd
+        self.detached = detached
+        self.on_exit = on_exit
+        self.returncode = None
+        self.rusage = None
+        self.usage = {}  # peaks sampled while it runs (see `usage`)
+        self.started = time.time()
+        self.done = False
+        self.pgid = pid if detached else None  # detached runs lead their group
+        self.deadline = None  # when it should be stopped (time.time())
+        self.kill_at = None  # when it gets SIGKILL if still alive
+        self._buffer = buffer  # status read before we got to the child
+        self.monitor = monitor  # our child that waits for a detached run
+        self.on_close = None  # called with `fd` right before it is closed
+
+    def fileno(self) -> int:
+        """The file descriptor to wait on (pidfd or status pipe)."""
+        return self.fd
+
+    def poll(self) -> bool:
+        """Checks, without blocking, if the process is over. If it is, the
+        exit code and the resource usage are collected.
+        """
+        if not self.done:
+            if self.detached:
+                self._read_status()
+            else:
+                self._reap()
+        return self.done
+
+    def _reap(self) -> None:
+        try:
+            pid, status, rusage = os.wait4(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            self._finish()
+            return
+        if pid == 0:
+            return
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self.rusage = rusage_to_dict(rusage)
+        if self.on_exit is not None:
+            self.on_exit(self.returncode)
+        self._finish()
+
+    def _read_status(self) -> None:
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        self._buffer += data
+        if b"\n" in self._buffer:
+            status = json.loads(self._buffer.split(b"\n", 1)[0])
+            self.returncode = status["returncode"]
+            self.rusage = status["rusage"]
+            self._finish()
+        elif not data:
+            # The monitor died without telling us anything.
+            self._finish()
+
+    def _finish(self) -> None:
+        self.done = True
+        if self.fd is not None:
+            if self.on_close is not None:
+                self.on_close(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.monitor is not None:
+            # It exits right after it reports (or it is gone already).
+            with contextlib.suppress(ChildProcessError):
+                os.waitpid(self.monitor, 0)
+            self.monitor = None
+
+    def send_signal(self, signum: int) -> None:
+        """Sends a signal to the process (and its process group, if it has
+        its own).
+        """
+        with contextlib.suppress(ProcessLookupError, PermissionError):
+            if self.pgid is not None:
+                os.killpg(self.pgid, signum)
+            else:
+                os.kill(self.pid, signum)
+
+    def describe(self) -> str:
+        """A short description of how the process ended."""
+        if self.returncode is None:
+            return "unknown exit status"
+        msg = f"exit code {self.returncode:d}"
+        if self.rusage:
+            cpu_time = self.rusage["ru_utime"] + self.rusage["ru_stime"]
+            msg += f", {cpu_time:.1f} CPU s"
+            msg += f", {self.rusage['ru_maxrss'] / 1024:.0f} MB max RSS"
+        return msg
+
+
+@contextlib.contextmanager
+def _pinned(cores):
+    """Temporarily restricts this process to the given cores, so that a
+    process spawned meanwhile inherits the affinity before it starts.
+    """
+    if not cores:
+        yield
+        return
+    previous = os.sched_getaffinity(0)
+    os.sched_setaffinity(0, cores)
+    try:
+        yield
+    finally:
+        os.sched_setaffinity(0, previous)
+
+
+def _posix_spawn(argv, env, out_path, err_path, detach, cores=None):
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    file_actions = [
+        (os.POSIX_SPAWN_OPEN, 1, out_path, flags, 0o644),
+        (os.POSIX_SPAWN_OPEN, 2, err_path, flags, 0o644),
+    ]
+    if detach:
+        file_actions.insert(0, (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0))
+    # Detached runs get their own process group, so they can be stopped
+    # together with their children without touching the monitor.
+    extra = {"setpgroup": 0} if detach else {}
+    with _pinned(cores):
+        return os.posix_spawnp(
+            argv[0],
+            argv,
+            env,
+            file_actions=file_actions,
+            setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+            **extra,
+        )
+
+
+def _write_line(fd: int, message: dict) -> None:
+    # If liftoff is gone, nobody is listening.
+    with contextlib.suppress(BrokenPipeError):
+        os.write(fd, (json.dumps(message) + "\n").encode("utf-8"))
+
+
+def _read_line(fd: int) -> tuple[bytes, bytes]:
+    """Reads the first line from a pipe, and whatever came after it."""
+    data = b""
+    while b"\n" not in data:
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            raise RuntimeError("The monitor process died before starting the run.")
+        data += chunk
+    line, rest = data.split(b"\n", 1)
+    return line, rest
+
+
+def _monitor(  # pylint: disable=bad-continuation
+    argv, env, out_path, err_path, status_fd, on_exit, cores, heartbeat
+) -> None:
+    """Runs in the monitor process: spawns the run and waits for it. If
+    a heartbeat (lock path, interval) is given, the lease on the lock is
+    renewed every interval seconds while waiting.
+    """
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        pid = _posix_spawn(argv, env, out_path, err_path, detach=True, cores=cores)
+    except OSError as exception:
+        _write_line(status_fd, {"error": str(exception)})
+        return
+    _write_line(status_fd, {"pid": pid})
+    if heartbeat is not None:
+        lock_path, interval = heartbeat
+        signal.signal(signal.SIGALRM, lambda *_: renew([lock_path]))
+        signal.setitimer(signal.ITIMER_REAL, interval, interval)
+    _, status, rusage = os.wait4(pid, 0)
+    signal.setitimer(signal.ITIMER_REAL, 0)
+    returncode = os.waitstatus_to_exitcode(status)
+    if on_exit is not None:
+        on_exit(returncode)
+    _write_line(status_fd, {"returncode": returncode, "rusage": rusage_to_dict(rusage)})
+
+
+def _spawn_detached(  # pylint: disable=bad-continuation
+    argv, env, out_path, err_path, on_exit, cores, heartbeat
+) -> Child:
+    read_fd, write_fd = os.pipe()
+    monitor = os.fork()
+    if monitor == 0:
+        # The monitor ends here, it never returns to the launcher's code.
+        exit_code = 1
+        try:
+            os.close(read_fd)
+            os.setsid()
+            _monitor(argv, env, out_path, err_path, write_fd, on_exit, cores, heartbeat)
+            exit_code = 0
+        except BaseException:  # pylint: disable=broad-except
+            traceback.print_exc()
+        finally:
+            os._exit(exit_code)
+
+    os.close(write_fd)
+    try:
+        line, rest = _read_line(read_fd)
+        started = json.loads(line)
+    except BaseException:
+        os.close(read_fd)
+        os.waitpid(monitor, 0)
+        raise
+    if "error" in started:
+        os.close(read_fd)
+        os.waitpid(monitor, 0)
+        raise OSError(started["error"])
+    os.set_blocking(read_fd, False)
+    return Child(started["pid"], read_fd, detached=True, buffer=rest, monitor=monitor)
+
+
+def spawn(  # pylint: disable=bad-continuation
+    argv,
+    env,
+    out_path,
+    err_path,
+    detach=True,
+    on_exit=None,
+    cores=None,
+    heartbeat=None,
+) -> Child:
+    """Starts a process with stdout and stderr redirected to the given files.
+    Detached processes survive liftoff. Raises OSError if the process could
+    not be started. If `cores` are given the process runs only on them. The
+    monitor of a detached process renews the lease in `heartbeat` (lock path,
+    interval); attached ones are renewed by liftoff alone.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if detach:
+        return _spawn_detached(argv, env, out_path, err_path, on_exit, cores, heartbeat)
+    pid = _posix_spawn(argv, env, out_path, err_path, detach=False, cores=cores)
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        fd = None  # we'll have to poll
+    return Child(pid, fd, on_exit=on_exit)
+
+
+def reseed() -> None:
+    """Forked processes would otherwise all draw the same random numbers."""
+    random.seed()
+    if "numpy" in sys.modules:
+        sys.modules["numpy"].random.seed()
+
+
+def _fork_worker(function, request, status_fd, inherited) -> None:
+    """Runs in a child of the fork server: redirects the output, sets up the
+    environment and calls the (already imported) function.
+    """
+    exit_code = 1
+    try:
+        os.setpgid(0, 0)
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        for fd in inherited:
+            os.close(fd)
+        os.close(status_fd)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+        null_fd = os.open(os.devnull, os.O_RDONLY)
+        out_fd = os.open(request["out_path"], flags, 0o644)
+        err_fd = os.open(request["err_path"], flags, 0o644)
+        for fd, target in ((null_fd, 0), (out_fd, 1), (err_fd, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdout.reconfigure(write_through=True)
+        sys.stderr.reconfigure(write_through=True)
+        os.environ.clear()
+        os.environ.update(request["env"])
+        sys.argv = request["argv"]
+        if request.get("cores"):
+            os.sched_setaffinity(0, request["cores"])
+            missed = limit_threads(len(request["cores"]))
+            if missed:
+                print(
+                    "liftoff: the thread pools of " + ", ".join(missed) + " were"
+                    " sized before the run was pinned; they may use more threads"
+                    " than cores.",
+                    file=sys.stderr,
+                )
+        reseed()
+        cfg = LO.from_yaml(request["cfg_path"])
+        exit_code = 0 if function(cfg) is not False else 1
+    except SystemExit as exception:
+        exit_code = exception.code if isinstance(exception.code, int) else 1
+    except BaseException:  # pylint: disable=broad-except
+        traceback.print_exc()
+    finally:
+        with contextlib.suppress(Exception):
+            sys.stdout.flush()
+            sys.stderr.flush()
+        os._exit(exit_code)
+
+
+def _serve(sock, loader, on_exit, detach) -> None:
+    """The fork server loop: imports the script once, forks a worker for each
+    request and reports how the workers end on their status pipes. It renews
+    the leases of the runs of its workers, all at once. Stops accepting work
+    when liftoff closes the socket, and exits once all workers are done.
+    """
+    if detach:
+        os.setsid()
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        function = loader()
+    except BaseException:  # pylint: disable=broad-except
+        sock.send(json.dumps({"error": traceback.format_exc()}).encode("utf-8"))
+        return
+    sock.send(json.dumps({"ready": True}).encode("utf-8"))
+
+    wake_r, wake_w = os.pipe()
+    os.set_blocking(wake_r, False)
+    os.set_blocking(wake_w, False)
+    signal.set_wakeup_fd(wake_w)
+    signal.signal(signal.SIGCHLD, lambda *_: None)
+
+    running = {}  # pid -> (status_fd, run_path)
+    leases = {}  # pid -> lock path
+    keeper = None
+    accepting = True
+    while accepting or running:
+        waitables = [wake_r, sock] if accepting else [wake_r]
+        timeout = keeper.timeout() if keeper is not None and leases else None
+        readable, _, _ = select.select(waitables, [], [], timeout)
+        if keeper is not None:
+            keeper.renew(list(leases.values()))
+        if sock in readable:
+            try:
+                msg, fds, _, _ = socket.recv_fds(sock, 1 << 20, 1)
+            except ConnectionError:
+                msg, fds = b"", []
+            if not msg:
+                accepting = False
+                sock.close()
+                continue
+            request, status_fd = json.loads(msg), fds[0]
+            inherited = [sock.fileno(), wake_r, wake_w]
+            inherited.extend(fd for fd, _ in running.values())
+            try:
+                pid = os.fork()
+            except OSError as exception:
+                os.close(status_fd)
+                sock.send(json.dumps({"error": str(exception)}).encode("utf-8"))
+                continue
+            if pid == 0:
+                _fork_worker(function, request, status_fd, inherited)
+            with contextlib.suppress(OSError):
+                os.setpgid(pid, pid)  # also done by the worker, whoever is first
+            running[pid] = (status_fd, request["run_path"])
+            if request.get("heartbeat"):
+                lock_path, interval = request["heartbeat"]
+                leases[pid] = lock_path
+                if keeper is None or interval < keeper.interval:
+                    keeper = LeaseKeeper(interval * 3)
+            sock.send(json.dumps({"pid": pid}).encode("utf-8"))
+        if wake_r in readable:
+            with contextlib.suppress(BlockingIOError):
+                while os.read(wake_r, 4096):
+                    pass
+        while running:
+            try:
+                pid, status, rusage = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if pid not in running:
+                continue
+            status_fd, run_path = running.pop(pid)
+            leases.pop(pid, None)
+            returncode = os.waitstatus_to_exitcode(status)
+            if on_exit is not None:
+                on_exit(run_path, returncode)
+            _write_line(
+                status_fd, {"returncode": returncode, "rusage": rusage_to_dict(rusage)}
+            )
+            os.close(status_fd)
+
+
+class ForkServer:
+    """A process that imports the user's script once and then forks a
+    worker for each run, so runs skip the interpreter startup and the
+    imports. Workers are children of the server, which reports their exit
+    status through the same kind of pipe the detached monitor uses.
+
+    `loader` is called in the server and returns the function each worker
+    calls with the run's config. `on_exit(run_path, returncode)` is called
+    by the server when a worker ends.
+    """
+
+    def __init__(self, loader, on_exit=None, detach=True) -> None:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.sock, server_sock = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET
+        )
+        self.pid = os.fork()
+        if self.pid == 0:
+            exit_code = 1
+            try:
+                self.sock.close()
+                _serve(server_sock, loader, on_exit, detach)
+                exit_code = 0
+            except BaseException:  # pylint: disable=broad-except
+                traceback.print_exc()
+            finally:
+                os._exit(exit_code)
+        server_sock.close()
+        reply = self._receive()
+        if "error" in reply:
+            self.close()
+            raise RuntimeError(f"The fork server failed to start:\n{reply['error']}")
+
+    def _receive(self) -> dict:
+        data = self.sock.recv(1 << 16)
+        if not data:
+            raise OSError("The fork server is gone.")
+        return json.loads(data)
+
+    def spawn(  # pylint: disable=bad-continuation
+        self,
+        argv,
+        env,
+        cfg_path,
+        out_path,
+        err_path,
+        run_path,
+        cores=None,
+        heartbeat=None,
+    ) -> Child:
+        """Forks a worker for a run. `argv` is what the worker sees in
+        sys.argv. The server renews the lease in `heartbeat` (lock path,
+        interval) until the worker ends. Raises OSError if the worker could
+        not be started.
+        """
+        request = {
+            "argv": argv,
+            "env": env,
+            "cfg_path": cfg_path,
+            "out_path": out_path,
+            "err_path": err_path,
+            "run_path": run_path,
+            "cores": cores,
+            "heartbeat": heartbeat,
+        }
+        read_fd, write_fd = os.pipe()
+        try:
+            socket.send_fds(
+                self.sock, [json.dumps(request).encode("utf-8")], [write_fd]
+            )
+            reply = self._receive()
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        if "error" in reply:
+            os.close(read_fd)
+            raise OSError(reply["error"])
+        os.set_blocking(read_fd, False)
+        return Child(reply["pid"], read_fd, detached=True)
+
+    def close(self) -> None:
+        """Tells the server to stop once its workers are done."""
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        with contextlib.suppress(ChildProcessError):
+            os.waitpid(self.pid, 0)
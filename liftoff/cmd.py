@@ -75,3 +75,21 @@ def unlock():
 
     hello()
     _lock(unlock=True)
+
+
+def index():
+    """liftoff-index"""
+    from .common.local_info import hello
+    from .reindex import reindex as _reindex
+
+    hello()
+    _reindex()
+
+
+def ctl():
+    """liftoff-ctl"""
+    from .common.local_info import hello
+    from .control import ctl as _ctl
+
+    hello()
+    _ctl()
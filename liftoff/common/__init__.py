@@ -5,6 +5,12 @@ LIFTOFF_FILES = [
     ".__start",
     ".__end",
     ".__crash",
+    ".__pruned",
+    ".__timeout",
+    ".__exit",
+    ".__retries",
+    ".__usage",
+    ".__ready",
     ".__journal",
     "cfg.yaml",
 ]
@@ -0,0 +1,176 @@
+"""Here we parse the `--filters` given to liftoff, liftoff-lock/unlock and
+liftoff-status into a predicate over run configurations.
+
+Each filter is `<dotted.key><op><value>` with op one of `=`, `!=`, `<`, `<=`,
+`>`, `>=`, `=~` (the value is a regular expression searched in the config
+value) or ` in ` (the value is a list: `model.name in [AlexNet, VGG]` or
+`optim.lr in 0.1,0.01`). Values are read as YAML, so `0.001` is a float,
+`true` a bool and `None` / `null` is None; against a number or a bool in
+the config they are converted to its type, so `optim.lr=1e-4` matches
+`0.0001` and `flag=1` matches `true`. A run matches only if it matches all
+the filters. A missing key matches only `!=`.
+
+Configurations are parsed at most once: `ConfigCache` keeps them until the
+modification time of the `cfg.yaml` file changes.
+"""
+
+import os
+import re
+
+import yaml
+
+FILTER_RE = re.compile(
+    r"^\s*(?P<key>[^\s=!<>~]+)\s*(?P<op>=~|!=|<=|>=|==|=|<|>|\s+in\s+)\s*(?P<value>.*)$"
+)
+
+MISSING = object()
+
+
+def _load_value(value: str):
+    if value == "None":
+        return None
+    try:
+        return yaml.load(value, Loader=yaml.SafeLoader)
+    except yaml.YAMLError:
+        return value
+
+
+def _coerce(actual, expected, raw: str):
+    """The filter value as the type of the config value, when YAML read it
+    as something else (YAML 1.1 reads `1e-4` as a string, and `flag=1` means
+    `flag=True`).
+    """
+    if isinstance(actual, bool):
+        if isinstance(expected, (int, float)) and not isinstance(expected, bool):
+            return bool(expected)
+        return expected
+    if isinstance(actual, (int, float)) and isinstance(expected, str):
+        for kind in (type(actual), float):
+            try:
+                return kind(raw)
+            except ValueError:
+                pass
+    return expected
+
+
+def _equals(actual, expected, raw: str) -> bool:
+    expected = _coerce(actual, expected, raw)
+    if isinstance(actual, str):
+        return actual in (raw, expected)
+    if isinstance(actual, bool) != isinstance(expected, bool):
+        return False
+    return actual == expected
+
+
+class Condition:
+    """A single `key op value` filter."""
+
+    def __init__(self, text: str) -> None:
+        match = FILTER_RE.match(text)
+        if match is None:
+            raise ValueError(f"Cannot parse filter {text!r}.")
+        self.text = text
+        self.keys = match.group("key").split(".")
+        self.op = match.group("op").strip()
+        self.raw = match.group("value").strip()
+        if self.op == "=~":
+            self.value = re.compile(self.raw)
+        elif self.op == "in":
+            value = _load_value(self.raw)
+            if isinstance(value, str) or not isinstance(value, list):
+                value = [s.strip() for s in self.raw.strip("[]").split(",")]
+                value = [(_load_value(s), s) for s in value]
+            else:
+                value = [(v, str(v)) for v in value]
+            self.value = value
+        else:
+            self.value = _load_value(self.raw)
+
+    def lookup(self, cfg: dict):
+        """Returns the value found at the dotted key, or MISSING."""
+        for key in self.keys:
+            if not isinstance(cfg, dict) or key not in cfg:
+                return MISSING
+            cfg = cfg[key]
+        return cfg
+
+    def matches(self, cfg: dict) -> bool:
+        """Checks the condition against a configuration."""
+        actual = self.lookup(cfg)
+        if actual is MISSING:
+            return self.op == "!="
+        if self.op in ("=", "=="):
+            return _equals(actual, self.value, self.raw)
+        if self.op == "!=":
+            return not _equals(actual, self.value, self.raw)
+        if self.op == "=~":
+            return self.value.search(str(actual)) is not None
+        if self.op == "in":
+            return any(_equals(actual, v, raw) for v, raw in self.value)
+        value = _coerce(actual, self.value, self.raw)
+        try:
+            if self.op == "<":
+                return actual < value
+            if self.op == "<=":
+                return actual <= value
+            if self.op == ">":
+                return actual > value
+            return actual >= value
+        except TypeError:
+            return False
+
+    def __repr__(self) -> str:
+        return self.text
+
+
+class ConfigCache:
+    """Parsed `cfg.yaml` files of runs, invalidated by modification time."""
+
+    def __init__(self) -> None:
+        self.configs = {}
+
+    def get(self, run_path: str) -> dict:
+        """Returns the parsed configuration of a run."""
+        cfg_path = os.path.join(run_path, "cfg.yaml")
+        mtime = os.stat(cfg_path).st_mtime_ns
+        cached = self.configs.get(cfg_path)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        with open(cfg_path) as handler:
+            cfg = yaml.load(handler, Loader=yaml.SafeLoader)
+        self.configs[cfg_path] = (mtime, cfg)
+        return cfg
+
+
+class RunFilter:
+    """All the conditions given with `--filters`, checked together."""
+
+    def __init__(self, filters: list[str], cache: ConfigCache = None) -> None:
+        self.conditions = [Condition(flt) for flt in filters]
+        self.cache = ConfigCache() if cache is None else cache
+
+    def matches(self, cfg: dict) -> bool:
+        """Checks if a configuration matches all conditions."""
+        return all(cond.matches(cfg) for cond in self.conditions)
+
+    def matches_run(self, run_path: str) -> bool:
+        """Checks if the configuration of a run matches all conditions. Runs
+        without a readable configuration do not match.
+        """
+        try:
+            cfg = self.cache.get(run_path)
+        except (OSError, yaml.YAMLError):
+            return False
+        return self.matches(cfg)
+
+    def __repr__(self) -> str:
+        return " and ".join(map(repr, self.conditions))
+
+
+def compile_filters(  # pylint: disable=bad-continuation
+    filters: list[str] | None, cache: ConfigCache = None
+) -> RunFilter | None:
+    """Builds the predicate for a list of filters; None if there are none."""
+    if not filters:
+        return None
+    return RunFilter(filters, cache=cache)
@@ -0,0 +1,139 @@
+"""Here we implement leases: `.__lock` files that say who holds a run
+(session, host, pid) and for how long. The holder renews the lease by
+touching the file, so the lease expires `lease` seconds after the file was
+last modified. Expired leases can be taken over by any other session.
+
+Locks written by older versions of liftoff, by liftoff-lock, or by runs
+started in-process hold just a session id; they never expire.
+
+Expiry is judged by comparing the modification time of the lock with the
+local clock, so the clocks of the machines sharing an experiment should be
+roughly in sync.
+"""
+
+import contextlib
+import json
+import os
+import socket
+import time
+
+
+def lease_content(session_id: str, lease: float) -> str:
+    """What we write in a lock file we hold for `lease` seconds."""
+    return json.dumps(
+        {
+            "session": session_id,
+            "host": socket.gethostname(),
+            "pid": os.getpid(),
+            "lease": lease,
+        }
+    )
+
+
+def read_lease(lock_path: str) -> dict | None:
+    """Reads a lock file. Returns None if it does not exist and an empty
+    dict if it is not a lease (it never expires).
+    """
+    try:
+        with open(lock_path) as handler:
+            content = handler.read()
+        mtime = os.stat(lock_path).st_mtime
+    except FileNotFoundError:
+        return None
+    try:
+        info = json.loads(content)
+    except ValueError:
+        return {}
+    if not isinstance(info, dict) or "lease" not in info:
+        return {}
+    info["expires"] = mtime + float(info["lease"])
+    return info
+
+
+def lease_expired(lock_path: str, now: float = None) -> bool:
+    """Checks if a lock is an expired lease."""
+    info = read_lease(lock_path)
+    if not info:
+        return False
+    return info["expires"] < (time.time() if now is None else now)
+
+
+def lease_alive(lock_path: str, now: float = None) -> bool:
+    """Checks if a lock is a lease nobody may take over yet."""
+    info = read_lease(lock_path)
+    if not info:
+        return False
+    return info["expires"] >= (time.time() if now is None else now)
+
+
+def renew(lock_paths: list[str]) -> list[str]:
+    """Renews several leases in one pass. Returns the locks that are gone
+    (someone took them over).
+    """
+    lost = []
+    for lock_path in lock_paths:
+        try:
+            os.utime(lock_path)
+        except FileNotFoundError:
+            lost.append(lock_path)
+    return lost
+
+
+def release(lock_path: str, session_id: str) -> bool:
+    """Removes a lock unless it is a lease held by another session (ours was
+    taken over). Returns True if the lock was ours.
+    """
+    info = read_lease(lock_path)
+    if info is None:
+        return False
+    if info and info["session"] != session_id:
+        return False
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(lock_path)
+    return True
+
+
+def break_lease(lock_path: str) -> bool:
+    """Removes an expired lease. Only one of several sessions trying at the
+    same time succeeds: the lock is first renamed to a name of our own, which
+    is atomic. If the holder renewed the lease meanwhile, it is put back.
+    Returns True if we removed it.
+    """
+    grave = f"{lock_path:s}.{socket.gethostname():s}.{os.getpid():d}"
+    if not lease_expired(lock_path):
+        return False
+    try:
+        os.rename(lock_path, grave)
+    except FileNotFoundError:
+        return False  # someone else was faster
+    if lease_expired(grave):
+        os.remove(grave)
+        return True
+    # Renewed just before we moved it: give it back, unless somebody has
+    # already created a new lock.
+    with contextlib.suppress(FileExistsError):
+        os.link(grave, lock_path)
+    os.remove(grave)
+    return False
+
+
+class LeaseKeeper:
+    """Renews the leases of the runs a supervisor holds, all at once, every
+    third of the lease. The first renewal is due right away.
+    """
+
+    def __init__(self, lease: float) -> None:
+        self.lease = lease
+        self.interval = lease / 3
+        self.last = float("-inf")
+
+    def timeout(self) -> float:
+        """Seconds until the next renewal."""
+        return max(0.0, self.last + self.interval - time.monotonic())
+
+    def renew(self, lock_paths: list[str], force: bool = False) -> list[str]:
+        """Renews the leases if it is time to. Returns the lost ones."""
+        if not force and self.timeout() > 0:
+            return []
+        self.last = time.monotonic()
+        return renew(lock_paths)
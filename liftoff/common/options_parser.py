@@ -11,6 +11,11 @@ from argparse import ArgumentParser, Namespace
 from .liftoff_config import LiftoffConfig
 
 
+def procs_no_type(value: str) -> int | str:
+    """A number of processes or `auto`."""
+    return value if value == "auto" else int(value)
+
+
 class OptionParser:
     """This class facilitates combining command line arguments and liftoff
     settings.
@@ -45,6 +50,36 @@ class OptionParser:
 
         return opts
 
+    def _add_asha(self) -> None:
+        self.arg_parser.add_argument(
+            "--asha",
+            dest="asha",
+            type=float,
+            metavar="MIN_STEP",
+            help="""Stop unpromising runs early by asynchronous successive\
+            halving. Runs report a metric with `liftoff.milestone(opts.out_dir,\
+            step, value)`; at steps MIN_STEP * eta^k a run goes on only if it is\
+            among the best 1/eta of the runs that got there before it.""",
+        )
+
+    def _add_asha_eta(self) -> None:
+        self.arg_parser.add_argument(
+            "--asha-eta",
+            dest="asha_eta",
+            type=int,
+            default=3,
+            help="Reduction factor for --asha. Defaults to 3.",
+        )
+
+    def _add_asha_goal(self) -> None:
+        self.arg_parser.add_argument(
+            "--asha-goal",
+            dest="asha_goal",
+            choices=["min", "max"],
+            default="min",
+            help="Whether smaller (a loss) or larger metrics are better for --asha.",
+        )
+
     def _add_all(self) -> None:
         self.arg_parser.add_argument(
             "-a",
@@ -74,6 +109,16 @@ class OptionParser:
                 for `model.name` in the config file.""",
         )
 
+    def _add_command(self) -> None:
+        self.arg_parser.add_argument(
+            "command",
+            type=str,
+            nargs="+",
+            help="""Command for the running liftoff sessions: `procs_no N|auto`,\
+            `per_gpu N [N ...]`, `gpus G [G ...]`, `pause`, `resume`, or\
+            `drain`.""",
+        )
+
     def _add_copy_to_clipboard(self) -> None:
         self.arg_parser.add_argument(
             "--cc",
@@ -87,6 +132,31 @@ class OptionParser:
             "config_path", type=str, help="Give a specific name to the experiment."
         )
 
+    def _add_experiments(self) -> None:
+        self.arg_parser.add_argument(
+            "config_path",
+            type=str,
+            nargs="?",
+            help="The experiment (or a config file) to run.",
+        )
+        self.arg_parser.add_argument(
+            "experiments",
+            type=str,
+            nargs="*",
+            help="More experiments to run at the same time, sharing the slots.",
+        )
+
+    def _add_queue(self) -> None:
+        self.arg_parser.add_argument(
+            "--queue",
+            dest="queue",
+            type=str,
+            metavar="FILE",
+            help="""Run the experiments listed in FILE, one per line with an\
+            optional `weight=W` and `priority=P`, sharing the slots. Lines\
+            appended while liftoff runs are picked up.""",
+        )
+
     def _add_do(self) -> None:
         self.arg_parser.add_argument(
             "--do",
@@ -117,12 +187,13 @@ class OptionParser:
             dest="filters",
             type=str,
             nargs="*",
-            help="""List of `key=value` strings present in your config files \
-            or results folder that you wish to filter.\
-            Example: `--filters optim.lr=0.001 model.name=AlexNet` will match \
-            experiments containing this configuration. `liftoff ...` will use it to \
-            leave out matched experiments from launching. `liftoff-lock/unlock` will \
-            use it to act on matched experiments accordingly.""",
+            help="""List of conditions on the values in your config files, \
+            all of which must hold. A condition is `key op value` where key may \
+            be dotted and op is one of =, !=, <, <=, >, >=, =~ (regex) or `in` \
+            (a list). Example: `--filters optim.lr=0.001 "model.name in [AlexNet, \
+            VGG]"`. `liftoff ...` will only launch the matched runs, \
+            `liftoff-lock/unlock` will act only on them, and `liftoff-status` will \
+            count only them.""",
         )
 
     def _add_gpus(self) -> None:
@@ -134,6 +205,101 @@ class OptionParser:
             help="List of available GPUs. Eg.: --gpus 0 1",
         )
 
+    def _add_lease(self) -> None:
+        default_value = self.liftoff_config.get("lease")
+        if default_value is None:
+            default_value = 120
+        self.arg_parser.add_argument(
+            "--lease",
+            dest="lease",
+            type=float,
+            default=float(default_value),
+            help="""Runs are locked for this many seconds and liftoff renews the\
+            locks while they run. Other liftoff sessions take over runs whose\
+            lock expired (e.g. their machine died). 0 locks them for good.\
+            Defaults to 120.""",
+        )
+
+    def _add_mem_guard(self) -> None:
+        self.arg_parser.add_argument(
+            "--mem-guard",
+            dest="mem_guard",
+            type=float,
+            metavar="RESERVE_GB",
+            help="""Start a run only if the memory available stays above\
+            RESERVE_GB once it reaches the peak RSS learned from the finished\
+            runs of its sub-experiment, and the memory pressure is low.""",
+        )
+
+    def _add_mem_suspend(self) -> None:
+        self.arg_parser.add_argument(
+            "--mem-suspend",
+            action="store_true",
+            dest="mem_suspend",
+            help="""With --mem-guard, suspend (SIGSTOP) the youngest run when\
+            memory gets scarce and resume it when there is room again.""",
+        )
+
+    def _add_calibrate(self) -> None:
+        self.arg_parser.add_argument(
+            "--calibrate",
+            dest="calibrate",
+            type=float,
+            metavar="SECONDS",
+            help="""Before the sweep, run one run of each sub-experiment for\
+            SECONDS to learn its speed and peak memory (see .__calibration),\
+            then order the runs by expected duration (--policy sjf).""",
+        )
+
+    def _add_metrics(self) -> None:
+        self.arg_parser.add_argument(
+            "--metrics",
+            action="store_true",
+            dest="metrics",
+            help="Also show the latest values reported by runs (liftoff.report).",
+        )
+
+    def _add_max_retries(self) -> None:
+        default_value = self.liftoff_config.get("max_retries")
+        self.arg_parser.add_argument(
+            "--max-retries",
+            dest="max_retries",
+            type=int,
+            default=int(default_value or 0),
+            help="""Retry runs that crashed in a retryable way (see --retry-on)\
+            up to this many times. Defaults to 0.""",
+        )
+
+    def _add_retry_on(self) -> None:
+        default_value = self.liftoff_config.get("retry_on") or ["signal"]
+        self.arg_parser.add_argument(
+            "--retry-on",
+            dest="retry_on",
+            type=str,
+            nargs="+",
+            default=default_value,
+            help="""Which crashes are retryable: `signal` (killed, e.g. by the\
+            OOM killer), `signal:NAME`, `exit:CODE`, or `err:REGEX` (searched in\
+            the end of `err`). Defaults to `signal`.""",
+        )
+
+    def _add_retry_backoff(self) -> None:
+        self.arg_parser.add_argument(
+            "--retry-backoff",
+            dest="retry_backoff",
+            type=float,
+            default=30,
+            help="Seconds before the first retry, doubled for each next one.",
+        )
+
+    def _add_usage(self) -> None:
+        self.arg_parser.add_argument(
+            "--usage",
+            action="store_true",
+            dest="usage",
+            help="Also show the CPU time, memory and I/O used by the finished runs.",
+        )
+
     def _add_name(self) -> None:
         self.arg_parser.add_argument(
             "--name",
@@ -180,19 +346,119 @@ class OptionParser:
     def _add_pid(self) -> None:
         self.arg_parser.add_argument("pid", type=int, help="PID of liftoff to kill.")
 
+    def _add_pin_cpus(self) -> None:
+        self.arg_parser.add_argument(
+            "--pin-cpus",
+            dest="pin_cpus",
+            nargs="?",
+            const="cores",
+            choices=["cores", "numa"],
+            help="""Pin each run to its own set of cores (the `cpus` it asks for\
+            or an equal share) and set OMP_NUM_THREADS & co. to match. With\
+            `--pin-cpus numa` a run's cores come from a single NUMA node when\
+            possible.""",
+        )
+
+    def _add_policy(self) -> None:
+        default_value = self.liftoff_config.get("policy") or "fifo"
+        self.arg_parser.add_argument(
+            "--policy",
+            dest="policy",
+            choices=["fifo", "random", "priority", "sjf", "round-robin"],
+            default=default_value,
+            help="""Order in which pending runs are launched: as added (fifo),\
+            random, by `liftoff.priority` in the config (priority), shortest\
+            expected duration first based on finished runs of the same\
+            sub-experiment (sjf), or one run from each sub-experiment in turn\
+            (round-robin).""",
+        )
+
     def _add_procs_no(self) -> None:
         default_value = self.liftoff_config.get("procs_no")
         if default_value is None:
             default_value = 1
-        default_value = int(default_value)
+        default_value = procs_no_type(str(default_value))
         self.arg_parser.add_argument(
             "--procs-no",
             dest="procs_no",
             required=False,
-            type=int,
+            type=procs_no_type,
             default=default_value,
-            help="""Total number of experiment runs allowed to run concurrently.\
-            Defaults to 1.""",
+            help="""Total number of experiment runs allowed to run concurrently,\
+            or `auto` to let liftoff choose it from the throughput and the load\
+            of the machine (within --procs-bounds). Defaults to 1.""",
+        )
+
+    def _add_procs_bounds(self) -> None:
+        self.arg_parser.add_argument(
+            "--procs-bounds",
+            dest="procs_bounds",
+            type=int,
+            nargs=2,
+            metavar=("MIN", "MAX"),
+            help="""Limits for --procs-no auto. Defaults to 1 and the number of\
+            cores.""",
+        )
+
+    def _add_host_slots(self) -> None:
+        self.arg_parser.add_argument(
+            "--host-slots",
+            dest="host_slots",
+            nargs="?",
+            const="",
+            metavar="PATH",
+            help="""Share the CPU and GPU slots of this machine with the other\
+            liftoff sessions started with --host-slots, through the file PATH\
+            (defaults to /dev/shm/liftoff-slots.json).""",
+        )
+
+    def _add_host_weight(self, default_value: float = 1) -> None:
+        self.arg_parser.add_argument(
+            "--host-weight",
+            dest="host_weight",
+            type=float,
+            default=float(default_value),
+            help="""With --host-slots, this session's weight in the fair share\
+            of the machine. Defaults to 1.""",
+        )
+
+    def _add_launch_rate(self) -> None:
+        self.arg_parser.add_argument(
+            "--launch-rate",
+            dest="launch_rate",
+            type=float,
+            nargs=2,
+            metavar=("N", "SECONDS"),
+            help="""Launch at most N runs every SECONDS, so they do not all\
+            load their data at once.""",
+        )
+
+    def _add_stagger(self) -> None:
+        self.arg_parser.add_argument(
+            "--stagger",
+            action="store_true",
+            dest="stagger",
+            help="""Launch a run only once the previous one is ready: it\
+            called liftoff.ready() or reported its first step.""",
+        )
+
+    def _add_ready_timeout(self, default_value: float = 600) -> None:
+        self.arg_parser.add_argument(
+            "--ready-timeout",
+            dest="ready_timeout",
+            type=float,
+            default=float(default_value),
+            help="""With --stagger, stop waiting for a run that is not ready\
+            after this many seconds. Defaults to 600.""",
+        )
+
+    def _add_autoscale_every(self) -> None:
+        self.arg_parser.add_argument(
+            "--autoscale-every",
+            dest="autoscale_every",
+            type=float,
+            default=60,
+            help="Seconds between two decisions of --procs-no auto.",
         )
 
     def _add_results_path(self) -> None:
@@ -277,6 +543,14 @@ class OptionParser:
             help="Verbose level (default: 0) e.g. -v / -vv / -vvv",
         )
 
+    def _add_session(self) -> None:
+        self.arg_parser.add_argument(
+            "--session",
+            type=str,
+            dest="session",
+            help="Send to this liftoff session only (a prefix of its id).",
+        )
+
     def _add_session_id(self) -> None:
         self.arg_parser.add_argument(
             "--session-id",
@@ -313,6 +587,33 @@ class OptionParser:
             help="Pass this to the processes using ENDBY variable.",
         )
 
+    def _add_hard_end_by(self) -> None:
+        self.arg_parser.add_argument(
+            "--hard-end-by",
+            action="store_true",
+            dest="hard_end_by",
+            help="Stop the runs still going when --end-by seconds have passed.",
+        )
+
+    def _add_run_timeout(self) -> None:
+        self.arg_parser.add_argument(
+            "--run-timeout",
+            type=float,
+            dest="run_timeout",
+            default=0,
+            help="Stop runs going for longer than this many seconds (0 - never).",
+        )
+
+    def _add_kill_grace(self) -> None:
+        self.arg_parser.add_argument(
+            "--kill-grace",
+            type=float,
+            dest="kill_grace",
+            default=30,
+            help="""Seconds a run gets to exit after SIGTERM (timeouts, ASHA)\
+            before it is killed with SIGKILL. Defaults to 30.""",
+        )
+
     def _add_max_runs(self) -> None:
         self.arg_parser.add_argument(
             "--max-runs",
@@ -322,10 +623,61 @@ class OptionParser:
             help="Stop if max runs have been exceeded. (default 0 - run all).",
         )
 
+    def _add_watch(self) -> None:
+        self.arg_parser.add_argument(
+            "--watch",
+            action="store_true",
+            dest="watch",
+            help="""Sleep until runs end or new ones are added (inotify) instead\
+            of polling. Changes made from other hosts on network file systems\
+            are not seen.""",
+        )
+
+    def _add_cpus(self) -> None:
+        self.arg_parser.add_argument(
+            "--cpus",
+            dest="cpus",
+            type=float,
+            help="""CPU cores runs may use together (see `cpus` in the `liftoff`\
+            block of a config). Defaults to the cores available to liftoff.""",
+        )
+
+    def _add_mem_gb(self) -> None:
+        self.arg_parser.add_argument(
+            "--mem-gb",
+            dest="mem_gb",
+            type=float,
+            help="""Memory (in GB) runs may use together (see `mem_gb` in the\
+            `liftoff` block of a config). Defaults to the machine's memory.""",
+        )
+
+    def _add_packing(self) -> None:
+        default_value = self.liftoff_config.get("packing") or "first-fit"
+        self.arg_parser.add_argument(
+            "--packing",
+            dest="packing",
+            choices=["first-fit", "best-fit"],
+            default=default_value,
+            help="""How runs are chosen when they ask for different resources:\
+            in order, skipping those that do not fit (first-fit), or the largest\
+            ones first with smaller ones filling the gaps (best-fit).""",
+        )
+
+    def _add_warm_workers(self) -> None:
+        self.arg_parser.add_argument(
+            "--warm-workers",
+            action="store_true",
+            dest="warm_workers",
+            help="""Import the script once in a fork server and fork each run from\
+            it, calling `run(LO.from_yaml(cfg))`, instead of starting a new\
+            interpreter per run. The script must not initialize CUDA (or start\
+            threads) at import time.""",
+        )
+
     def _add_shuffle(self) -> None:
         self.arg_parser.add_argument(
             "--shuffle",
             action="store_true",
             dest="shuffle",
-            help="Makes sure the runs are launched randomly.",
+            help="Makes sure the runs are launched randomly (--policy random).",
         )
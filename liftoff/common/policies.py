@@ -0,0 +1,328 @@
+"""Here we define the policies that decide which pending run is launched
+next. Pending runs are kept in a heap ordered by the policy's key, so
+picking the next run costs O(log n).
+
+  - fifo: the order in which runs were added to the index;
+  - random: a random order (what --shuffle used to do);
+  - priority: higher `priority` (in the `liftoff` block of the config) first;
+  - sjf: shortest expected job first, where the expected duration of a run is
+    the mean duration of the finished runs of its sub-experiment, or the
+    estimate from its calibration run (see `calibration`), or the mean of all
+    finished runs for sub-experiments with neither. Runs get new keys only
+    when a mean moves by more than a tenth, and then only the runs of that
+    sub-experiment (all of them if the mean of all runs moved);
+  - round-robin: one run from each sub-experiment in turn.
+
+When several liftoff sessions share an experiment, each of them gets its own
+partition of the runs (by a hash of the run path) and launches the runs of
+its partition first, in the policy's order. Among runs the policy does not
+tell apart, sessions thus pick different runs and only compete for the last
+ones.
+"""
+
+import heapq
+import itertools
+import os
+import random
+import zlib
+
+from .filters import ConfigCache
+
+DRIFT = 0.1  # relative change of an expected duration worth new keys
+
+
+def read_timestamp(path: str) -> int | None:
+    """Reads a timestamp written by `systime_to`."""
+    try:
+        with open(path) as handler:
+            return int(handler.readline().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def subexperiment(rel_path: str) -> str:
+    """The sub-experiment of a run path relative to the experiment."""
+    return rel_path.split(os.sep, 1)[0]
+
+
+def partition(rel_path: str, partitions: int) -> int:
+    """The partition of a run, the same in every session."""
+    return zlib.crc32(rel_path.encode("utf-8")) % partitions
+
+
+class FifoPolicy:
+    """Runs are launched in the order they were added."""
+
+    def __init__(self, experiment_path: str) -> None:
+        self.experiment_path = experiment_path
+
+    def key(self, rel_path: str, seq: int) -> tuple:
+        """Runs with smaller keys are launched first. Keys end with `seq`, the
+        order in which runs were queued.
+        """
+        return (seq,)
+
+    def reset(self) -> None:
+        """Forgets everything observed so far."""
+
+    def rekey(self) -> None:
+        """Called before the keys of all waiting runs are computed again, in
+        the order the runs were queued.
+        """
+
+    def observe(self, rel_path: str) -> bool | set:
+        """Called when a run ended. Returns True if the keys of the runs
+        still waiting changed, or the sub-experiments whose runs got new
+        keys.
+        """
+        return False
+
+    def set_estimates(self, durations: dict) -> bool:
+        """Called with the expected durations of some sub-experiments (e.g.
+        from calibration). Returns True if the keys of the runs changed.
+        """
+        return False
+
+
+class RandomPolicy(FifoPolicy):
+    """Runs are launched in a random order."""
+
+    def key(self, rel_path: str, seq: int) -> tuple:
+        return (random.random(), seq)
+
+
+class PriorityPolicy(FifoPolicy):
+    """Runs with a higher `liftoff.priority` are launched first."""
+
+    def __init__(self, experiment_path: str, configs: ConfigCache = None) -> None:
+        super().__init__(experiment_path)
+        self.configs = ConfigCache() if configs is None else configs
+
+    def key(self, rel_path: str, seq: int) -> tuple:
+        try:
+            cfg = self.configs.get(os.path.join(self.experiment_path, rel_path))
+            priority = float((cfg.get("liftoff") or {}).get("priority", 0))
+        except (OSError, ValueError, TypeError, AttributeError):
+            priority = 0
+        return (-priority, seq)
+
+
+def _drifted(value: float, keyed: float | None) -> bool:
+    return keyed is None or abs(value - keyed) > DRIFT * max(abs(keyed), 1e-9)
+
+
+class ShortestJobPolicy(FifoPolicy):
+    """Runs expected to end sooner are launched first."""
+
+    def __init__(self, experiment_path: str) -> None:
+        super().__init__(experiment_path)
+        self.durations = {}  # sub-experiment -> (total seconds, number of runs)
+        self.estimates = {}  # sub-experiment -> expected seconds
+        self.keyed = {}  # sub-experiment -> mean the keys were made with
+        self.keyed_all = None  # mean of all runs the keys were made with
+
+    def reset(self) -> None:
+        self.durations.clear()
+        self.keyed.clear()
+        self.keyed_all = None
+
+    def set_estimates(self, durations: dict) -> bool:
+        changed = durations != self.estimates
+        self.estimates = dict(durations)
+        return changed
+
+    def observe(self, rel_path: str) -> bool:
+        run_path = os.path.join(self.experiment_path, rel_path)
+        start = read_timestamp(os.path.join(run_path, ".__start"))
+        end = read_timestamp(os.path.join(run_path, ".__end"))
+        if start is None or end is None:
+            return False
+        name = subexperiment(rel_path)
+        total, count = self.durations.get(name, (0, 0))
+        self.durations[name] = (total + end - start, count + 1)
+        totals, counts = zip(*self.durations.values(), strict=True)
+        mean_all = sum(totals) / sum(counts)
+        if _drifted(mean_all, self.keyed_all):
+            self.keyed = {n: t / c for n, (t, c) in self.durations.items()}
+            self.keyed_all = mean_all
+            return True
+        mean = (total + end - start) / (count + 1)
+        if _drifted(mean, self.keyed.get(name)):
+            self.keyed[name] = mean
+            return {name}
+        return set()
+
+    def expected_duration(self, rel_path: str) -> float:
+        """Mean duration of the finished runs of the same sub-experiment."""
+        total, count = self.durations.get(subexperiment(rel_path), (0, 0))
+        if count:
+            return total / count
+        if subexperiment(rel_path) in self.estimates:
+            return self.estimates[subexperiment(rel_path)]
+        if self.durations:
+            totals, counts = zip(*self.durations.values(), strict=True)
+            return sum(totals) / sum(counts)
+        return 0
+
+    def key(self, rel_path: str, seq: int) -> tuple:
+        return (self.expected_duration(rel_path), seq)
+
+
+class RoundRobinPolicy(FifoPolicy):
+    """Takes one run from each sub-experiment in turn."""
+
+    def __init__(self, experiment_path: str) -> None:
+        super().__init__(experiment_path)
+        self.counts = {}
+        self.ranks = {}
+
+    def reset(self) -> None:
+        self.counts.clear()
+        self.ranks.clear()
+
+    def rekey(self) -> None:
+        self.counts.clear()  # turns are handed out again to the waiting runs
+
+    def key(self, rel_path: str, seq: int) -> tuple:
+        name = subexperiment(rel_path)
+        rank = self.ranks.setdefault(name, len(self.ranks))
+        turn = self.counts.get(name, 0)
+        self.counts[name] = turn + 1
+        return (turn, rank, seq)
+
+
+POLICIES = {
+    "fifo": FifoPolicy,
+    "random": RandomPolicy,
+    "priority": PriorityPolicy,
+    "sjf": ShortestJobPolicy,
+    "round-robin": RoundRobinPolicy,
+}
+
+
+def make_policy(name: str, experiment_path: str, configs: ConfigCache = None):
+    """Builds a policy by name."""
+    if name not in POLICIES:
+        raise ValueError(f"Unknown policy {name}. Choose from {', '.join(POLICIES)}.")
+    if name == "priority":
+        return PriorityPolicy(experiment_path, configs=configs)
+    return POLICIES[name](experiment_path)
+
+
+class RunQueue:
+    """Pending runs in a heap ordered by a policy. A run keeps its key until
+    it is no longer pending (see `discard`), so runs put back with `requeue`
+    return to their place. When the policy changes the keys of a few
+    sub-experiments, their runs are pushed again with the new keys and the
+    old entries are skipped when they come up.
+
+    With several partitions, runs in the session's own partition (`rank`)
+    come first among runs with the same policy key, then those of the next
+    partitions in turn.
+    """
+
+    def __init__(self, policy=None) -> None:
+        self.policy = FifoPolicy("") if policy is None else policy
+        self.heap = []
+        self.keys = {}  # runs in the heap, or popped and maybe put back
+        self.queued = set()  # runs in the heap
+        self.groups = {}  # sub-experiment -> its runs in the heap
+        self.counter = itertools.count()
+        self.stale = False
+        self.rank, self.partitions = 0, 1
+
+    def __len__(self) -> int:
+        return len(self.queued)
+
+    def push(self, rel_path: str) -> None:
+        """Adds a run to the queue (once)."""
+        if rel_path in self.queued:
+            return
+        key = self.keys.get(rel_path)
+        if key is None:
+            key = self.keys[rel_path] = self._key(rel_path, next(self.counter))
+        heapq.heappush(self.heap, (key, rel_path))
+        self.queued.add(rel_path)
+        self.groups.setdefault(subexperiment(rel_path), set()).add(rel_path)
+
+    def _key(self, rel_path: str, seq: int) -> tuple:
+        key = self.policy.key(rel_path, seq)
+        if self.partitions == 1:
+            return key
+        turn = (partition(rel_path, self.partitions) - self.rank) % self.partitions
+        return (*key[:-1], turn, key[-1])
+
+    def set_partition(self, rank: int, partitions: int) -> None:
+        """Sets this session's partition, out of `partitions`."""
+        if (rank, partitions) != (self.rank, self.partitions):
+            self.rank, self.partitions = rank, partitions
+            self.stale = True
+
+    def pop(self) -> str | None:
+        """Removes and returns the run with the smallest key."""
+        if self.stale:
+            self.reorder()
+        while self.heap:
+            key, rel_path = heapq.heappop(self.heap)
+            if rel_path in self.queued and self.keys.get(rel_path) == key:
+                self.queued.discard(rel_path)
+                self.groups[subexperiment(rel_path)].discard(rel_path)
+                return rel_path
+        return None
+
+    def requeue(self, rel_paths: list[str]) -> None:
+        """Puts popped runs back."""
+        for rel_path in rel_paths:
+            self.push(rel_path)
+
+    def discard(self, rel_path: str) -> None:
+        """Forgets the key of a popped run that is no longer pending."""
+        if rel_path not in self.queued:
+            self.keys.pop(rel_path, None)
+
+    def observe(self, rel_path: str) -> None:
+        """Tells the policy that a run ended."""
+        changed = self.policy.observe(rel_path)
+        if changed is True:
+            self.stale = True
+        elif changed and not self.stale:
+            for name in changed:
+                self._rekey(self.groups.get(name, ()))
+
+    def _rekey(self, rel_paths) -> None:
+        for rel_path in rel_paths:
+            old = self.keys[rel_path]
+            key = self._key(rel_path, old[-1])
+            if key != old:
+                self.keys[rel_path] = key
+                heapq.heappush(self.heap, (key, rel_path))
+        if len(self.heap) > 2 * len(self.queued) + 64:
+            self.heap = [(self.keys[p], p) for p in self.queued]
+            heapq.heapify(self.heap)
+
+    def set_estimates(self, durations: dict) -> None:
+        """Gives the policy expected durations by sub-experiment."""
+        if self.policy.set_estimates(durations):
+            self.stale = True
+
+    def reorder(self) -> None:
+        """Recomputes the keys of the waiting runs (e.g. after the expected
+        durations changed), in the order they were queued, and rebuilds the
+        heap.
+        """
+        self.stale = False
+        self.policy.rekey()
+        entries = []
+        for rel_path in sorted(self.queued, key=lambda p: self.keys[p][-1]):
+            self.keys[rel_path] = self._key(rel_path, self.keys[rel_path][-1])
+            entries.append((self.keys[rel_path], rel_path))
+        heapq.heapify(entries)
+        self.heap = entries
+
+    def clear(self) -> None:
+        """Forgets all the runs."""
+        self.heap.clear()
+        self.keys.clear()
+        self.queued.clear()
+        self.groups.clear()
+        self.policy.reset()
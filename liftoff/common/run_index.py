@@ -0,0 +1,218 @@
+"""Here we keep an experiment-level index of runs and their states so that
+the launcher does not have to walk the whole experiment tree every time it
+looks for something to run.
+
+The index is an append-only text file (`.__index`) in the experiment folder.
+Each line is `<state> <subexperiment>/<run>` and the last line for a run wins.
+The marker files in the run folders remain the source of truth; the index is
+just a hint which can always be rebuilt from disk with `liftoff-index`.
+"""
+
+import os
+
+from .policies import RunQueue
+
+INDEX_FILE = ".__index"
+
+PENDING = "pending"
+LOCKED = "locked"
+STARTED = "started"
+ENDED = "ended"
+CRASHED = "crashed"
+PRUNED = "pruned"
+TIMEOUT = "timeout"
+
+STATES = [PENDING, LOCKED, STARTED, ENDED, CRASHED, PRUNED, TIMEOUT]
+
+
+def run_state(run_path: str) -> str | None:
+    """Reads the state of a run from its marker files. Returns None if the
+    folder is not a run (no cfg.yaml or no .__leaf).
+    """
+    try:
+        names = set(os.listdir(run_path))
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    if "cfg.yaml" not in names or ".__leaf" not in names:
+        return None
+    if ".__end" in names:
+        return ENDED
+    if ".__pruned" in names:
+        return PRUNED
+    if ".__timeout" in names:
+        return TIMEOUT
+    if ".__crash" in names:
+        return CRASHED
+    if ".__start" in names:
+        return STARTED
+    if ".__lock" in names:
+        return LOCKED
+    return PENDING
+
+
+def iter_run_paths(experiment_path: str):
+    """Yields the paths of all run folders (leaves or not) in an experiment."""
+    with os.scandir(experiment_path) as fit:
+        for entry in fit:
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+            with os.scandir(entry.path) as fit2:
+                for entry2 in fit2:
+                    if entry2.name.startswith(".") or not entry2.is_dir():
+                        continue
+                    yield entry2.path
+
+
+class RunIndex:
+    """An in-memory view of the `.__index` file of an experiment.
+
+    Lines appended by other processes (e.g. `liftoff-prepare --append-to` or
+    another liftoff session) are picked up by `refresh` which only reads the
+    bytes added since the previous call. Pending runs are queued in the order
+    given by `policy` (see `policies`), FIFO by default.
+    """
+
+    def __init__(self, experiment_path: str, policy=None) -> None:
+        self.experiment_path = experiment_path
+        self.path = os.path.join(experiment_path, INDEX_FILE)
+        self.states = {}
+        self.pending = RunQueue(policy)
+        self._offset = 0
+        self._inode = None
+        self._own_size = None
+
+    def exists(self) -> bool:
+        """Checks if the experiment has an index file."""
+        return os.path.isfile(self.path)
+
+    def relpath(self, run_path: str) -> str:
+        """Run path relative to the experiment folder."""
+        return os.path.relpath(run_path, self.experiment_path)
+
+    def abspath(self, rel_path: str) -> str:
+        """Run path from a path relative to the experiment folder."""
+        return os.path.join(self.experiment_path, rel_path)
+
+    def refresh(self) -> int:
+        """Reads the lines appended since the last refresh and returns the
+        number of runs that became pending.
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        if stat.st_ino != self._inode:
+            # The index was rebuilt, so we read it again from the beginning.
+            self.states.clear()
+            self.pending.clear()
+            self._offset, self._inode = 0, stat.st_ino
+        if stat.st_size <= self._offset:
+            return 0
+
+        with open(self.path, "rb") as handler:
+            handler.seek(self._offset)
+            data = handler.read()
+        # A partially written line will be read at the next refresh.
+        data = data[: data.rfind(b"\n") + 1]
+        self._offset += len(data)
+
+        new_pending = 0
+        for line in data.decode("utf-8").splitlines():
+            state, _, rel_path = line.partition(" ")
+            if state not in STATES or not rel_path:
+                continue
+            self._set_state(rel_path, state)
+            if state == PENDING:
+                new_pending += 1
+        return new_pending
+
+    def _set_state(self, rel_path: str, state: str) -> None:
+        previous = self.states.get(rel_path)
+        self.states[rel_path] = state
+        if state == PENDING:
+            self.pending.push(rel_path)
+            return
+        self.pending.discard(rel_path)
+        if state == ENDED and previous != ENDED:
+            self.pending.observe(rel_path)
+
+    def record(self, run_path: str, state: str) -> None:
+        """Appends the new state of a run to the index."""
+        self.record_many([(run_path, state)])
+
+    def record_many(self, updates: list[tuple[str, str]]) -> None:
+        """Appends the states of several runs with a single write."""
+        if not updates:
+            return
+        lines = []
+        for run_path, state in updates:
+            rel_path = self.relpath(run_path)
+            self._set_state(rel_path, state)
+            lines.append(f"{state:s} {rel_path:s}\n")
+        fd = os.open(self.path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, "".join(lines).encode("utf-8"))
+            self._own_size = os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+    def written_by_us(self) -> bool:
+        """Checks if the last bytes of the index are the ones we appended
+        (i.e. nobody else wrote to it since our last `record_many`).
+        """
+        try:
+            return os.path.getsize(self.path) == self._own_size
+        except OSError:
+            return False
+
+    def pop_pending(self) -> str | None:
+        """Returns the path of the next pending run (according to the index)
+        or None if there is none. The run is removed from the in-memory queue.
+        """
+        while (rel_path := self.pending.pop()) is not None:
+            if self.states.get(rel_path) == PENDING:
+                return self.abspath(rel_path)
+            self.pending.discard(rel_path)
+        return None
+
+    def requeue(self, run_paths: list[str]) -> None:
+        """Puts popped runs back in the queue, where they were."""
+        self.pending.requeue([self.relpath(p) for p in run_paths])
+
+    def count(self) -> dict:
+        """Number of runs in each state."""
+        counts = {state: 0 for state in STATES}
+        for state in self.states.values():
+            counts[state] += 1
+        return counts
+
+    def scan(self) -> dict:
+        """Reads the state of every run from disk."""
+        states = {}
+        for run_path in iter_run_paths(self.experiment_path):
+            state = run_state(run_path)
+            if state is not None:
+                states[self.relpath(run_path)] = state
+        return states
+
+    def rebuild(self, states: dict = None) -> None:
+        """Rewrites the index from the marker files on disk (or from the given
+        states). The file is replaced atomically.
+        """
+        if states is None:
+            states = self.scan()
+        tmp_path = f"{self.path:s}.{os.getpid():d}"
+        with open(tmp_path, "w") as handler:
+            for rel_path in sorted(states):
+                handler.write(f"{states[rel_path]:s} {rel_path:s}\n")
+        os.replace(tmp_path, self.path)
+        self.refresh()
+
+
+def record_state(experiment_path: str, run_path: str, state: str) -> None:
+    """Updates the index of an experiment, if it has one. Used by tools that
+    change the marker files of a run behind the launcher's back.
+    """
+    index = RunIndex(experiment_path)
+    if index.exists():
+        index.record(run_path, state)
@@ -0,0 +1,56 @@
+"""Here we read what the local machine has to offer: CPU cores and memory.
+Everything falls back to None (unknown) where /proc is not available.
+"""
+
+import os
+
+
+def cpu_count() -> int:
+    """Number of CPU cores this process may run on."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def meminfo() -> dict:
+    """Reads /proc/meminfo (values in kB). Empty if not available."""
+    info = {}
+    try:
+        with open("/proc/meminfo") as handler:
+            for line in handler:
+                key, _, value = line.partition(":")
+                info[key] = int(value.split()[0])
+    except (OSError, ValueError, IndexError):
+        pass
+    return info
+
+
+def memory_gb() -> float | None:
+    """Total memory of the machine in GB, None if unknown."""
+    total = meminfo().get("MemTotal")
+    return None if total is None else total / (1024 * 1024)
+
+
+def load_average() -> float | None:
+    """The load average over the last minute, None if unknown."""
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return None
+
+
+def pressure(resource: str) -> dict:
+    """Reads /proc/pressure/<resource> (cpu, memory or io): the share of the
+    last 10 s (in %) in which `some` or `full` tasks were stalled on it.
+    Empty if not available (no PSI in the kernel).
+    """
+    info = {}
+    try:
+        with open(f"/proc/pressure/{resource:s}") as handler:
+            for line in handler:
+                kind, *fields = line.split()
+                info[kind] = float(dict(f.split("=") for f in fields)["avg10"])
+    except (OSError, ValueError, KeyError):
+        pass
+    return info
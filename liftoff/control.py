@@ -0,0 +1,132 @@
+"""Here we implement the control channel of running liftoff sessions and
+liftoff-ctl which writes to it.
+
+Commands are lines appended to the `.__control` file of an experiment:
+`<session id or *> <command> [args]`. Each running liftoff reads the lines
+added since it started (it is woken up by the change when it uses --watch)
+and applies those addressed to it:
+
+    procs_no N          at most N runs at a time
+    procs_no auto       let liftoff choose (see `autoscale`)
+    per_gpu N [N ...]   at most N runs on each GPU (or one value per GPU)
+    gpus G [G ...]      the GPUs runs may use
+    pause               stop launching runs (the running ones go on)
+    resume              launch runs again
+    drain               launch no more runs and exit once the running ones end
+"""
+
+import os
+import time
+from argparse import Namespace
+
+from termcolor import colored as clr
+
+from .common.experiment_info import is_experiment
+from .common.options_parser import OptionParser
+
+CONTROL_FILE = ".__control"
+
+# Command -> number of arguments (None for one or more).
+COMMANDS = {
+    "procs_no": 1,
+    "per_gpu": None,
+    "gpus": None,
+    "pause": 0,
+    "resume": 0,
+    "drain": 0,
+}
+
+
+def check_command(words: list[str]) -> None:
+    """Raises ValueError if the command is not a valid one."""
+    if not words or words[0] not in COMMANDS:
+        raise ValueError(f"Unknown command. Use one of: {', '.join(COMMANDS)}")
+    command, args = words[0], words[1:]
+    nargs = COMMANDS[command]
+    if (nargs is None and not args) or (nargs is not None and len(args) != nargs):
+        raise ValueError(f"Wrong number of arguments for {command:s}")
+    if command == "procs_no" and args == ["auto"]:
+        return
+    if command in ("procs_no", "per_gpu") and not all(a.isdigit() for a in args):
+        raise ValueError(f"{command:s} expects non-negative integers")
+
+
+def send_command(experiment_path: str, words: list[str], session: str = "*") -> None:
+    """Appends a command to the control file of an experiment."""
+    check_command(words)
+    line = " ".join([session, *words]) + "\n"
+    path = os.path.join(experiment_path, CONTROL_FILE)
+    fd = os.open(path, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line.encode("utf-8"))
+    finally:
+        os.close(fd)
+
+
+class ControlChannel:
+    """Reads the commands sent to a liftoff session and keeps track of the
+    ones about launching (pause, resume, drain). Commands written before the
+    session started are ignored.
+    """
+
+    def __init__(self, experiment_path: str, session_id: str) -> None:
+        self.path = os.path.join(experiment_path, CONTROL_FILE)
+        self.session_id = session_id
+        self.paused = False
+        self.draining = False
+        try:
+            self._offset = os.path.getsize(self.path)
+        except FileNotFoundError:
+            self._offset = 0
+
+    def read(self) -> list[str]:
+        """Returns the new commands for this session (see
+        `LiftoffResources.process_commands`).
+        """
+        try:
+            if os.path.getsize(self.path) <= self._offset:
+                return []
+            with open(self.path, "rb") as handler:
+                handler.seek(self._offset)
+                data = handler.read()
+        except FileNotFoundError:
+            return []
+        data = data[: data.rfind(b"\n") + 1]
+        self._offset += len(data)
+
+        commands = []
+        for line in data.decode("utf-8").splitlines():
+            target, _, command = line.partition(" ")
+            if target != "*" and not self.session_id.startswith(target):
+                continue
+            try:
+                check_command(command.split())
+            except ValueError as exception:
+                error = clr(f"Ignoring `{command:s}`: {exception}", "red")
+                print(f"[{time.strftime(time.ctime())}] {error:s}")
+                continue
+            if command == "pause":
+                self.paused = True
+            elif command == "resume":
+                self.paused = False
+            elif command == "drain":
+                self.draining = True
+            commands.append(command)
+        return commands
+
+
+def parse_options() -> Namespace:
+    """Parse command line arguments and liftoff configuration."""
+
+    opt_parser = OptionParser("liftoff-ctl", ["config_path", "command", "session"])
+    return opt_parser.parse_args()
+
+
+def ctl():
+    """Main function for liftoff-ctl."""
+    opts = parse_options()
+    if not is_experiment(opts.config_path):
+        raise RuntimeError(f"{opts.config_path:s} is not a liftoff experiment")
+    send_command(opts.config_path, opts.command, session=opts.session or "*")
+    target = "all sessions" if not opts.session else f"session {opts.session:s}"
+    print(f"Sent `{' '.join(opts.command):s}` to {target:s}.")
@@ -0,0 +1,34 @@
+"""Here runs find out how much time they have left.
+
+Liftoff stops a run when its deadline passes: after --run-timeout seconds,
+or when --end-by seconds have passed since liftoff started if --hard-end-by
+is given. The run gets SIGTERM (it and its process group), --kill-grace
+seconds to exit, and then SIGKILL. It is marked with `.__timeout` and its
+slot goes to a pending run.
+
+The deadline is passed to the run in `LIFTOFF_DEADLINE` (seconds since the
+epoch), so a run can save a checkpoint in time:
+
+    from liftoff import time_left
+    if time_left() < 60:
+        save_checkpoint()
+"""
+
+import math
+import os
+import time
+
+DEADLINE_ENV = "LIFTOFF_DEADLINE"
+
+
+def run_deadline() -> float:
+    """When the run will be stopped (time.time()), inf if never."""
+    try:
+        return float(os.environ[DEADLINE_ENV])
+    except (KeyError, ValueError):
+        return math.inf
+
+
+def time_left() -> float:
+    """Seconds left until the run is stopped (inf if it has no deadline)."""
+    return max(run_deadline() - time.time(), 0.0)
@@ -1,9 +1,12 @@
 """TODO: write doc"""
 
+import contextlib
+import math
 import os
 import os.path
-import random
-import subprocess
+import re
+import shlex
+import signal
 import sys
 import time
 import traceback
@@ -11,109 +14,226 @@ from argparse import Namespace
 from collections.abc import Callable
 from functools import partial
 from importlib import import_module
+from importlib.util import find_spec
 from time import perf_counter
 
 import yaml
 from termcolor import colored as clr
 
-from .common.experiment_info import experiment_matches, is_experiment, is_yaml
+from . import metrics
+from .admission import POLL_EVERY, MemoryGuard
+from .asha import Asha
+from .autoscale import ConcurrencyTuner
+from .calibration import Calibration
+from .children import ForkServer, reseed, spawn
+from .common.experiment_info import is_experiment, is_yaml
+from .common.filters import ConfigCache, compile_filters
+from .common.leases import LeaseKeeper, break_lease, lease_content, release
 from .common.liftopt import LO
 from .common.options_parser import OptionParser
+from .common.policies import make_policy
+from .common.run_index import CRASHED, LOCKED, PENDING, STARTED, RunIndex, run_state
+from .common.sysinfo import cpu_count
+from .control import ControlChannel
+from .deadlines import DEADLINE_ENV
+from .placement import format_cpulist, thread_env
 from .prepare import parse_options as prepare_parse_options
 from .prepare import prepare_experiment
+from .resources import LiftoffResources, run_request
+from .retries import RetryPolicy
+from .slots import POLL_EVERY as HOST_POLL_EVERY
+from .slots import HostSlots
+from .startup import READY_FILE, LaunchLimiter
+from .usage import UsageSampler, usage_record, write_usage
+from .watcher import make_watcher
+
+# How many pending runs the scheduler looks at when packing them.
+PACKING_WINDOW = 64
+
+# The `.__<session id>` files of the liftoff sessions running an experiment.
+SESSION_RE = re.compile(r"^\.__([0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12})$")
+
+
+def pending_run_paths(index, run_filter=None, run_paths=None):
+    """Pops pending runs from the experiment index (or goes through the given
+    `run_paths`). The marker files of each candidate are checked (and the
+    index fixed) before yielding it. Runs that do not match `run_filter` (a
+    compiled `--filters`) are skipped.
+    """
+    if run_paths is None:
+        run_paths = iter(index.pop_pending, None)
+    for run_path in run_paths:
+        state = run_state(run_path)
+        if state != PENDING:
+            if state is not None:
+                index.record(run_path, state)
+            continue
+        if run_filter is not None and not run_filter.matches_run(run_path):
+            print(f"Skipping {run_path:s} as it was filtered out.")
+            continue
+        yield run_path
+
+
+def load_index(experiment_path, policy=None):
+    """Reads the run index of an experiment, building it from disk if the
+    experiment was prepared by an older liftoff. Pending runs are ordered by
+    the given policy.
+    """
+    index = RunIndex(experiment_path, policy=policy)
+    if index.exists():
+        index.refresh()
+    else:
+        print(f"[{time.strftime(time.ctime())}] Building the run index.")
+        index.rebuild()
+    return index
 
 
-class LiftoffResources:
-    """Here we have a simple class to handle GPU availability."""
-
-    def __init__(self, opts):
-        self.gpus = opts.gpus
-        self.procs_no = opts.procs_no
-
-        if self.gpus:
-            if len(opts.gpus) == len(opts.per_gpu):
-                self.per_gpu = {g: int(n) for g, n in zip(opts.gpus, opts.per_gpu)}
-            elif len(opts.per_gpu) == 1:
-                self.per_gpu = {g: int(opts.per_gpu[0]) for g in opts.gpus}
-            else:
-                raise ValueError("Strage per_gpu values. {opts.per_gpu}")
-        else:
-            self.per_gpu = None
-
-        if self.gpus:
-            self.gpu_running_procs = {g: 0 for g in self.gpus}
-        self.running_procs = 0
-
-    def process_commands(self, commands: list[str]):
-        """Here we process some commands we got from god knows where that
-        might change the way we want to allocate resources.
-        """
-
-    def free(self, gpu=None):
-        """Here we inform that some process ended, maybe on a specific gpu."""
-        if self.gpus:
-            self.gpu_running_procs[gpu] -= 1
-        self.running_procs -= 1
-
-    def is_free(self) -> tuple:
-        """Here we ask if there are resources available."""
-        if self.running_procs >= self.procs_no:
-            return (False, None)
-        if self.gpus:
-            for gpu in self.gpus:
-                if self.gpu_running_procs[gpu] < self.per_gpu[gpu]:
-                    return (True, gpu)
-            return (False, None)
-        return (True, None)
-
-    def allocate(self, gpu=None) -> None:
-        """Here we allocate resources for some process. Be careful, no checks
-        are being performed here. We just increment counters.
-        """
-        if self.gpus:
-            self.gpu_running_procs[gpu] += 1
-        self.running_procs += 1
-
-    @property
-    def state(self):
-        """Returns the state of the computing resources."""
-        msg = f"Procs: {self.running_procs} / {self.procs_no}"
-        if self.gpus:
-            msg += f" | {len(self.gpus):d} GPUS:"
-            for gpu in self.gpus:
-                msg += f" {gpu}:{self.gpu_running_procs[gpu]}/{self.per_gpu[gpu]};"
-        return msg
-
-
-def some_run_path(experiment_path, filters=None):
-    """So we have that experiment path and we ask for a single subexperiment
-    we might run now.
+def session_partition(experiment_path, session_id):
+    """Returns the partition of the runs this session should start with and
+    the number of partitions: one for each liftoff session working on the
+    experiment (including sessions on other hosts sharing the folder).
     """
-    must_be = ["cfg.yaml", ".__leaf"]
-    must_not_be = [".__lock", ".__crash", ".__end", ".__start"]
+    sessions = {session_id}
     with os.scandir(experiment_path) as fit:
         for entry in fit:
-            if not entry.name.startswith(".") and entry.is_dir():
-                subexp_path = os.path.join(experiment_path, entry.name)
-                with os.scandir(subexp_path) as fit2:
-                    for entry2 in fit2:
-                        if not entry2.name.startswith(".") and entry2.is_dir():
-                            run_path = os.path.join(subexp_path, entry2.name)
-                            done_before = False
-                            mandatory_files = []
-                            with os.scandir(run_path) as fit3:
-                                for entry3 in fit3:
-                                    if entry3.name in must_not_be:
-                                        done_before = True
-                                        break
-                                    if entry3.name in must_be:
-                                        mandatory_files.append(entry3.name)
-                            if done_before or set(mandatory_files) != set(must_be):
-                                continue
-                            if filters and not experiment_matches(run_path, filters):
-                                print(f"Skipping {run_path:s} as it was filtered out.")
-                                continue
-                            yield run_path
+            match = SESSION_RE.match(entry.name)
+            if match:
+                sessions.add(match.group(1))
+    sessions = sorted(sessions)
+    return sessions.index(session_id), len(sessions)
+
+
+def claim_runs(  # pylint: disable=bad-continuation
+    index,
+    resources,
+    session_id,
+    run_filter=None,
+    configs=None,
+    packing="first-fit",
+    limit=None,
+    lease=None,
+    calibration=None,
+):
+    """Looks at the next pending runs in the index and locks those that fit
+    in the free resources (see `LiftoffResources.pack`). Runs that do not fit
+    right now go back to the front of the queue. With a memory guard, runs
+    ask for at least the peak memory learned from their sub-experiment, and
+    with a `calibration`, at least the peak of its calibration run. While
+    calibrating, only one run of each sub-experiment not calibrated yet is
+    considered.
+
+    If other sessions lock all the runs tried, the next runs are looked at.
+    Returns the placed runs as (run path, request, gpus), the number of lock
+    attempts, and the runs left waiting for resources.
+    """
+    nfree = resources.free_procs()
+    if limit is not None:
+        nfree = min(nfree, limit)
+    if nfree <= 0:
+        return [], 0, []
+    configs = ConfigCache() if configs is None else configs
+    use_gpus = bool(resources.gpus)
+
+    run_paths = None
+    if calibration is not None and calibration.active:
+        run_paths = calibration.candidates(index, run_filter=run_filter)
+    window = max(PACKING_WINDOW, nfree)
+    pending = pending_run_paths(index, run_filter, run_paths=run_paths)
+
+    def claim(run_path):
+        return lock_file(os.path.join(run_path, ".__lock"), session_id, lease=lease)
+
+    attempts = 0
+    while True:
+        candidates = []
+        for run_path in pending:
+            try:
+                request = run_request(configs.get(run_path), use_gpus)
+            except (OSError, ValueError, TypeError) as exception:
+                print(f"Skipping {run_path:s}: {exception}")
+                continue
+            if resources.guard is not None:
+                expected_gb = resources.guard.expected_gb(run_path)
+                request["mem_gb"] = max(request["mem_gb"], expected_gb)
+            if calibration is not None:
+                expected_gb = calibration.peak_gb(run_path)
+                request["mem_gb"] = max(request["mem_gb"], expected_gb)
+            candidates.append((run_path, request))
+            if len(candidates) >= window:
+                break
+        placed, tried = resources.pack(candidates, claim, packing=packing, limit=nfree)
+        attempts += len(tried)
+        waiting = [(p, r) for p, r in candidates if p not in tried]
+        index.requeue([run_path for run_path, _ in waiting])
+        if placed or waiting or not candidates:
+            break
+        # Other sessions locked all the runs we tried: look further.
+    index.record_many([(run_path, LOCKED) for run_path, _, _ in placed])
+    return placed, attempts, waiting
+
+
+def keep_leases(keeper, active_pids, index, session_id):
+    """Renews the leases on the locks of our running runs in one pass (if it
+    is time to) and takes over the runs whose lease expired: their holder
+    died, so they go back to the pending ones. Runs that ended before their
+    holder could unlock them just get their state fixed.
+
+    Returns the number of runs that became pending again.
+    """
+    if keeper is None or keeper.timeout() > 0:
+        return 0
+    ours = {child.run_path for child in active_pids}
+    for lock_path in keeper.renew([os.path.join(p, ".__lock") for p in ours]):
+        print(
+            f"[{time.strftime(time.ctime())}] "
+            + clr(f"Lost the lease on {lock_path:s}.", "red")
+        )
+
+    updates = []
+    for rel_path, state in list(index.states.items()):
+        run_path = index.abspath(rel_path)
+        if state not in (LOCKED, STARTED) or run_path in ours:
+            continue
+        if not break_lease(os.path.join(run_path, ".__lock")):
+            continue
+        state = run_state(run_path)
+        if state in (LOCKED, STARTED):
+            for name in (".__start", ".__cpus"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(run_path, name))
+            with open(os.path.join(run_path, ".__journal"), "a") as handler:
+                handler.write(
+                    f"[{time.strftime(time.ctime())}][{session_id}]"
+                    " Took over an expired lease.\n"
+                )
+            state = run_state(run_path)
+        if state is not None:
+            updates.append((run_path, state))
+    index.record_many(updates)
+    reclaimed = sum(1 for _, state in updates if state == PENDING)
+    if reclaimed:
+        print(
+            f"[{time.strftime(time.ctime())}] {reclaimed:d} runs with expired"
+            " leases are pending again."
+        )
+    return reclaimed
+
+
+def retry_runs(retries, index, session_id):
+    """Makes the crashed runs whose retry is due pending again."""
+    updates = []
+    for run_path in retries.pop_due():
+        if run_state(run_path) != CRASHED:
+            continue
+        for name in (".__crash", ".__start", ".__cpus"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(run_path, name))
+        with open(os.path.join(run_path, ".__journal"), "a") as handler:
+            handler.write(
+                f"[{time.strftime(time.ctime())}][{session_id}] Retrying the run.\n"
+            )
+        updates.append((run_path, PENDING))
+    index.record_many(updates)
 
 
 def should_stop(experiment_path):
@@ -128,8 +248,12 @@ def parse_options() -> Namespace:
         "liftoff",
         [
             "script",
-            "config_path",
+            "experiments",
+            "queue",
             "procs_no",
+            "procs_bounds",
+            "autoscale_every",
+            "runs_no",
             "gpus",
             "per_gpu",
             "no_detach",
@@ -138,6 +262,9 @@ def parse_options() -> Namespace:
             "time_limit",  # This should be removed in favour of start_by
             "start_by",
             "end_by",
+            "hard_end_by",
+            "run_timeout",
+            "kill_grace",
             "optimize",
             "args",
             "filters",
@@ -145,33 +272,41 @@ def parse_options() -> Namespace:
             "name",
             "max_runs",
             "shuffle",
+            "policy",
+            "watch",
+            "warm_workers",
+            "cpus",
+            "mem_gb",
+            "packing",
+            "pin_cpus",
+            "mem_guard",
+            "mem_suspend",
+            "calibrate",
+            "host_slots",
+            "host_weight",
+            "launch_rate",
+            "stagger",
+            "ready_timeout",
+            "lease",
+            "asha",
+            "asha_eta",
+            "asha_goal",
+            "max_retries",
+            "retry_on",
+            "retry_backoff",
         ],
     )
     return opt_parser.parse_args()
 
 
-def get_command_for_pid(pid: int) -> str:
-    """Returns the command for a pid if that process exists."""
-    try:
-        result = subprocess.run(
-            f"ps -p {pid:d} -o cmd h", stdout=subprocess.PIPE, shell=True
-        )
-        return result.stdout.decode("utf-8").strip()
-    except subprocess.CalledProcessError as _e:
-        return ""
-
-
-def still_active(pid: int, cmd: str) -> bool:
-    """Checks if a subprocess is still active."""
-    os_cmd = get_command_for_pid(pid)
-    return cmd in os_cmd
-
-
-def lock_file(lock_path: str, session_id: str) -> bool:
-    """Creates a file if it does not exist."""
+def lock_file(lock_path: str, session_id: str, lease: float = None) -> bool:
+    """Creates a file if it does not exist. With a `lease` (in seconds) the
+    lock expires unless it is renewed (see `common.leases`).
+    """
+    content = lease_content(session_id, lease) if lease else session_id
     try:
         lck_fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-        os.write(lck_fd, session_id.encode())
+        os.write(lck_fd, content.encode())
         os.close(lck_fd)
         return True
     except FileExistsError:
@@ -182,131 +317,356 @@ def lock_file(lock_path: str, session_id: str) -> bool:
     return False
 
 
+def finish_run(run_path: str, returncode: int | None) -> None:
+    """Writes the exit code of a run and marks it as ended or crashed, unless
+    the run already did it itself (see `wrapper`) or liftoff stopped it.
+    """
+    with open(os.path.join(run_path, ".__exit"), "a") as handler:
+        handler.write(f"{returncode}\n")
+    markers = (".__end", ".__crash", ".__pruned", ".__timeout")
+    if any(os.path.exists(os.path.join(run_path, m)) for m in markers):
+        return
+    marker = ".__end" if returncode == 0 else ".__crash"
+    systime_to(os.path.join(run_path, marker))
+
+
 def launch_run(  # pylint: disable=bad-continuation
-    run_path, py_script, session_id, gpu=None, do_nohup=True, optim=False, end_by=None
+    run_path,
+    py_script,
+    session_id,
+    gpu=None,
+    do_nohup=True,
+    optim=False,
+    end_by=None,
+    fork_server=None,
+    cores=None,
+    lease=None,
+    deadline=None,
 ):
     """Here we launch a run from an experiment.
     This might be the most important function here.
+
+    The python process is spawned directly (no shell) with its output
+    redirected to `out` and `err`. The markers and the exit code are written
+    by whoever reaps it: liftoff or, for detached runs, the monitor process.
+    With a `fork_server` the run is forked from it instead. If `cores` are
+    given the run is pinned to them, its thread pools are sized to match, and
+    the cores are written to `.__cpus`. The monitor or the fork server keeps
+    renewing the `lease` on the lock while the run lives. The run is stopped
+    at `deadline` (see `deadlines`).
+    Returns None if the process could not be started.
     """
     err_path = os.path.join(run_path, "err")
     out_path = os.path.join(run_path, "out")
-    wrap_err_path = os.path.join(run_path, "nohup.err" if do_nohup else "sh.err")
-    wrap_out_path = os.path.join(run_path, "nohup.out" if do_nohup else "sh.out")
     cfg_path = os.path.join(run_path, "cfg.yaml")
-    start_path = os.path.join(run_path, ".__start")
-    end_path = os.path.join(run_path, ".__end")
-    crash_path = os.path.join(run_path, ".__crash")
-    env_vars = ""
+    env = dict(os.environ)
 
     with open(cfg_path) as handler:
         title = yaml.load(handler, Loader=yaml.SafeLoader)["title"]
 
-    if gpu is not None:
-        env_vars = f"CUDA_VISIBLE_DEVICES={gpu} {env_vars:s}"
+    if isinstance(gpu, list):
+        env["CUDA_VISIBLE_DEVICES"] = ",".join(map(str, gpu))
+    elif gpu is not None:
+        env["CUDA_VISIBLE_DEVICES"] = str(gpu)
 
     if end_by is not None:
-        env_vars += f" ENDBY={end_by}"
-
-    flags = "-u -OO" if optim else "-u"
-
-    py_cmd = f"python {flags} {py_script:s} {cfg_path:s} --session-id {session_id}"
-
-    if do_nohup:
-        cmd = (
-            f" date +%s 1> {start_path:s} 2>/dev/null &&"
-            f" nohup sh -c '{env_vars:s} {py_cmd:s}"
-            f" 2>{err_path:s} 1>{out_path:s}"
-            f" && date +%s > {end_path:s}"
-            f" || date +%s > {crash_path:s}'"
-            f" 1> {wrap_out_path} 2> {wrap_err_path}"
-            f" & echo $!"
-        )
-    else:
-        cmd = (
-            f" date +%s 1> {start_path:s} 2>/dev/null &&"
-            f" sh -c '{env_vars:s} {py_cmd:s}"
-            f" 2>{err_path:s} 1>{out_path:s}"
-            f" && date +%s > {end_path:s}"
-            f" || date +%s > {crash_path:s}'"
-            f" 1>{wrap_out_path} 2>{wrap_err_path}"
-            f" & echo $!"
-        )
-
-    print(f"[{time.strftime(time.ctime())}] Command to be run:\n{cmd:s}")
+        env["ENDBY"] = str(end_by)
+    env["LIFTOFF_OUT_DIR"] = run_path
+    if deadline is not None:
+        env[DEADLINE_ENV] = repr(deadline)
+
+    if cores:
+        env.update(thread_env(cores))
+        with open(os.path.join(run_path, ".__cpus"), "w") as handler:
+            handler.write(f"{format_cpulist(cores):s}\n")
+
+    flags = ["-u", "-OO"] if optim else ["-u"]
+    argv = ["python", *flags, py_script, cfg_path, "--session-id", session_id]
+    py_cmd = shlex.join(argv)
+
+    if fork_server is not None:
+        py_cmd = f"{py_cmd:s} (forked by {fork_server.pid:d})"
+    print(f"[{time.strftime(time.ctime())}] Command to be run:\n{py_cmd:s}")
+
+    heartbeat = None
+    if lease and (fork_server is not None or do_nohup):
+        heartbeat = (os.path.join(run_path, ".__lock"), lease / 3)
+
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(os.path.join(run_path, READY_FILE))  # from an earlier attempt
+    systime_to(os.path.join(run_path, ".__start"))
+    try:
+        if fork_server is not None:
+            child = fork_server.spawn(
+                argv[len(flags) + 1 :],
+                env,
+                cfg_path,
+                out_path,
+                err_path,
+                run_path,
+                cores=cores,
+                heartbeat=heartbeat,
+            )
+        else:
+            child = spawn(
+                argv,
+                env,
+                out_path,
+                err_path,
+                detach=do_nohup,
+                on_exit=partial(finish_run, run_path),
+                cores=cores,
+                heartbeat=heartbeat,
+            )
+    except OSError as exception:
+        error = clr(str(exception), "red")
+        print(f"[{time.strftime(time.ctime())}] Some error: {error:s}.")
+        finish_run(run_path, None)
+        return None
+    child.run_path, child.gpu, child.title, child.cmd = run_path, gpu, title, py_cmd
+    child.deadline = deadline
+    print(f"[{time.strftime(time.ctime())}] New PID is {child.pid:d}.")
     sys.stdout.flush()
+    return child
 
-    proc = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True
-    )
-    (out, err) = proc.communicate()
-    err = err.decode("utf-8").strip()
-    if err:
-        print(f"[{time.strftime(time.ctime())}] Some error: {clr(err, 'red'):s}.")
-    pid = int(out.decode("utf-8").strip())
-    print(f"[{time.strftime(time.ctime())}] New PID is {pid:d}.")
-    sys.stdout.flush()
-    return pid, gpu, title, py_cmd
+
+def stop_run(child, marker: str, reason: str, grace: float) -> None:
+    """Marks a run with `marker` (e.g. `.__pruned`) and sends SIGTERM to it and
+    its process group. If it is still alive after `grace` seconds,
+    `refresh_pids` kills it. Its slot is freed once it is over.
+    """
+    systime_to(os.path.join(child.run_path, marker))
+    print(f"[{time.strftime(time.ctime())}] Stopping {child.title} ({reason:s}).")
+    child.send_signal(signal.SIGTERM)
+    child.kill_at = time.time() + grace
 
 
-def refresh_pids(active_pids, resources):
+def enforce_deadline(child, grace: float) -> None:
+    """Stops a run whose deadline passed and kills it if it outlived its
+    grace period.
+    """
+    now = time.time()
+    if child.kill_at is None:
+        if child.deadline is not None and child.deadline <= now:
+            stop_run(child, ".__timeout", "time is up", grace)
+    elif child.kill_at <= now:
+        print(f"[{time.strftime(time.ctime())}] Killing {child.title} (SIGKILL).")
+        child.send_signal(signal.SIGKILL)
+        child.kill_at = math.inf
+
+
+def refresh_pids(  # pylint: disable=bad-continuation
+    active_pids,
+    resources,
+    index=None,
+    watcher=None,
+    session_id=None,
+    asha=None,
+    retries=None,
+    kill_grace=30,
+    sampler=None,
+    guard=None,
+    calibration=None,
+    tuner=None,
+):
     """This function gets the previous list of running processes, the resources, and
     return the new list of pids. The resources are modified if some processes ended.
+    Locks taken over by other sessions (see `keep_leases`) are left alone. With
+    `asha`, runs whose metrics fall behind are pruned first. With `retries`,
+    retryable crashes are scheduled for another try. Runs past their deadline
+    are stopped, and killed if they take longer than `kill_grace` to exit.
+    The `sampler` keeps track of what the runs use, and each run's usage is
+    written to its `.__usage` when it is over. The `guard` then looks at the
+    memory left and suspends or resumes runs (see `admission`). Calibration
+    runs are recorded in the `calibration`, and the runs that ended are
+    counted by the `tuner`.
     """
+    if sampler is not None:
+        sampler.sample(active_pids)
     still_active_pids = []
     no_change = True
-    for info in active_pids:
-        pid, gpu, title, cmd, lock_path = info
-        if still_active(pid, cmd):
-            still_active_pids.append(info)
-        else:
-            print(f"[{time.strftime(time.ctime())}] {title} seems to be over.")
+    for child in active_pids:
+        stopping = child.kill_at is not None
+        if asha is not None and not stopping and asha.should_prune(child.run_path):
+            stop_run(child, ".__pruned", "pruned by ASHA", kill_grace)
+        if not child.poll():
+            enforce_deadline(child, kill_grace)
+            still_active_pids.append(child)
+            continue
+        print(
+            f"[{time.strftime(time.ctime())}] {child.title} is over"
+            f" ({child.describe()})."
+        )
+        write_usage(child.run_path, usage_record(child))
+        if tuner is not None:
+            tuner.ended(child.run_path)
+        if getattr(child, "calibrating", False) and calibration is not None:
+            calibration.record(child, session_id)
+        lock_path = os.path.join(child.run_path, ".__lock")
+        if session_id is None:
             os.remove(lock_path)
-            resources.free(gpu=gpu)
-            no_change = False
+        else:
+            release(lock_path, session_id)
+        resources.free(child.request, child.gpus, child.cores)
+        state = run_state(child.run_path) or CRASHED
+        if index is not None:
+            index.record(child.run_path, state)
+        if state == CRASHED and retries is not None:
+            reason = retries.consider(child.run_path, child.returncode)
+            if reason is not None:
+                print(
+                    f"[{time.strftime(time.ctime())}] {child.title} will be"
+                    f" retried in {retries.next_due():.0f}s or later ({reason:s})."
+                )
+        if watcher is not None:
+            watcher.unwatch(child.run_path)
+        if asha is not None:
+            asha.forget(child.run_path)
+        no_change = False
+    if guard is not None:
+        guard.refresh(still_active_pids)
+        guard.suspend_or_resume(still_active_pids)
     return still_active_pids, no_change
 
 
-def shuffle(some_generator):
-    """Takes a generator and returns a shuffled generator."""
-    seq = list(some_generator)
-    random.shuffle(seq)
-    for x in seq:
-        yield x
-
-
 def launch_experiment(opts):
     """This is like the most important function in the whole Universe."""
+    configs = ConfigCache()
+    run_filter = compile_filters(opts.filters, cache=configs)
+    fork_server = start_fork_server(opts) if opts.warm_workers else None
+    if fork_server is not None and opts.pin_cpus and find_spec("threadpoolctl") is None:
+        msg = (
+            "Warm workers set the thread counts of torch and numexpr, but those"
+            " of numpy (BLAS, OpenMP) only with threadpoolctl installed."
+        )
+        print(f"[{time.strftime(time.ctime())}] {clr(msg, 'yellow')}")
     resources = LiftoffResources(opts)
+    policy_name = "random" if opts.shuffle else opts.policy
+    if opts.calibrate and policy_name == "fifo":
+        policy_name = "sjf"  # use what the calibration tells us
+    policy = make_policy(policy_name, opts.experiment_path, configs=configs)
+    index = load_index(opts.experiment_path, policy=policy)
+    watcher = make_watcher(opts.watch)
+    watcher.watch_experiment(opts.experiment_path, index=index)
+    control = ControlChannel(opts.experiment_path, opts.session_id)
+    asha = None
+    if opts.asha:
+        asha = Asha(opts.experiment_path, opts.asha, opts.asha_eta, opts.asha_goal)
+    keeper = LeaseKeeper(opts.lease) if opts.lease > 0 else None
+    retries = None
+    if opts.max_retries > 0:
+        retries = RetryPolicy(opts.max_retries, opts.retry_on, opts.retry_backoff)
+    sampler = UsageSampler()
+    calibration = None
+    if opts.calibrate:
+        calibration = Calibration(opts.experiment_path, opts.calibrate)
+        index.pending.set_estimates(calibration.durations())
+    if opts.mem_guard is not None:
+        resources.guard = MemoryGuard(
+            opts.experiment_path, opts.mem_guard, suspend=opts.mem_suspend
+        )
+    if opts.host_slots is not None:
+        resources.host = HostSlots(
+            opts.session_id,
+            path=opts.host_slots or None,
+            weight=opts.host_weight,
+            per_gpu=resources.per_gpu,
+        )
+    limiter = None
+    if opts.launch_rate or opts.stagger:
+        limiter = LaunchLimiter(opts.launch_rate, opts.stagger, opts.ready_timeout)
+    # Idle until the limit is `auto` (from the start or with liftoff-ctl).
+    tuner = ConcurrencyTuner(
+        opts.experiment_path,
+        opts.session_id,
+        bounds=opts.procs_bounds,
+        interval=opts.autoscale_every,
+    )
+
+    def guard_waits():
+        guard = resources.guard
+        return guard is not None and (guard.blocked or guard.nsuspended > 0)
+
+    def host_waits():
+        return resources.host is not None and resources.host.blocked
+
+    def wait_time():
+        # Wake up in time to renew the leases, to retry crashed runs, to
+        # stop runs at their deadlines, to see what the runs use, to adjust
+        # the number of runs (--procs-no auto), to look again when the memory
+        # or the other sessions on the machine hold runs back, and to launch
+        # the runs held back by the launch rate.
+        timeouts = [keeper.interval] if keeper is not None else []
+        if active_pids:
+            timeouts.append(sampler.timeout())
+        if resources.auto_procs:
+            timeouts.append(tuner.timeout())
+        if guard_waits():
+            timeouts.append(POLL_EVERY)
+        if host_waits():
+            timeouts.append(HOST_POLL_EVERY)
+        if limiter is not None and limiter.holding:
+            timeouts.append(limiter.timeout())
+        if retries is not None and retries.next_due() is not None:
+            timeouts.append(retries.next_due())
+        now = time.time()
+        for child in active_pids:
+            due = child.deadline if child.kill_at is None else child.kill_at
+            if due is not None and due < math.inf:
+                timeouts.append(max(due - now, 0.0))
+        return min(timeouts, default=None)
+
+    refresh = partial(
+        refresh_pids,
+        resources=resources,
+        index=index,
+        watcher=watcher,
+        session_id=opts.session_id,
+        asha=asha,
+        retries=retries,
+        kill_grace=opts.kill_grace,
+        sampler=sampler,
+        guard=resources.guard,
+        calibration=calibration,
+        tuner=tuner,
+    )
     active_pids = []
     pid_path = os.path.join(opts.experiment_path, f".__{opts.session_id}")
 
     start = perf_counter()
+    hard_end = (
+        time.time() + opts.end_by if opts.hard_end_by and opts.end_by > 0 else None
+    )
     run_cnt = 0
-    sleep_time = 1
-    launched_something = False
+    lost_races = 0
 
     with open(pid_path, "a") as handler:
         handler.write(f"{os.getpid():d}\n")
     while True:
+        active_pids, _ = refresh(active_pids)
+        resources.process_commands(control.read())
+        tuner.update(resources, active_pids)
         print(f"[{time.strftime(time.ctime())}] Resources:", resources.state)
-        if not launched_something:
-            active_pids, _ = refresh_pids(active_pids, resources)
 
-        available, next_gpu = resources.is_free()
-        print(f"[{time.strftime(time.ctime())}] Free??: {available}, {next_gpu}")
-        while not available:
-            active_pids, do_sleep = refresh_pids(active_pids, resources)
+        nfree = resources.free_procs()
+        print(f"[{time.strftime(time.ctime())}] Free slots: {nfree:d}")
+        while not nfree and not control.draining:
+            keep_leases(keeper, active_pids, index, opts.session_id)
+            active_pids, do_sleep = refresh(active_pids)
             if do_sleep:
-                time.sleep(sleep_time)
-            available, next_gpu = resources.is_free()
+                watcher.wait(timeout=wait_time(), fds=active_pids)
+            resources.process_commands(control.read())
+            tuner.update(resources, active_pids)
+            nfree = resources.free_procs()
 
         # There are several conditions that stop liftoff:
         # 1. someone created the .STOP file in that experiment
+        #    (or sent `drain` with liftoff-ctl)
         # 2. start_by has been exceeded
         # 3. end_by has been exceeded   (if start_by has not beed provided)
         # 4. max-runs has been exceeded
 
-        if should_stop(opts.experiment_path):
+        if should_stop(opts.experiment_path) or control.draining:
             print(f"[{time.strftime(time.ctime())}] Exit once running procs are over.")
             break
 
@@ -330,62 +690,187 @@ def launch_experiment(opts):
             )
             break
 
-        run_paths = some_run_path(opts.experiment_path, filters=opts.filters)
-        if opts.shuffle:
-            run_paths = shuffle(run_paths)
+        if control.paused:
+            print(f"[{time.strftime(time.ctime())}] Paused (liftoff-ctl resume).")
+            while control.paused and not control.draining:
+                keep_leases(keeper, active_pids, index, opts.session_id)
+                active_pids, do_sleep = refresh(active_pids)
+                if do_sleep:
+                    watcher.wait(timeout=wait_time(), fds=active_pids)
+                resources.process_commands(control.read())
+            continue
+
+        limit = opts.max_runs - run_cnt if opts.max_runs > 0 else None
+        if (
+            limiter is not None
+            and (allowed := limiter.allowance(active_pids)) is not None
+        ):
+            limit = allowed if limit is None else min(limit, allowed)
+
+        index.refresh()
+        keep_leases(keeper, active_pids, index, opts.session_id)
+        if retries is not None:
+            retry_runs(retries, index, opts.session_id)
+        rank, partitions = session_partition(opts.experiment_path, opts.session_id)
+        if partitions not in (1, index.pending.partitions):
+            print(
+                f"[{time.strftime(time.ctime())}] {partitions:d} sessions share"
+                f" this experiment, this one starts with partition {rank:d}."
+            )
+        index.pending.set_partition(rank, partitions)
 
         path_start = perf_counter()
-        attempt = 0
-        launched_something = False
-        for run_path in run_paths:
-            attempt += 1
-            lock_path = os.path.join(run_path, ".__lock")
-            if lock_file(lock_path, opts.session_id):
-                path_delta = perf_counter() - path_start
-                print(
-                    f"[{time.strftime(time.ctime())}] Path search took "
-                    f"{path_delta:.3f} s. ({attempt:d} attempts)"
-                )
-                launched_something = True
-                if opts.end_by > 0:
-                    end_by = int(opts.end_by - (perf_counter() - start))
-                else:
-                    end_by = None
-                info = launch_run(
-                    run_path,
-                    opts.script,
-                    opts.session_id,
-                    gpu=next_gpu,
-                    do_nohup=not opts.no_detach,
-                    optim=opts.optimize,
-                    end_by=end_by,
-                )
-                active_pids.append(info + (lock_path,))
-                resources.allocate(gpu=next_gpu)
-                break
-        if not launched_something:
+        placed, attempts, waiting = claim_runs(
+            index,
+            resources,
+            opts.session_id,
+            run_filter=run_filter,
+            configs=configs,
+            packing=opts.packing,
+            limit=limit,
+            lease=opts.lease,
+            calibration=calibration,
+        )
+        if attempts:
+            path_delta = perf_counter() - path_start
+            lost = attempts - len(placed)
+            lost_races += lost
+            print(
+                f"[{time.strftime(time.ctime())}] Path search took "
+                f"{path_delta:.3f} s. ({len(placed):d} runs,"
+                f" {attempts:d} attempts, {lost:d} lost races)"
+            )
+
+        calibrating = calibration is not None and calibration.active
+        if opts.end_by > 0:
+            end_by = int(opts.end_by - (perf_counter() - start))
+        else:
+            end_by = None
+        if calibrating:
+            end_by = int(min(end_by or math.inf, opts.calibrate))
+        started = []
+        for run_path, request, gpus in placed:
+            cores = resources.assign_cores(request)
+            deadlines = [hard_end] if hard_end is not None else []
+            if opts.run_timeout > 0:
+                deadlines.append(time.time() + opts.run_timeout)
+            if calibrating:
+                deadlines.append(time.time() + opts.calibrate)
+            child = launch_run(
+                run_path,
+                opts.script,
+                opts.session_id,
+                gpu=gpus if resources.gpus else None,
+                do_nohup=not opts.no_detach,
+                optim=opts.optimize,
+                end_by=end_by,
+                fork_server=fork_server,
+                cores=cores,
+                lease=opts.lease,
+                deadline=min(deadlines, default=None),
+            )
+            if child is None:
+                os.remove(os.path.join(run_path, ".__lock"))
+                resources.free(request, gpus, cores)
+                started.append((run_path, CRASHED))
+                continue
+            child.request, child.gpus, child.cores = request, gpus, cores
+            child.calibrating = calibrating
+            if limiter is not None:
+                limiter.launched(child)
+            if calibrating:
+                calibration.start(run_path)
+            active_pids.append(child)
+            watcher.watch(run_path)
+            started.append((run_path, STARTED))
+        index.record_many(started)
+
+        # The sweep starts once no calibration run is left to start or going.
+        probing = any(getattr(child, "calibrating", False) for child in active_pids)
+        held = limiter is not None and limiter.holding
+        if (
+            calibrating
+            and not placed
+            and (probing or held or (waiting and active_pids))
+        ):
+            print(f"[{time.strftime(time.ctime())}] Calibrating.")
+            watcher.backoff()
+            watcher.wait(timeout=wait_time(), fds=active_pids)
+            continue
+        if calibrating and not placed and not waiting:
+            calibration.active = False
+            index.pending.set_estimates(calibration.durations())
+            print(
+                f"[{time.strftime(time.ctime())}] Calibration is over"
+                f" ({len(calibration.records):d} sub-experiments)."
+            )
+            continue
+
+        if (
+            not placed
+            and waiting
+            and not active_pids
+            and not guard_waits()
+            and not host_waits()
+        ):
+            too_big = [p for p, r in waiting if not resources.could_ever_fit(r)]
             print(
                 f"[{time.strftime(time.ctime())}] "
-                "All subexperiments are done / running."
+                + clr(f"{len(waiting):d} runs do not fit in this machine", "red")
+                + (f" (e.g. {too_big[0]:s})." if too_big else ".")
             )
-            if not active_pids:
+            break
+        if not placed:
+            if waiting:
+                print(
+                    f"[{time.strftime(time.ctime())}] "
+                    f"Runs are waiting for resources ({resources.state})."
+                )
+            elif not held:
+                print(
+                    f"[{time.strftime(time.ctime())}] "
+                    "All subexperiments are done / running."
+                )
+            if guard_waits():
+                print(
+                    f"[{time.strftime(time.ctime())}] "
+                    f"Waiting for memory ({resources.guard.state:s})."
+                )
+            elif host_waits():
+                print(
+                    f"[{time.strftime(time.ctime())}] "
+                    "Waiting for the other sessions on this machine."
+                )
+            elif held:
+                print(
+                    f"[{time.strftime(time.ctime())}] "
+                    f"Launches are held back ({limiter.state:s})."
+                )
+            elif not active_pids and not (retries is not None and len(retries)):
                 break
-            sleep_time = min(16, sleep_time * 2)
-            time.sleep(sleep_time)
+            watcher.backoff()
+            watcher.wait(timeout=wait_time(), fds=active_pids)
         else:
-            sleep_time = 1
+            watcher.reset()
 
-        run_cnt += launched_something
+        run_cnt += len(placed)
 
     while active_pids:
-        active_pids, do_sleep = refresh_pids(active_pids, resources)
+        keep_leases(keeper, active_pids, index, opts.session_id)
+        active_pids, do_sleep = refresh(active_pids)
         if do_sleep:
-            time.sleep(2)
+            watcher.wait(timeout=wait_time(), fds=active_pids)
+    watcher.close()
+    if fork_server is not None:
+        fork_server.close()
+    if resources.host is not None:
+        resources.host.leave()
 
     duration = perf_counter() - start
     msg = (
         f"[{time.strftime(time.ctime())}] "
-        f"Experiment {opts.experiment_path} ended after {duration:.2f}s."
+        f"Experiment {opts.experiment_path} ended after {duration:.2f}s"
+        f" ({lost_races:d} runs were locked by other sessions first)."
     )
     print(clr(msg, attrs=["bold"]))
     os.remove(pid_path)
@@ -393,32 +878,44 @@ def launch_experiment(opts):
 
 def systime_to(timestamp_file_path: str) -> None:
     """Write current system time to a file."""
-    cmd = f"date +%s 1> {timestamp_file_path:s}"
-    proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, shell=True)
-    (_, err) = proc.communicate()
-    return err.decode("utf-8").strip()
+    with open(timestamp_file_path, "w") as handler:
+        handler.write(f"{int(time.time()):d}\n")
 
 
-def wrapper(function: Callable[[Namespace], None], args: Namespace) -> None:
-    """Wrapper around function to be called that also writes info files."""
+def wrapper(  # pylint: disable=bad-continuation
+    function: Callable[[Namespace], None], args: Namespace, lock: bool = True
+) -> bool:
+    """Wrapper around function to be called that also writes info files.
+    Returns False if the function crashed. Pass `lock=False` if the run was
+    already locked by liftoff.
+    """
     start_path = os.path.join(args.out_dir, ".__start")
     end_path = os.path.join(args.out_dir, ".__end")
     crash_path = os.path.join(args.out_dir, ".__crash")
     lock_path = os.path.join(args.out_dir, ".__lock")
 
-    if lock_file(lock_path, ""):
-        try:
-            systime_to(start_path)
-            function(args)
-            systime_to(end_path)
-        except Exception:  # pylint: disable=broad-except
-            traceback.print_exc(file=sys.stderr)
-            systime_to(crash_path)
-        finally:
+    if lock and not lock_file(lock_path, ""):
+        return False
+    os.environ["LIFTOFF_OUT_DIR"] = args.out_dir
+    try:
+        systime_to(start_path)
+        function(args)
+        systime_to(end_path)
+        return True
+    except Exception:  # pylint: disable=broad-except
+        traceback.print_exc(file=sys.stderr)
+        systime_to(crash_path)
+        return False
+    except KeyboardInterrupt:
+        systime_to(crash_path)
+        raise
+    finally:
+        metrics.close()
+        if lock:
             os.remove(lock_path)
 
 
-def get_function(opts: Namespace) -> Callable[[Namespace], None]:
+def get_function(opts: Namespace, lock: bool = True) -> Callable[[Namespace], bool]:
     """Loads the script and calls run(opts)"""
     sys.path.append(os.getcwd())
     module_name = opts.script
@@ -431,12 +928,82 @@ def get_function(opts: Namespace) -> Callable[[Namespace], None]:
     module = import_module(module_name)
     if function not in module.__dict__:
         raise Exception(f"Module must have function {function}(args).")
-    return partial(wrapper, module.__dict__[function])
+    return partial(wrapper, module.__dict__[function], lock=lock)
+
+
+def start_fork_server(opts: Namespace) -> ForkServer:
+    """Starts the process that imports the script once and forks the runs
+    (--warm-workers).
+    """
+    print(f"[{time.strftime(time.ctime())}] Importing {opts.script:s} once.")
+    fork_server = ForkServer(
+        partial(get_function, opts, lock=False),
+        on_exit=finish_run,
+        detach=not opts.no_detach,
+    )
+    print(f"[{time.strftime(time.ctime())}] Fork server {fork_server.pid:d} ready.")
+    return fork_server
+
+
+def run_leaves(function, run_paths, procs_no=1):
+    """Runs the given leaves with the already loaded function. With a single
+    process they run one after the other in this process, otherwise each of
+    them runs in a forked child, at most `procs_no` at a time.
+
+    On Ctrl-C no other run is started; the running ones are marked as crashed
+    by `wrapper` and we wait for them to exit.
+    """
+    if procs_no <= 1 or len(run_paths) == 1:
+        for run_path in run_paths:
+            args = LO.from_yaml(os.path.join(run_path, "cfg.yaml"))
+            print(clr("\nStarting\n", attrs=["bold"]))
+            function(args)
+        return
+
+    pending, running = list(run_paths), {}
+    try:
+        while pending or running:
+            while pending and len(running) < procs_no:
+                run_path = pending.pop(0)
+                args = LO.from_yaml(os.path.join(run_path, "cfg.yaml"))
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    exit_code = 1
+                    try:
+                        reseed()
+                        exit_code = 0 if function(args) else 1
+                    finally:
+                        sys.stdout.flush()
+                        sys.stderr.flush()
+                        os._exit(exit_code)
+                running[pid] = run_path
+                print(f"[{time.strftime(time.ctime())}] Started {run_path} ({pid:d}).")
+            pid, status = os.wait()
+            run_path = running.pop(pid, None)
+            if run_path is not None:
+                returncode = os.waitstatus_to_exitcode(status)
+                print(
+                    f"[{time.strftime(time.ctime())}] {run_path} is over"
+                    f" (exit code {returncode:d})."
+                )
+    except KeyboardInterrupt:
+        print(f"[{time.strftime(time.ctime())}] Waiting for {len(running):d} runs.")
+        while running:
+            try:
+                pid, _ = os.wait()
+            except ChildProcessError:
+                break
+            except KeyboardInterrupt:
+                continue
+            running.pop(pid, None)
+        raise
 
 
 def run_here(opts):
-    """If there's a single run in the experiment we run it in this process by
-    calling run in the script.
+    """If there's a single config file we run its leaves in this process by
+    calling run in the script (or in `--procs-no` forked children).
     """
     prep_args = [opts.config_path, "--do"]
     if opts.copy_to_clipboard:
@@ -445,6 +1012,8 @@ def run_here(opts):
     # prepare_opts.args = opts.args
     prepare_opts.__dict__.update(vars(opts))
 
+    function = get_function(opts)
+
     # Fast_check if cfg file is already prepared
     with open(opts.config_path) as handler:
         dummy_config = yaml.load(handler, Loader=yaml.SafeLoader)
@@ -453,17 +1022,13 @@ def run_here(opts):
 
         run_path = dummy_config["out_dir"]
         leaf_path = os.path.join(run_path, ".__leaf")
-        cfg_path = os.path.join(run_path, "cfg.yaml")
         if os.path.isfile(leaf_path):
-            with open(cfg_path) as handler:
-                cfg = yaml.load(handler, Loader=yaml.SafeLoader)
-            args = LO.from_dict(cfg)
-            print(clr("\nStarting\n", attrs=["bold"]))
-            get_function(opts)(args)
+            run_leaves(function, [run_path])
     else:
         # Virgin cfg
         opts.experiment_path = prepare_experiment(prepare_opts)
 
+        run_paths = []
         with os.scandir(opts.experiment_path) as fit:
             for entry in fit:
                 if entry.name.startswith(".") or not entry.is_dir():
@@ -474,13 +1039,10 @@ def run_here(opts):
                             continue
                         run_path = entry2.path
                         leaf_path = os.path.join(run_path, ".__leaf")
-                        cfg_path = os.path.join(run_path, "cfg.yaml")
                         if os.path.isfile(leaf_path):
-                            with open(cfg_path) as handler:
-                                cfg = yaml.load(handler, Loader=yaml.SafeLoader)
-                            args = LO.from_dict(cfg)
-                            print(clr("\nStarting\n", attrs=["bold"]))
-                            get_function(opts)(args)
+                            run_paths.append(run_path)
+        procs_no = cpu_count() if opts.procs_no == "auto" else opts.procs_no
+        run_leaves(function, sorted(run_paths), procs_no=procs_no)
 
 
 def check_opts_integrity(opts):
@@ -489,12 +1051,29 @@ def check_opts_integrity(opts):
         raise ValueError("--args works for single experiment only; see liftoff-prepare")
     if opts.no_detach and opts.procs_no != 1:
         raise ValueError("No detach mode only for single processes")
+    if opts.warm_workers and opts.optimize:
+        raise ValueError("--optimize does not work with --warm-workers")
+    if opts.procs_bounds and not 1 <= opts.procs_bounds[0] <= opts.procs_bounds[1]:
+        raise ValueError("--procs-bounds needs 1 <= MIN <= MAX")
+    if opts.calibrate is not None and opts.calibrate <= 0:
+        raise ValueError("--calibrate needs a positive number of seconds")
+    if opts.host_weight <= 0:
+        raise ValueError("--host-weight must be positive")
+    if opts.launch_rate and not (opts.launch_rate[0] >= 1 and opts.launch_rate[1] > 0):
+        raise ValueError("--launch-rate needs N >= 1 and SECONDS > 0")
 
 
 def launch() -> None:
     """Main function."""
     opts = parse_options()
-    if is_experiment(opts.config_path):
+    if opts.experiments or opts.queue:
+        from .supervisor import supervise  # here, as it imports this module
+
+        check_opts_integrity(opts)
+        supervise(opts)
+    elif opts.config_path is None:
+        raise ValueError("Give an experiment, a config file, or --queue.")
+    elif is_experiment(opts.config_path):
         opts.experiment_path = opts.config_path
         check_opts_integrity(opts)
         launch_experiment(opts)
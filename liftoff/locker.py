@@ -9,8 +9,10 @@ from datetime import datetime
 
 from termcolor import colored as clr
 
-from .common.experiment_info import experiment_matches, is_experiment
+from .common.experiment_info import is_experiment
+from .common.filters import compile_filters
 from .common.options_parser import OptionParser
+from .common.run_index import LOCKED, PENDING, record_state
 from .liftoff import lock_file
 
 
@@ -44,6 +46,7 @@ def unlock_run(run_path, info, prefix, opts):
 
     if opts.do:
         os.remove(os.path.join(run_path, ".__seal"))
+        record_state(opts.experiment_path, run_path, PENDING)
 
     lines.append(f"{prefix:s} Unlocked and unsealed {run_path}.\n")
 
@@ -72,6 +75,7 @@ def lock_run(run_path, info, prefix, opts):
             with open(os.path.join(run_path, ".__seal"), "w") as hndlr:
                 hndlr.write(f"{opts.session_id}\n")
             lines.append(f"{prefix:s} Locked and sealed {run_path}.\n")
+            record_state(opts.experiment_path, run_path, LOCKED)
         else:
             info["nlocks"] -= 1
             info["nraced"] += 1
@@ -87,12 +91,13 @@ def lock_run(run_path, info, prefix, opts):
 def change_experiment_lock_status(opts, unlock=False):
     """Lock or Unlock experiments given the RUNS and FILTERS provided in opts.
     FILTERS allows for selecting experiments based on their configuration.
-    For example experiments containing the configuration `a.b=c` can be targeted.
+    For example experiments containing the configuration `a.b=c` can be targeted
+    (see `common.filters` for the syntax).
     """
     info = defaultdict(int)
 
     experiment_path = opts.experiment_path
-    filters = opts.filters
+    run_filter = compile_filters(opts.filters)
 
     timestamp = f"{datetime.now():{opts.timestamp_fmt:s}}"
     prefix = f"[{timestamp:s}][{opts.session_id}]"
@@ -105,22 +110,21 @@ def change_experiment_lock_status(opts, unlock=False):
                     if entry2.name.startswith(".") or not entry2.is_dir():
                         continue
                     try:
-                        # if `filters` is not provided lock/unlock experiments
-                        # based on the mandatory `runs` argument. Else, check if
-                        # experiment matches any of the filters provided.
-                        target_experiment = True
-                        if filters is not None:
-                            run_path = f"{experiment_path}/{entry.name}/{entry2.name}"
-                            target_experiment = experiment_matches(run_path, filters)
-
                         run_id = int(entry2.name)
-                        if target_experiment and run_id in opts.runs:
-                            if unlock:
-                                unlock_run(entry2.path, info, prefix, opts)
-                            else:
-                                lock_run(entry2.path, info, prefix, opts)
                     except ValueError:
-                        pass
+                        continue
+                    if run_id not in opts.runs:
+                        continue
+                    # If `filters` are given, only the runs whose config
+                    # matches all of them are locked/unlocked.
+                    if run_filter is not None and not run_filter.matches_run(
+                        entry2.path
+                    ):
+                        continue
+                    if unlock:
+                        unlock_run(entry2.path, info, prefix, opts)
+                    else:
+                        lock_run(entry2.path, info, prefix, opts)
     if unlock:
         print(f"{info['nlocks']:d} .__lock files deleted")
         print(f"{info['nstrange']:d} strange folders")
@@ -0,0 +1,152 @@
+"""Here we implement a cheap way for runs to report scalars as they go:
+
+    from liftoff import report
+    report(step, loss=loss, accuracy=acc)
+
+Records are buffered in memory and appended in batches to `metrics.bin` in
+the run folder. Each record has a fixed width (`RECORD`): the step (int64),
+the id of the scalar (uint32), and its value (float64), so the file can be
+memory-mapped as a numpy array of `DTYPE`. The names of the scalars are in
+`metrics.keys`, one per line, the line number being the id.
+
+The run folder is taken from `LIFTOFF_OUT_DIR`, set by liftoff (and by
+`parse_opts`). Buffered records are written every second, when the buffer
+is full, and when the run ends. The first report also tells liftoff that
+the run is past its startup (see `startup`).
+"""
+
+import atexit
+import os
+import struct
+import time
+
+from .startup import ready
+
+METRICS_FILE = "metrics.bin"
+KEYS_FILE = "metrics.keys"
+
+RECORD = struct.Struct("<qId")
+DTYPE = [("step", "<i8"), ("key", "<u4"), ("value", "<f8")]
+
+
+def read_keys(run_path: str) -> list[str]:
+    """The names of the scalars reported by a run, by id."""
+    try:
+        with open(os.path.join(run_path, KEYS_FILE)) as handler:
+            return handler.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+class MetricsWriter:
+    """Buffers the records of a run and appends them to its metrics file."""
+
+    def __init__(  # pylint: disable=bad-continuation
+        self, out_dir: str, capacity: int = 4096, flush_every: float = 1.0
+    ) -> None:
+        self.path = os.path.join(out_dir, METRICS_FILE)
+        self.keys_path = os.path.join(out_dir, KEYS_FILE)
+        self.keys = {name: key for key, name in enumerate(read_keys(out_dir))}
+        self.new_keys = []
+        self.capacity = capacity
+        self.flush_every = flush_every
+        self.buffer = bytearray(RECORD.size * capacity)
+        self.nrecords = 0
+        self.last_flush = time.monotonic()
+        self.handler = open(self.path, "ab", buffering=0)  # noqa: SIM115
+
+    def report(self, step: int, scalars: dict) -> None:
+        """Buffers one record for each scalar."""
+        for name, value in scalars.items():
+            key = self.keys.get(name)
+            if key is None:
+                key = self.keys[name] = len(self.keys)
+                self.new_keys.append(name)
+            if self.nrecords == self.capacity:
+                self.flush()
+            RECORD.pack_into(self.buffer, self.nrecords * RECORD.size, step, key, value)
+            self.nrecords += 1
+        if time.monotonic() - self.last_flush > self.flush_every:
+            self.flush()
+
+    def flush(self) -> None:
+        """Writes the buffered records (names of new scalars first)."""
+        if self.new_keys:
+            with open(self.keys_path, "a") as handler:
+                handler.write("".join(f"{name:s}\n" for name in self.new_keys))
+            self.new_keys = []
+        if self.nrecords:
+            self.handler.write(memoryview(self.buffer)[: self.nrecords * RECORD.size])
+            self.nrecords = 0
+        self.last_flush = time.monotonic()
+
+    def close(self) -> None:
+        """Flushes and closes the file."""
+        self.flush()
+        self.handler.close()
+
+
+_WRITER = None
+
+
+def report(step: int, **scalars: float) -> None:
+    """Records the values of some scalars at a step. Cheap enough to be
+    called at every step.
+    """
+    global _WRITER  # pylint: disable=global-statement
+    if _WRITER is None:
+        out_dir = os.environ.get("LIFTOFF_OUT_DIR")
+        if out_dir is None:
+            raise RuntimeError("LIFTOFF_OUT_DIR is not set. Use parse_opts().")
+        _WRITER = MetricsWriter(out_dir)
+        atexit.register(close)
+        ready()
+    _WRITER.report(step, scalars)
+
+
+def close() -> None:
+    """Writes what is left in the buffer. Called when the run ends."""
+    global _WRITER  # pylint: disable=global-statement
+    if _WRITER is not None:
+        _WRITER.close()
+        _WRITER = None
+
+
+def read_metrics(run_path: str, last: int = None) -> dict:
+    """Reads the metrics of a run (only the `last` records if given) as a
+    dict from scalar names to (steps, values) numpy arrays.
+    """
+    import numpy as np  # pylint: disable=import-outside-toplevel
+
+    keys = read_keys(run_path)
+    try:
+        size = os.path.getsize(os.path.join(run_path, METRICS_FILE))
+    except FileNotFoundError:
+        return {}
+    nrecords = size // RECORD.size  # the last record might be incomplete
+    if not nrecords or not keys:
+        return {}
+    records = np.memmap(
+        os.path.join(run_path, METRICS_FILE),
+        dtype=np.dtype(DTYPE),
+        mode="r",
+        shape=(nrecords,),
+    )
+    if last is not None:
+        records = records[-last:]
+    metrics = {}
+    for key, name in enumerate(keys):
+        selected = records[records["key"] == key]
+        if selected.size:
+            metrics[name] = (np.array(selected["step"]), np.array(selected["value"]))
+    return metrics
+
+
+def latest_metrics(run_path: str, last: int = 65536) -> dict:
+    """The most recent (step, value) of each scalar, looking only at the
+    `last` records.
+    """
+    return {
+        name: (int(steps[-1]), float(values[-1]))
+        for name, (steps, values) in read_metrics(run_path, last=last).items()
+    }
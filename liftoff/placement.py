@@ -0,0 +1,149 @@
+"""Here we split the CPU cores of the machine into disjoint sets, one for
+each running run, so concurrent runs do not fight over the same cores.
+
+Runs get as many cores as they ask for (`cpus` in the `liftoff` block of
+their config) or an equal share of the cores otherwise. With NUMA alignment
+a run gets its cores from a single node whenever one has enough free cores
+(the fullest such node, to keep the others free for larger runs).
+"""
+
+import contextlib
+import glob
+import math
+import os
+import re
+import sys
+
+from .common.sysinfo import cpu_count
+
+# Thread pools of the usual numerical libraries.
+THREAD_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+]
+
+
+def parse_cpulist(text: str) -> list[int]:
+    """Parses a kernel cpulist such as `0-3,8-11`."""
+    cores = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        cores.extend(range(int(first), int(last or first) + 1))
+    return cores
+
+
+def format_cpulist(cores: list[int]) -> str:
+    """The inverse of parse_cpulist."""
+    parts, cores = [], sorted(cores)
+    start = prev = None
+    for core in [*cores, None]:
+        if core is not None and prev is not None and core == prev + 1:
+            prev = core
+            continue
+        if start is not None:
+            parts.append(f"{start:d}" if start == prev else f"{start:d}-{prev:d}")
+        start = prev = core
+    return ",".join(parts)
+
+
+def available_cores() -> list[int]:
+    """The cores liftoff itself may run on."""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(cpu_count()))
+
+
+def numa_nodes(cores: list[int]) -> list[list[int]]:
+    """Groups the given cores by NUMA node (from /sys/devices/system/node).
+    Returns a single group if the topology is unknown.
+    """
+    nodes = []
+    allowed = set(cores)
+    paths = glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")
+    for path in sorted(paths, key=lambda p: int(re.findall(r"node(\d+)", p)[-1])):
+        try:
+            with open(path) as handler:
+                node = [c for c in parse_cpulist(handler.read()) if c in allowed]
+        except (OSError, ValueError):
+            continue
+        if node:
+            nodes.append(node)
+    seen = {c for node in nodes for c in node}
+    if not nodes or seen != allowed:
+        return [sorted(allowed)]
+    return nodes
+
+
+class CorePlacer:
+    """Hands out disjoint sets of cores."""
+
+    def __init__(self, procs_no: int, numa: bool = False) -> None:
+        cores = available_cores()
+        self.nodes = numa_nodes(cores) if numa else [cores]
+        self.free = {core for node in self.nodes for core in node}
+        self.resize(procs_no)
+
+    def resize(self, procs_no: int) -> None:
+        """Sets the number of runs the cores are shared by."""
+        ncores = sum(len(node) for node in self.nodes)
+        self.share = max(1, ncores // max(procs_no, 1))
+
+    def cores_for(self, request: dict) -> int:
+        """How many cores a run gets."""
+        if request and request.get("cpus"):
+            return max(1, math.ceil(request["cpus"]))
+        return self.share
+
+    def assign(self, request: dict) -> list[int] | None:
+        """Takes cores for a run. Returns None if there are not enough free
+        cores (the run is then not pinned).
+        """
+        ncores = self.cores_for(request)
+        if ncores > len(self.free):
+            return None
+        free_by_node = [[c for c in node if c in self.free] for node in self.nodes]
+        fitting = [node for node in free_by_node if len(node) >= ncores]
+        if fitting:
+            cores = min(fitting, key=len)[:ncores]
+        else:
+            cores = []
+            for node in sorted(free_by_node, key=len, reverse=True):
+                cores.extend(node[: ncores - len(cores)])
+        self.free.difference_update(cores)
+        return cores
+
+    def release(self, cores: list[int] | None) -> None:
+        """Gives back the cores of a run that ended."""
+        if cores:
+            self.free.update(cores)
+
+
+def thread_env(cores: list[int]) -> dict:
+    """Environment variables that size the thread pools to the cores."""
+    return {name: str(len(cores)) for name in THREAD_VARS}
+
+
+def limit_threads(count: int) -> list[str]:
+    """Resizes the thread pools of the libraries this process already
+    imported, for which the environment variables come too late (e.g. in a
+    warm worker). BLAS and OpenMP pools need `threadpoolctl`. Returns the
+    libraries left as they were.
+    """
+    missed = []
+    for name in ("torch", "numexpr"):
+        if name in sys.modules:
+            sys.modules[name].set_num_threads(count)
+    if "numpy" in sys.modules:
+        try:
+            from threadpoolctl import threadpool_limits
+        except ImportError:
+            missed.append("numpy (install threadpoolctl)")
+        else:
+            with contextlib.suppress(Exception):
+                threadpool_limits(limits=count)
+    return missed
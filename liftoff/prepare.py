@@ -35,6 +35,7 @@ from termcolor import colored as clr
 
 from .common.dict_utils import clean_dict, deep_update_dict, hashstr, uniqstr
 from .common.options_parser import OptionParser
+from .common.run_index import RunIndex, run_state
 
 VALID_CHARS = f"-_.(){string.ascii_letters:s}{string.digits:s}"
 KNOWN_CONSTRAINTS = ["->", "<=>", "v", "!!"]
@@ -147,9 +148,15 @@ def check(values, constraints):
 def generate_combinations(cfg, _opts):
     """This is actually the function we wrote the whole script for."""
 
+    # The `liftoff` entry holds either the list of constraints, or a dict with
+    # the constraints and the resources each run asks for (kept in cfg.yaml).
+    requests = {}
     if "liftoff" in cfg:
         constraints = cfg["liftoff"]
         del cfg["liftoff"]
+        if isinstance(constraints, dict):
+            requests = dict(constraints)
+            constraints = requests.pop("constraints", [])
         if not isinstance(constraints, list):
             raise ValueError(f"Expected list of constraints, got {constraints}")
     else:
@@ -269,6 +276,8 @@ def generate_combinations(cfg, _opts):
                     dct = dct.setdefault(parent, {})
                 dct[var[-1]] = value
 
+            if requests:
+                cfg["liftoff"] = deepcopy(requests)
             yield (cfg, "; ".join(title))
 
 
@@ -380,6 +389,7 @@ def prepare_experiment(opts):
 
     start_idx = 0
     existing = dict({})
+    index_updates = []
 
     if opts.do and not opts.append_to:
         os.makedirs(experiment_path)
@@ -489,6 +499,7 @@ def prepare_experiment(opts):
                     yaml.safe_dump(run_cfg, yaml_file, default_flow_style=False)
 
                 open(leaf_path, "a").close()
+                index_updates.append((run_path, run_state(run_path)))
 
     print(clr("\nSummary:", attrs=["bold"]))
     print(
@@ -525,6 +536,13 @@ def prepare_experiment(opts):
 
         return None
 
+    index = RunIndex(experiment_path)
+    if index.exists() or not opts.append_to:
+        index.record_many(index_updates)
+    else:
+        # Experiments prepared by older versions have no index.
+        index.rebuild()
+
     print("\nExperiment configured in", clr(experiment_path, attrs=["bold"]))
     if opts.copy_to_clipboard:
         pyperclip.copy(experiment_path)
@@ -22,9 +22,12 @@ def parse_options() -> Namespace:
 def get_running_liftoffs(experiment: str, results_path: str):
     """Get the running liftoff processes."""
 
+    # The session files hold one pid per line. Other `.__*` files (e.g. the
+    # run index, with lines like `pending 0001_x_12/0`) contain numbers too,
+    # so the pid must be the whole line.
     cmd = (
         "COLUMNS=0 pgrep liftoff"
-        " | xargs -r -n 1 grep "
+        " | xargs -r -n 1 grep --line-regexp "
         f"--files-with-matches {results_path:s}/*/.__* -e"
     )
     result = subprocess.run(
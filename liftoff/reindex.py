@@ -0,0 +1,68 @@
+"""Here we implement liftoff-index which compares the run index of an
+experiment with the marker files on disk and rebuilds it.
+"""
+
+from argparse import Namespace
+from collections import defaultdict
+
+from termcolor import colored as clr
+
+from .common.experiment_info import is_experiment
+from .common.options_parser import OptionParser
+from .common.run_index import STATES, RunIndex
+
+
+def parse_options(strict: bool = True) -> Namespace:
+    """Parse command line arguments and liftoff configuration."""
+
+    opt_parser = OptionParser("liftoff-index", ["config_path", "do", "verbose"])
+
+    return opt_parser.parse_args(strict=strict)
+
+
+def reindex_experiment(opts):
+    """Shows where the index and the disk disagree and rewrites the index."""
+    index = RunIndex(opts.experiment_path)
+    if index.exists():
+        index.refresh()
+    else:
+        print(f"{opts.experiment_path:s} has no index yet.")
+
+    on_disk = index.scan()
+    mismatches = defaultdict(int)
+    for rel_path, state in on_disk.items():
+        indexed = index.states.get(rel_path, "missing")
+        if indexed != state:
+            mismatches[(indexed, state)] += 1
+            if opts.verbose and opts.verbose > 0:
+                print(f"{rel_path:s}: {indexed:s} in index, {state:s} on disk")
+    for rel_path in index.states.keys() - on_disk.keys():
+        mismatches[(index.states[rel_path], "missing")] += 1
+
+    counts = {state: 0 for state in STATES}
+    for state in on_disk.values():
+        counts[state] += 1
+    print("On disk:", " | ".join(f"{s}: {n:d}" for s, n in counts.items()))
+    for (indexed, state), count in sorted(mismatches.items()):
+        print(f"{count:d} runs are {indexed:s} in the index, but {state:s} on disk")
+    if not mismatches:
+        print("The index agrees with the disk.")
+
+    if opts.do:
+        index.rebuild(on_disk)
+        print("Index rebuilt:", clr(index.path, attrs=["bold"]))
+    else:
+        print(
+            "\nThis was just a simultation. Rerun with",
+            clr("--do", attrs=["bold"]),
+            "to rebuild the index for real.",
+        )
+
+
+def reindex():
+    """Main function for liftoff-index."""
+    opts = parse_options()
+    if not is_experiment(opts.config_path):
+        raise RuntimeError(f"{opts.config_path:s} is not a liftoff experiment")
+    opts.experiment_path = opts.config_path
+    reindex_experiment(opts)
@@ -0,0 +1,281 @@
+"""Here we keep track of what the runs launched by liftoff use: process
+slots, CPU cores, memory, and GPU slots.
+
+A run may declare what it needs in a `liftoff` block of its config:
+
+    liftoff:
+      cpus: 4
+      mem_gb: 12
+      gpus: 1
+
+Missing entries ask for nothing, except `gpus` which defaults to one GPU
+slot when liftoff was given --gpus (and to none otherwise). A run asking
+for k GPUs gets k distinct GPUs, one slot on each. The same block may hold
+the run's `priority` (see `common.policies`).
+
+With --host-slots, the sessions of a machine also share its CPU and GPU
+slots (see `slots`).
+"""
+
+import contextlib
+import time
+
+from termcolor import colored as clr
+
+from .common.sysinfo import cpu_count, memory_gb
+from .placement import CorePlacer
+
+REQUESTS = ("cpus", "mem_gb", "gpus")
+BLOCK_KEYS = (*REQUESTS, "priority")
+
+
+def run_request(cfg: dict, use_gpus: bool) -> dict:
+    """Reads what a run asks for from its config."""
+    block = cfg.get("liftoff") if isinstance(cfg, dict) else None
+    if not isinstance(block, dict):
+        block = {}
+    unknown = set(block) - set(BLOCK_KEYS)
+    if unknown:
+        raise ValueError(f"Unknown resources requested: {', '.join(sorted(unknown))}")
+    return {
+        "cpus": float(block.get("cpus", 0)),
+        "mem_gb": float(block.get("mem_gb", 0)),
+        "gpus": int(block.get("gpus", 1 if use_gpus else 0)),
+    }
+
+
+class LiftoffResources:
+    """Here we have a simple class to handle the capacity of the machine
+    along several dimensions: processes, CPU cores, memory, and GPU slots.
+    """
+
+    def __init__(self, opts):
+        # With `--procs-no auto` the limit is moved by `autoscale`.
+        self.auto_procs = opts.procs_no == "auto"
+        self.can_autoscale = True  # False if nobody would move the limit
+        if self.auto_procs:
+            self.procs_no = (getattr(opts, "procs_bounds", None) or [1])[0]
+        else:
+            self.procs_no = opts.procs_no
+        self.cpus = getattr(opts, "cpus", None) or cpu_count()
+        self.mem_gb = getattr(opts, "mem_gb", None) or memory_gb()
+        self.gpu_running_procs = {}
+        self.host = None  # a slots.HostSlots with --host-slots
+        self.set_gpus(opts.gpus, opts.per_gpu)
+        self.running_procs = 0
+        self.used_cpus = 0.0
+        self.used_mem_gb = 0.0
+
+        self.guard = None  # an admission.MemoryGuard with --mem-guard
+
+        pin_cpus = getattr(opts, "pin_cpus", None)
+        if pin_cpus:
+            self.placer = CorePlacer(self.procs_no, numa=pin_cpus == "numa")
+        else:
+            self.placer = None
+
+    def set_gpus(self, gpus: list, per_gpu: list) -> None:
+        """Sets the GPUs runs may use and how many runs each of them takes.
+        Runs already on GPUs that were removed keep them until they end.
+        """
+        if gpus:
+            if len(gpus) == len(per_gpu):
+                per_gpu = {g: int(n) for g, n in zip(gpus, per_gpu, strict=True)}
+            elif len(per_gpu) == 1:
+                per_gpu = {g: int(per_gpu[0]) for g in gpus}
+            else:
+                raise ValueError(f"Strage per_gpu values. {per_gpu}")
+        else:
+            per_gpu = None
+        self.gpus, self.per_gpu = list(gpus), per_gpu
+        running = self.gpu_running_procs
+        self.gpu_running_procs = {g: n for g, n in running.items() if n > 0}
+        for gpu in self.gpus:
+            self.gpu_running_procs.setdefault(gpu, 0)
+        if self.host is not None:
+            self.host.per_gpu = {str(g): n for g, n in (per_gpu or {}).items()}
+
+    def set_procs_no(self, procs_no: int) -> None:
+        """Sets the number of runs at a time. Running runs go on."""
+        self.procs_no = procs_no
+        if self.placer is not None:
+            self.placer.resize(procs_no)
+
+    def process_commands(self, commands: list[str]):
+        """Here we process some commands we got from god knows where that
+        might change the way we want to allocate resources (see `control`).
+        Commands that are not about resources are ignored.
+        """
+        for command in commands:
+            name, *args = command.split()
+            try:
+                if name == "procs_no" and args[0] == "auto":
+                    if not self.can_autoscale:
+                        raise ValueError("this session cannot choose it by itself")
+                    self.auto_procs = True
+                elif name == "procs_no":
+                    self.set_procs_no(int(args[0]))
+                    self.auto_procs = False
+                elif name == "per_gpu":
+                    self.set_gpus(self.gpus, args)
+                elif name == "gpus":
+                    per_gpu = self.per_gpu or {}
+                    default = max(per_gpu.values(), default=1)
+                    self.set_gpus(args, [per_gpu.get(g, default) for g in args])
+                else:
+                    continue
+            except ValueError as exception:
+                error = clr(f"Cannot apply `{command:s}`: {exception}", "red")
+                print(f"[{time.strftime(time.ctime())}] {error:s}")
+                continue
+            print(f"[{time.strftime(time.ctime())}] Applied `{command:s}`.")
+
+    def is_free(self) -> tuple:
+        """Here we ask if there are resources available."""
+        if self.running_procs >= self.procs_no:
+            return (False, None)
+        if self.gpus:
+            for gpu in self.gpus:
+                if self.gpu_running_procs[gpu] < self.per_gpu[gpu]:
+                    return (True, gpu)
+            return (False, None)
+        return (True, None)
+
+    def free_procs(self) -> int:
+        """Number of runs that could still be started if they asked for
+        nothing but a process slot.
+        """
+        return max(self.procs_no - self.running_procs, 0)
+
+    def place(self, request: dict) -> list | None:
+        """Returns the GPUs a run would get (an empty list if it asks for
+        none) if it fits right now, or None if it does not. GPUs are picked
+        from the least loaded ones.
+        """
+        if self.running_procs >= self.procs_no:
+            return None
+        if self.cpus and self.used_cpus + request["cpus"] > self.cpus:
+            return None
+        if self.mem_gb and self.used_mem_gb + request["mem_gb"] > self.mem_gb:
+            return None
+        if self.guard is not None and not self.guard.admits(request):
+            return None
+        gpus = []
+        if request["gpus"] > 0:
+            if not self.gpus:
+                return None
+            free = [g for g in self.gpus if self.gpu_running_procs[g] < self.per_gpu[g]]
+            if len(free) < request["gpus"]:
+                return None
+            if self.host is not None:
+                free = [g for g in free if self.host.gpu_free.get(str(g), 0) > 0]
+                if len(free) < request["gpus"]:
+                    self.host.refuse(request)
+                    return None
+            free.sort(key=lambda g: self.gpu_running_procs[g] - self.per_gpu[g])
+            gpus = free[: request["gpus"]]
+        if self.host is not None and not self.host.fits(request, gpus):
+            return None
+        return gpus
+
+    def could_ever_fit(self, request: dict) -> bool:
+        """Checks a request against the whole machine."""
+        if self.cpus and request["cpus"] > self.cpus:
+            return False
+        if self.mem_gb and request["mem_gb"] > self.mem_gb:
+            return False
+        return request["gpus"] <= (len(self.gpus) if self.gpus else 0)
+
+    def share(self, request: dict) -> float:
+        """The dominant share of the machine a run asks for."""
+        shares = [1 / self.procs_no]
+        if self.cpus:
+            shares.append(request["cpus"] / self.cpus)
+        if self.mem_gb:
+            shares.append(request["mem_gb"] / self.mem_gb)
+        if self.gpus and request["gpus"]:
+            shares.append(request["gpus"] / len(self.gpus))
+        return max(shares)
+
+    def pack(self, candidates, claim, packing="first-fit", limit=None):
+        """Chooses which of the candidates (run path, request) to start now.
+        With first-fit the candidates are taken in order, skipping those that
+        do not fit. With best-fit the largest ones (by dominant share) are
+        placed first and the smaller ones fill the gaps. `claim(run_path)` is
+        called for each chosen run and may refuse it (e.g. it lost the lock).
+
+        Returns the placed runs as (run_path, request, gpus) and the paths
+        of all the runs that were claimed or refused.
+        """
+        if packing == "best-fit":
+            candidates = sorted(candidates, key=lambda c: -self.share(c[1]))
+        placed, tried = [], set()
+        host_round = contextlib.nullcontext()
+        if self.host is not None:
+            host_round = self.host.round([request for _, request in candidates])
+        with host_round:
+            for run_path, request in candidates:
+                if limit is not None and len(placed) >= limit:
+                    break
+                gpus = self.place(request)
+                if gpus is None:
+                    continue
+                tried.add(run_path)
+                if claim(run_path):
+                    self.allocate(request, gpus)
+                    placed.append((run_path, request, gpus))
+        return placed, tried
+
+    def allocate(self, request: dict, gpus: list) -> None:
+        """Here we allocate resources for some process. Be careful, no checks
+        are being performed here. We just increment counters.
+        """
+        for gpu in gpus:
+            self.gpu_running_procs[gpu] += 1
+        self.running_procs += 1
+        self.used_cpus += request["cpus"]
+        self.used_mem_gb += request["mem_gb"]
+        if self.guard is not None:
+            self.guard.reserve(request)
+        if self.host is not None:
+            self.host.take(request, gpus)
+
+    def assign_cores(self, request: dict) -> list[int] | None:
+        """The cores a run should be pinned to, None if we don't pin runs or
+        there are no free cores left.
+        """
+        if self.placer is None:
+            return None
+        return self.placer.assign(request)
+
+    def free(self, request: dict, gpus: list, cores: list = None) -> None:
+        """Here we inform that some process ended."""
+        if self.placer is not None:
+            self.placer.release(cores)
+        for gpu in gpus:
+            self.gpu_running_procs[gpu] -= 1
+        self.running_procs -= 1
+        self.used_cpus -= request["cpus"]
+        self.used_mem_gb -= request["mem_gb"]
+        if self.host is not None:
+            self.host.give_back(request, gpus)
+
+    @property
+    def state(self):
+        """Returns the state of the computing resources."""
+        msg = f"Procs: {self.running_procs} / {self.procs_no}"
+        if self.cpus:
+            msg += f" | CPUs: {self.used_cpus:g} / {self.cpus:g}"
+        if self.placer is not None:
+            msg += f" | Free cores: {len(self.placer.free):d}"
+        if self.mem_gb:
+            msg += f" | Memory: {self.used_mem_gb:.1f} / {self.mem_gb:.1f} GB"
+        if self.gpus:
+            msg += f" | {len(self.gpus):d} GPUS:"
+            for gpu in self.gpus:
+                msg += f" {gpu}:{self.gpu_running_procs[gpu]}/{self.per_gpu[gpu]};"
+        if self.guard is not None:
+            msg += f" | {self.guard.state:s}"
+        if self.host is not None:
+            msg += f" | {self.host.state:s}"
+        return msg
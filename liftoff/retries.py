@@ -0,0 +1,124 @@
+"""Here we decide which crashed runs deserve another try (--max-retries).
+
+A crash is retryable if it matches one of the rules given with --retry-on:
+
+    signal          the run was killed by a signal (e.g. the OOM killer) or
+                    liftoff never learnt how it ended
+    signal:KILL     the run was killed by that signal (name or number)
+    exit:N          the run exited with code N
+    err:REGEX       the regex matches the last lines of `err`
+
+Retries wait `backoff * 2 ** k` seconds (k = retries so far). The number of
+retries of a run is kept in its `.__retries` file; the exit codes of all its
+attempts are in `.__exit`.
+"""
+
+import heapq
+import os
+import re
+import signal
+import time
+
+RETRIES_FILE = ".__retries"
+ERR_TAIL = 4096
+MAX_DELAY = 3600
+
+
+def read_retries(run_path: str) -> int:
+    """How many times a run was retried."""
+    try:
+        with open(os.path.join(run_path, RETRIES_FILE)) as handler:
+            return int(handler.readline().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def err_tail(run_path: str, size: int = ERR_TAIL) -> str:
+    """The end of a run's `err` file."""
+    try:
+        with open(os.path.join(run_path, "err"), "rb") as handler:
+            handler.seek(max(os.path.getsize(handler.name) - size, 0))
+            return handler.read().decode("utf-8", errors="replace")
+    except OSError:
+        return ""
+
+
+def parse_signal(name: str) -> int:
+    """A signal number from `9`, `KILL` or `SIGKILL`."""
+    if name.isdigit():
+        return int(name)
+    name = name.upper()
+    return int(getattr(signal, name if name.startswith("SIG") else f"SIG{name}"))
+
+
+class RetryPolicy:
+    """Classifies crashes and keeps the runs waiting for their retry."""
+
+    def __init__(  # pylint: disable=bad-continuation
+        self, max_retries: int, rules: list[str], backoff: float = 30
+    ) -> None:
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.signals, self.exit_codes, self.patterns = set(), set(), []
+        self.any_signal = False
+        for rule in rules:
+            kind, _, value = rule.partition(":")
+            if kind == "signal" and not value:
+                self.any_signal = True
+            elif kind == "signal":
+                self.signals.add(parse_signal(value))
+            elif kind == "exit":
+                self.exit_codes.add(int(value))
+            elif kind == "err":
+                self.patterns.append(re.compile(value, re.MULTILINE))
+            else:
+                raise ValueError(f"Unknown retry rule: {rule}")
+        self.delayed = []  # heap of (due time, run path)
+
+    def reason(self, run_path: str, returncode: int | None) -> str | None:
+        """Why the crash is retryable, or None if it is not."""
+        if returncode is None or returncode < 0:
+            if self.any_signal:
+                return "killed" if returncode is None else f"signal {-returncode:d}"
+            if returncode is not None and -returncode in self.signals:
+                return f"signal {-returncode:d}"
+        elif returncode in self.exit_codes:
+            return f"exit code {returncode:d}"
+        if self.patterns:
+            tail = err_tail(run_path)
+            for pattern in self.patterns:
+                if pattern.search(tail):
+                    return f"err matches {pattern.pattern}"
+        return None
+
+    def consider(self, run_path: str, returncode: int | None) -> str | None:
+        """Schedules a retry for a crashed run if it has retries left and the
+        crash is retryable. Returns the reason, or None.
+        """
+        retries = read_retries(run_path)
+        if retries >= self.max_retries:
+            return None
+        reason = self.reason(run_path, returncode)
+        if reason is None:
+            return None
+        with open(os.path.join(run_path, RETRIES_FILE), "w") as handler:
+            handler.write(f"{retries + 1:d}\n")
+        delay = min(self.backoff * 2**retries, MAX_DELAY)
+        heapq.heappush(self.delayed, (time.time() + delay, run_path))
+        return reason
+
+    def pop_due(self) -> list[str]:
+        """The runs whose retry is due."""
+        due, now = [], time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            due.append(heapq.heappop(self.delayed)[1])
+        return due
+
+    def next_due(self) -> float | None:
+        """Seconds until the next retry is due, None if there is none."""
+        if not self.delayed:
+            return None
+        return max(0.0, self.delayed[0][0] - time.time())
+
+    def __len__(self) -> int:
+        return len(self.delayed)
@@ -12,7 +12,9 @@ from termcolor import colored as clr
 
 from .common import LIFTOFF_FILES
 from .common.experiment_info import is_experiment
+from .common.leases import lease_alive
 from .common.options_parser import OptionParser
+from .common.run_index import record_state, run_state
 
 
 def parse_options(strict: bool = True) -> Namespace:
@@ -66,6 +68,7 @@ def clean_run(run_path, info, prefix, opts):
     """Here we clean a run file."""
     lock_path = os.path.join(run_path, ".__lock")
     crash_path = os.path.join(run_path, ".__crash")
+    timeout_path = os.path.join(run_path, ".__timeout")
     start_path = os.path.join(run_path, ".__start")
     end_path = os.path.join(run_path, ".__end")
     seal_path = os.path.join(run_path, ".__seal")
@@ -83,6 +86,10 @@ def clean_run(run_path, info, prefix, opts):
         info["nsealed"] += 1
         return
 
+    if lease_alive(lock_path):
+        info["live leases"] += 1
+        return
+
     if os.path.exists(lock_path):
         info["nlocks"] += 1
         if opts.do:
@@ -93,6 +100,11 @@ def clean_run(run_path, info, prefix, opts):
         if opts.do:
             os.remove(crash_path)
         lines.append(f"{prefix:s} Deleted {crash_path}\n")
+    if os.path.exists(timeout_path):
+        info["ntimeout"] += 1
+        if opts.do:
+            os.remove(timeout_path)
+        lines.append(f"{prefix:s} Deleted {timeout_path}\n")
     if os.path.exists(start_path) and not os.path.exists(end_path):
         info["nstarted"] += 1
         if opts.do:
@@ -107,6 +119,8 @@ def clean_run(run_path, info, prefix, opts):
     if opts.do:
         with open(os.path.join(run_path, ".__journal"), "a") as j_hndlr:
             j_hndlr.writelines(lines)
+        if lines and (state := run_state(run_path)) is not None:
+            record_state(opts.experiment_path, run_path, state)
 
 
 def clean_experiment(opts):
@@ -129,8 +143,10 @@ def clean_experiment(opts):
 
     print(f"{info['safe skipped']:d} runs were skipped (SAFE).")
     print(f"{info['nsealed']:d} runs are sealed.")
+    print(f"{info['live leases']:d} runs are held by live sessions.")
     print(f"{info['nlocks']:d} .__lock files removed")
     print(f"{info['ncrashed']:d} .__crashed files removed")
+    print(f"{info['ntimeout']:d} .__timeout files removed")
     print(
         f"{info['nstarted']:d} .__start files removed "
         f"(not corresponding .__end or .__crash)"
@@ -138,7 +154,7 @@ def clean_experiment(opts):
     if opts.clean_all:
         print("\nFiles produced by the experiment run: ")
         for key, val in info.items():
-            if key not in ["nlocks", "ncrashed", "nstarted"]:
+            if key not in ["nlocks", "ncrashed", "ntimeout", "nstarted", "live leases"]:
                 print(f"{val:d} {key} files removed.")
 
     if not opts.do:
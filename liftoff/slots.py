@@ -0,0 +1,227 @@
+"""Here we share the machine between all the liftoff sessions running on it
+(--host-slots), so two sessions started with --procs-no 16 on a 16-core box
+do not end up running 32 runs.
+
+The sessions keep what they hold in one small JSON file (by default
+`/dev/shm/liftoff-slots.json`), locked with `fcntl.flock` while it is read
+and written:
+
+    {"sessions": {"<session id>": {"pid": 4242, "weight": 1.0, "cpus": 8,
+     "gpus": {"0": 2}, "per_gpu": {"0": 2}, "wants": 3, "served":
+     1760000000.0, ...}}}
+
+The machine has one CPU slot per core, and each GPU as many slots as the
+sessions using it allow (`--per-gpu`, the largest if they disagree). A run
+takes as many CPU slots as the CPUs it asks for (`liftoff: cpus`), at least
+one, and one slot on each of its GPUs. These limits come on top of each
+session's own (--procs-no, --cpus, --gpus).
+
+CPU slots are shared by weighted max-min fair share (--host-weight): a
+session may take a free slot unless another session that waits for slots
+holds fewer of them for its weight (or as few, but got one less recently).
+Nothing is preempted: a session above its share gets back to it as its
+runs end.
+
+A session that died (its liftoff process is gone) loses its slots the next
+time any session looks at the file, even if some of its detached runs are
+still going.
+"""
+
+import contextlib
+import fcntl
+import json
+import math
+import os
+import tempfile
+import time
+
+from termcolor import colored as clr
+
+from .common.sysinfo import cpu_count
+
+SHM = "/dev/shm"
+SLOTS_FILE = "liftoff-slots.json"
+POLL_EVERY = 1  # seconds between two looks at the file while refused
+
+
+def default_path() -> str:
+    """Where the sessions of this machine keep their slots."""
+    directory = SHM if os.path.isdir(SHM) else tempfile.gettempdir()
+    return os.path.join(directory, SLOTS_FILE)
+
+
+def _process_start(pid: int) -> str | None:
+    """When a process started (in clock ticks since boot), to tell it apart
+    from a later process with the same pid. None if it is gone or unknown.
+    """
+    try:
+        with open(f"/proc/{pid:d}/stat", "rb") as handler:
+            stat = handler.read()
+    except OSError:
+        return None
+    return stat[stat.rfind(b")") + 2 :].split()[19].decode()
+
+
+def _is_alive(session: dict) -> bool:
+    try:
+        os.kill(session["pid"], 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # someone else's session
+    started = _process_start(session["pid"])
+    return started is None or session.get("pstart") in (None, started)
+
+
+def slots_of(request: dict) -> float:
+    """CPU slots a run takes."""
+    return max(request["cpus"], 1.0)
+
+
+class HostSlots:
+    """One session's view of the slots shared by the liftoff sessions of a
+    machine.
+    """
+
+    def __init__(  # pylint: disable=bad-continuation
+        self,
+        session_id: str,
+        path: str = None,
+        weight: float = 1.0,
+        per_gpu: dict = None,
+    ) -> None:
+        self.session_id = session_id
+        self.path = path or default_path()
+        self.weight = weight
+        self.per_gpu = {str(g): int(n) for g, n in (per_gpu or {}).items()}
+        self.capacity = float(cpu_count())  # the cores we may run on
+        self.cpus = 0.0  # CPU slots our runs hold
+        self.gpus = {}  # GPU -> slots our runs hold
+        self.wants = 0.0  # CPU slots our pending runs would take
+        self.short = 0.0  # CPU slots of the runs refused in this round
+        self.served = None  # when we last took a slot
+        self.allowed = None  # CPU slots we may still take in this round
+        self.rivals = []  # (slots per weight, served) of waiting others
+        self.gpu_free = {}  # GPU -> slots free on the machine in this round
+        self.blocked = False  # the machine refused us a run in the last round
+        self.summary = ""
+
+    @contextlib.contextmanager
+    def _locked(self, stay: bool = True):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        with os.fdopen(fd, "r+") as handler:
+            fcntl.flock(handler, fcntl.LOCK_EX)
+            with contextlib.suppress(PermissionError):
+                os.fchmod(fd, 0o666)  # every user's sessions share it
+            try:
+                state = json.loads(handler.read() or "{}")
+            except ValueError:
+                state = {}
+            sessions = state.setdefault("sessions", {})
+            for name, session in list(sessions.items()):
+                if name != self.session_id and not _is_alive(session):
+                    del sessions[name]
+                    msg = f"Reclaimed the slots of dead session {name:s}."
+                    print(f"[{time.strftime(time.ctime())}] {clr(msg, 'yellow')}")
+            yield sessions
+            if stay:
+                sessions[self.session_id] = self._entry()
+            else:
+                sessions.pop(self.session_id, None)
+            used = sum(session["cpus"] for session in sessions.values())
+            self.summary = (
+                f"{used:g} / {self.capacity:g} CPU slots, {len(sessions):d} sessions"
+            )
+            handler.seek(0)
+            handler.truncate()
+            handler.write(json.dumps(state))
+
+    def _entry(self) -> dict:
+        return {
+            "pid": os.getpid(),
+            "pstart": _process_start(os.getpid()),
+            "weight": self.weight,
+            "cpus": self.cpus,
+            "gpus": self.gpus,
+            "per_gpu": self.per_gpu,
+            "wants": self.wants,
+            "served": self.served,
+        }
+
+    @contextlib.contextmanager
+    def round(self, requests: list[dict]):
+        """Holds the machine while we pick runs that fit (see `fits` and
+        `take`) among candidates asking for `requests`, then writes down what
+        we hold and what we could not get.
+        """
+        self.wants = sum(slots_of(request) for request in requests)
+        with self._locked() as sessions:
+            sessions[self.session_id] = self._entry()
+            others = {k: s for k, s in sessions.items() if k != self.session_id}
+            used = self.cpus + sum(s["cpus"] for s in others.values())
+            self.allowed = self.capacity - used
+            self.rivals = [
+                (s["cpus"] / s["weight"], s["served"] or -math.inf)
+                for s in others.values()
+                if s["wants"] > 0
+            ]
+            self.gpu_free = {}
+            for session in sessions.values():
+                for gpu, slots in session["per_gpu"].items():
+                    capacity = max(self.gpu_free.get(gpu, 0), slots)
+                    self.gpu_free[gpu] = capacity
+            for session in sessions.values():
+                for gpu, held in session["gpus"].items():
+                    self.gpu_free[gpu] = self.gpu_free.get(gpu, 0) - held
+            self.blocked, self.short = False, 0.0
+            try:
+                yield self
+            finally:
+                self.allowed = None
+                self.wants = self.short
+
+    def fits(self, request: dict, gpus: list) -> bool:
+        """Checks if the machine has room for a run during a `round`."""
+        fits = self.allowed is None or slots_of(request) <= self.allowed + 1e-9
+        ours = (self.cpus / self.weight, self.served or -math.inf)
+        if any(rival < ours for rival in self.rivals):
+            fits = False  # their turn
+        fits = fits and all(self.gpu_free.get(str(g), 0) > 0 for g in gpus)
+        if not fits:
+            self.refuse(request)
+        return fits
+
+    def refuse(self, request: dict) -> None:
+        """Notes that the machine had no room for a run during a `round`."""
+        self.blocked = True
+        self.short += slots_of(request)
+
+    def take(self, request: dict, gpus: list) -> None:
+        """Takes the slots of a run placed during a `round`."""
+        self.cpus += slots_of(request)
+        self.served = time.time()
+        if self.allowed is not None:
+            self.allowed -= slots_of(request)
+        for gpu in map(str, gpus):
+            self.gpus[gpu] = self.gpus.get(gpu, 0) + 1
+            self.gpu_free[gpu] = self.gpu_free.get(gpu, 0) - 1
+
+    def give_back(self, request: dict, gpus: list) -> None:
+        """Gives back the slots of a run that ended."""
+        self.cpus = max(self.cpus - slots_of(request), 0.0)
+        for gpu in map(str, gpus):
+            self.gpus[gpu] = self.gpus.get(gpu, 0) - 1
+            if self.gpus[gpu] <= 0:
+                del self.gpus[gpu]
+        with self._locked():
+            pass
+
+    def leave(self) -> None:
+        """Removes this session from the file."""
+        with contextlib.suppress(OSError), self._locked(stay=False):
+            pass
+
+    @property
+    def state(self) -> str:
+        """What the machine has left, for the logs."""
+        return f"Host: {self.summary:s}" if self.summary else "Host: unknown"
@@ -0,0 +1,141 @@
+"""Here we spread the launches out in time, so that runs that all load the
+same data do not all hit the disk (or the network file system) at once.
+
+- --launch-rate N SECONDS starts at most N runs every SECONDS (a token bucket:
+  up to N at once, then one every SECONDS / N);
+- --stagger starts a run only once the previous one is past its startup.
+
+A run is past its startup when it calls `liftoff.ready()` (e.g. once its
+data is loaded) or reports its first step with `liftoff.report`, whichever
+comes first:
+
+    from liftoff import ready
+    data = load_dataset()
+    ready()
+
+This creates the `.__ready` file in the run folder, with the time. A run
+that is not ready after --ready-timeout seconds (or that ended) no longer
+holds the others back.
+
+For each run, the time it took to get ready (`ready_s`) and how long the
+limiter held it back (`held_s`) go to its `.__usage` record, so
+liftoff-status --usage shows what staggering did to the startup times.
+"""
+
+import math
+import os
+import time
+
+READY_FILE = ".__ready"
+READY_POLL = 1  # seconds between two looks for `.__ready` if not notified
+
+
+def ready() -> None:
+    """Tells liftoff the run is done starting up (only the first call counts)."""
+    out_dir = os.environ.get("LIFTOFF_OUT_DIR")
+    if out_dir is None:
+        raise RuntimeError("LIFTOFF_OUT_DIR is not set. Use parse_opts().")
+    try:
+        fd = os.open(
+            os.path.join(out_dir, READY_FILE), os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        )
+    except FileExistsError:
+        return
+    with os.fdopen(fd, "w") as handler:
+        handler.write(f"{time.time():.3f}\n")
+
+
+def ready_time(run_path: str) -> float | None:
+    """When a run got ready (time.time()), None if it did not yet."""
+    try:
+        with open(os.path.join(run_path, READY_FILE)) as handler:
+            return float(handler.read())
+    except (OSError, ValueError):
+        return None
+
+
+class LaunchLimiter:
+    """Decides how many runs may be launched now."""
+
+    def __init__(  # pylint: disable=bad-continuation
+        self,
+        rate: tuple[float, float] = None,
+        stagger: bool = False,
+        ready_timeout: float = 600,
+    ) -> None:
+        self.capacity, seconds = rate or (math.inf, 1.0)
+        self.fill_rate = self.capacity / seconds  # tokens per second
+        self.tokens = self.capacity
+        self.stagger = stagger
+        self.ready_timeout = ready_timeout
+        self.starting = None  # the last run launched, while it starts up
+        self.held_since = None  # when we started holding runs back, if we do
+        self.held_s = 0.0  # how long we held back the runs launched next
+        self.last = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.last) * self.fill_rate
+        )
+        self.last = now
+
+    def _still_starting(self, children: list) -> bool:
+        child = self.starting
+        if child is None:
+            return False
+        if (
+            child not in children
+            or ready_time(child.run_path) is not None
+            or time.time() - child.started > self.ready_timeout
+        ):
+            self.starting = None
+            return False
+        return True
+
+    def allowance(self, children: list) -> int | None:
+        """How many runs may be launched now (None for any number), given the
+        running `children`.
+        """
+        self._refill()
+        allowed = None if math.isinf(self.tokens) else int(self.tokens)
+        if self.stagger and self._still_starting(children):
+            allowed = 0
+        elif self.stagger:
+            allowed = 1 if allowed is None else min(allowed, 1)
+        if allowed == 0:
+            if self.held_since is None:
+                self.held_since = time.monotonic()
+        else:
+            self.held_s = 0.0
+            if self.held_since is not None:
+                self.held_s = time.monotonic() - self.held_since
+            self.held_since = None
+        return allowed
+
+    @property
+    def holding(self) -> bool:
+        """Checks if runs were held back the last time we were asked."""
+        return self.held_since is not None
+
+    def launched(self, child) -> None:
+        """Takes a token for a run that was just launched."""
+        self.tokens -= 1
+        if self.stagger:
+            self.starting = child
+        child.held_s = round(self.held_s, 3)
+
+    def timeout(self) -> float:
+        """Seconds until we may launch again (if we are holding runs back)."""
+        if self.starting is not None:
+            return READY_POLL
+        if self.tokens >= 1:
+            return 0.0
+        return max(0.0, (1 - self.tokens) / self.fill_rate)
+
+    @property
+    def state(self) -> str:
+        """What holds the launches back, for the logs."""
+        if self.starting is not None:
+            return f"{self.starting.title} is starting up"
+        return f"next launch in {self.timeout():.1f} s"
@@ -11,21 +11,37 @@ from tabulate import tabulate
 from termcolor import colored as clr
 
 from .common.experiment_info import get_experiment_paths
+from .common.filters import compile_filters
 from .common.options_parser import OptionParser
+from .common.run_index import iter_run_paths
+from .metrics import latest_metrics
+from .usage import read_usage, summarize
 
 
 def parse_options() -> Namespace:
     """Parse command line arguments and liftoff configuration."""
 
     opt_parser = OptionParser(
-        "liftoff-status", ["experiment", "all", "timestamp_fmt", "results_path"]
+        "liftoff-status",
+        [
+            "experiment",
+            "all",
+            "filters",
+            "metrics",
+            "usage",
+            "timestamp_fmt",
+            "results_path",
+        ],
     )
     return opt_parser.parse_args()
 
 
-def experiment_status(experiment_path):
-    """Gets full info about about an experiment."""
+def experiment_status(experiment_path, run_filter=None):
+    """Gets full info about about an experiment. If `run_filter` is given,
+    only the runs matching it are counted.
+    """
     ntotal, nstarted, nended, ncrashed, nlocked, nlost = 0, 0, 0, 0, 0, 0
+    npruned, ntimeout = 0, 0
     durations = []
     live_durations = []
 
@@ -43,6 +59,10 @@ def experiment_status(experiment_path):
                     leaf_path = os.path.join(entry2.path, ".__leaf")
                     if not os.path.isfile(leaf_path):
                         continue
+                    if run_filter is not None and not run_filter.matches_run(
+                        entry2.path
+                    ):
+                        continue
 
                     ntotal += 1
 
@@ -61,6 +81,8 @@ def experiment_status(experiment_path):
 
                             end_path = os.path.join(entry2.path, ".__end")
                             crash_path = os.path.join(entry2.path, ".__crash")
+                            pruned_path = os.path.join(entry2.path, ".__pruned")
+                            timeout_path = os.path.join(entry2.path, ".__timeout")
 
                             if os.path.isfile(end_path):
                                 with open(end_path) as end_file:
@@ -72,6 +94,26 @@ def experiment_status(experiment_path):
                                             f"Can't read timestamp in {end_path}.\n"
                                         )
                                 nended += 1
+                            elif os.path.isfile(pruned_path):
+                                with open(pruned_path) as end_file:
+                                    try:
+                                        end_time = int(end_file.readline().strip())
+                                        durations.append(end_time - start_time)
+                                    except ValueError as _ex:
+                                        sys.stderr.write(
+                                            f"Can't read timestamp in {pruned_path}.\n"
+                                        )
+                                npruned += 1
+                            elif os.path.isfile(timeout_path):
+                                with open(timeout_path) as end_file:
+                                    try:
+                                        end_time = int(end_file.readline().strip())
+                                        durations.append(end_time - start_time)
+                                    except ValueError as _ex:
+                                        sys.stderr.write(
+                                            f"Can't read timestamp in {timeout_path}.\n"
+                                        )
+                                ntimeout += 1
                             elif os.path.isfile(crash_path):
                                 with open(crash_path) as end_file:
                                     try:
@@ -107,7 +149,7 @@ def experiment_status(experiment_path):
 
     if avg_time > 0:
         live_time_left = np.sum(avg_time - live_durations)
-        nleft = ntotal - nended - ncrashed - len(live_durations)
+        nleft = ntotal - nended - ncrashed - npruned - ntimeout - len(live_durations)
         is_over = (nleft > 0) or (live_durations.size > 0)
 
         time_left = max(avg_time * nleft + live_time_left, 0 if is_over else 1)
@@ -123,13 +165,15 @@ def experiment_status(experiment_path):
         progress = 0
         left_wall_time = datetime.timedelta(days=100)
 
-    nrunning = nstarted - nended
+    nrunning = nstarted - nended - npruned - ntimeout
 
     info = {
         "Experiment": os.path.basename(experiment_path),
         "Running": f"{nrunning:d}",
         "Done": clr(f"{nended:d}", "green"),
         "Dead": clr(f"{ncrashed:d}", "red"),
+        **({"Pruned": clr(f"{npruned:d}", "yellow")} if npruned > 0 else {}),
+        **({"Timeout": clr(f"{ntimeout:d}", "yellow")} if ntimeout > 0 else {}),
         **({"Lock": f"{nlocked:d}"} if nrunning != nlocked else {}),
         **(
             {"Lost": clr(f"{nlost:d}", "white", "on_magenta", attrs=["bold"])}
@@ -144,6 +188,56 @@ def experiment_status(experiment_path):
     return info
 
 
+def experiment_metrics(experiment_path, run_filter=None):
+    """The latest value of each scalar reported by the runs of an experiment
+    (see `liftoff.report`), one row per run.
+    """
+    rows = []
+    for run_path in sorted(iter_run_paths(experiment_path)):
+        if run_filter is not None and not run_filter.matches_run(run_path):
+            continue
+        latest = latest_metrics(run_path)
+        if not latest:
+            continue
+        row = {"Run": os.path.relpath(run_path, experiment_path)}
+        for name, (step, value) in sorted(latest.items()):
+            row[name] = f"{value:.4g} @ {step:d}"
+        rows.append(row)
+    return rows
+
+
+def experiment_usage(experiment_path, run_filter=None):
+    """What the finished runs of an experiment used (see `usage`), one row
+    per sub-experiment.
+    """
+    records = {}
+    for run_path in iter_run_paths(experiment_path):
+        if run_filter is not None and not run_filter.matches_run(run_path):
+            continue
+        record = read_usage(run_path)
+        if record is not None:
+            subexperiment = os.path.basename(os.path.dirname(run_path))
+            records.setdefault(subexperiment, []).append(record)
+    rows = []
+    for subexperiment, sub_records in sorted(records.items()):
+        summary = summarize(sub_records)
+        rows.append(
+            {
+                "Sub-experiment": subexperiment,
+                "Runs": summary["runs"],
+                "Wall s": f"{summary['wall_s']:.1f}",
+                "CPU s": f"{summary['cpu_s']:.1f}",
+                "RSS MB": f"{summary['mean_rss_mb']:.0f}",
+                "Peak RSS MB": f"{summary['max_rss_mb']:.0f}",
+                "Read MB": f"{summary['read_mb']:.1f}",
+                "Write MB": f"{summary['write_mb']:.1f}",
+                "Ready s": f"{summary['ready_s']:.1f}",
+                "Held s": f"{summary['held_s']:.1f}",
+            }
+        )
+    return rows
+
+
 def display_experiments(experiments_info: list[dict]):
     """Here we nicely display the experiments."""
     print(tabulate(experiments_info, headers="keys"))
@@ -152,6 +246,7 @@ def display_experiments(experiments_info: list[dict]):
 def status() -> None:
     """Entry point for liftoff-status."""
     opts = parse_options()
+    run_filter = compile_filters(opts.filters)
     experiment_paths = get_experiment_paths(  # pylint: disable=bad-continuation
         opts.experiment,
         opts.results_path,
@@ -160,7 +255,20 @@ def status() -> None:
     )
     display_experiments(
         sorted(
-            [experiment_status(p) for p in experiment_paths],
+            [experiment_status(p, run_filter) for p in experiment_paths],
             key=lambda info: info["Experiment"],
         )
     )
+    if opts.metrics:
+        for experiment_path in sorted(experiment_paths):
+            rows = experiment_metrics(experiment_path, run_filter)
+            if rows:
+                print(clr(f"\n{os.path.basename(experiment_path)}", attrs=["bold"]))
+                print(tabulate(rows, headers="keys"))
+    if opts.usage:
+        for experiment_path in sorted(experiment_paths):
+            rows = experiment_usage(experiment_path, run_filter)
+            if rows:
+                title = f"\n{os.path.basename(experiment_path)} (usage, means per run)"
+                print(clr(title, attrs=["bold"]))
+                print(tabulate(rows, headers="keys"))
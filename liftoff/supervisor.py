@@ -0,0 +1,447 @@
+"""Here we run several experiments from a single liftoff process, with one
+pool of resources:
+
+    liftoff script.py results/exp1 results/exp2 results/exp3
+    liftoff script.py --queue experiments.txt
+
+A queue file has one experiment per line, with an optional weight and
+priority (blank lines and `#` comments are ignored):
+
+    results/2024Jan01-120000_lr   weight=2
+    results/2024Jan01-130000_wd   priority=1
+
+The file is read again whenever it changes: experiments appended to it are
+picked up, and those removed from it get no new runs (their running runs go
+on). Experiments given on the command line have weight 1 and priority 0.
+
+A free slot goes to the experiment with the highest priority that has
+pending runs and, among those, to the one with the fewest running runs for
+its weight (weighted fair share), so the slots of an experiment that is done
+go to the others. If the next run of an experiment does not fit, the slot
+goes to the next experiment. Each experiment keeps its own order of runs
+(--policy) and its own liftoff-ctl channel: `pause`, `resume` and `drain`
+apply to it, the other commands to the shared pool.
+
+The loop runs on asyncio: it sleeps until a run ends (its pidfd becomes
+readable), a lease is due, a deadline passes, or it is time to look at the
+queue again. liftoff ends once no experiment has runs left to start or
+running. Options tied to a single experiment (--asha, --calibrate,
+--max-retries, --warm-workers and --procs-no auto, nor `procs_no auto`
+sent with liftoff-ctl) do not work here.
+"""
+
+import asyncio
+import contextlib
+import math
+import os
+import time
+
+from termcolor import colored as clr
+
+from .admission import POLL_EVERY, MemoryGuard
+from .common.experiment_info import is_experiment
+from .common.filters import ConfigCache, compile_filters
+from .common.leases import LeaseKeeper
+from .common.policies import make_policy
+from .common.run_index import CRASHED, STARTED
+from .control import ControlChannel
+from .liftoff import (
+    claim_runs,
+    keep_leases,
+    launch_run,
+    load_index,
+    refresh_pids,
+    should_stop,
+)
+from .resources import LiftoffResources
+from .slots import POLL_EVERY as HOST_POLL_EVERY
+from .slots import HostSlots
+from .startup import LaunchLimiter
+from .usage import UsageSampler
+
+QUEUE_POLL = 2  # seconds between two looks at the queue and the controls
+
+SINGLE_EXPERIMENT_OPTIONS = {
+    "asha": "--asha",
+    "calibrate": "--calibrate",
+    "max_retries": "--max-retries",
+    "warm_workers": "--warm-workers",
+}
+
+
+def read_queue(queue_path: str) -> dict[str, tuple[float, int]]:
+    """The experiments in a queue file, with their weight and priority.
+    Lines that cannot be read are reported and skipped.
+    """
+    entries = {}
+    with open(queue_path) as handler:
+        for line_no, line in enumerate(handler, start=1):
+            words = line.split("#", 1)[0].split()
+            if not words:
+                continue
+            settings = {"weight": 1.0, "priority": 0}
+            try:
+                for word in words[1:]:
+                    key, _, value = word.partition("=")
+                    if key not in settings:
+                        raise ValueError(f"unknown setting `{word:s}`")
+                    settings[key] = type(settings[key])(value)
+                if settings["weight"] <= 0:
+                    raise ValueError("the weight must be positive")
+            except ValueError as exception:
+                print(f"Skipping line {line_no:d} of {queue_path:s}: {exception}")
+                continue
+            path = os.path.normpath(words[0])
+            entries[path] = (settings["weight"], settings["priority"])
+    return entries
+
+
+class Experiment:
+    """One of the experiments run by a Supervisor."""
+
+    def __init__(  # pylint: disable=bad-continuation
+        self, path: str, opts, configs, weight: float = 1.0, priority: int = 0
+    ) -> None:
+        self.path = path
+        self.weight, self.priority = weight, priority
+        self.queued = True  # still on the command line or in the queue
+        self.exhausted = False  # had no pending runs when we last looked
+        self.children = []
+        policy = make_policy(opts.policy, path, configs=configs)
+        self.index = load_index(path, policy=policy)
+        self.control = ControlChannel(path, opts.session_id)
+        self.keeper = LeaseKeeper(opts.lease) if opts.lease > 0 else None
+        self.pid_path = os.path.join(path, f".__{opts.session_id}")
+        with open(self.pid_path, "a") as handler:
+            handler.write(f"{os.getpid():d}\n")
+
+    @property
+    def open(self) -> bool:
+        """Checks if we may start runs of this experiment."""
+        return (
+            self.queued
+            and not self.control.paused
+            and not self.control.draining
+            and not should_stop(self.path)
+        )
+
+    @property
+    def over(self) -> bool:
+        """Checks if this experiment needs us no more."""
+        if self.children or (self.control.paused and self.queued):
+            return False
+        return self.exhausted or not self.open
+
+
+class Supervisor:
+    """Starts the runs of several experiments from one pool of resources."""
+
+    def __init__(self, opts) -> None:
+        self.opts = opts
+        self.configs = ConfigCache()
+        self.run_filter = compile_filters(opts.filters, cache=self.configs)
+        self.resources = LiftoffResources(opts)
+        self.resources.can_autoscale = False  # see check_supervisor_opts
+        if opts.mem_guard is not None:
+            self.resources.guard = MemoryGuard(
+                None, opts.mem_guard, suspend=opts.mem_suspend
+            )
+        if opts.host_slots is not None:
+            self.resources.host = HostSlots(
+                opts.session_id,
+                path=opts.host_slots or None,
+                weight=opts.host_weight,
+                per_gpu=self.resources.per_gpu,
+            )
+        self.limiter = None
+        if opts.launch_rate or opts.stagger:
+            self.limiter = LaunchLimiter(
+                opts.launch_rate, opts.stagger, opts.ready_timeout
+            )
+        self.sampler = UsageSampler()
+        self.experiments = {}  # path -> Experiment, in the order they came
+        self.given = set()  # the experiments on the command line
+        self.queue_mtime = None
+        self.start = time.time()
+        self.hard_end = None
+        if opts.hard_end_by and opts.end_by > 0:
+            self.hard_end = self.start + opts.end_by
+        self.run_cnt = 0
+        self.closed = False  # no more runs are started (time or runs limit)
+        self.waiting = False  # some runs wait for resources
+        self.wakeup = None
+
+    def add(self, path: str, weight: float = 1.0, priority: int = 0) -> None:
+        """Adds an experiment (or updates its weight and priority)."""
+        if path in self.experiments:
+            experiment = self.experiments[path]
+            experiment.weight, experiment.priority = weight, priority
+            experiment.queued = True
+            return
+        if not is_experiment(path):
+            print(clr(f"Skipping {path:s}: not an experiment.", "red"))
+            return
+        self.experiments[path] = Experiment(
+            path, self.opts, self.configs, weight=weight, priority=priority
+        )
+        print(
+            f"[{time.strftime(time.ctime())}] Added {path:s}"
+            f" (weight {weight:g}, priority {priority:d})."
+        )
+
+    def read_queue(self) -> None:
+        """Reads the queue file again if it changed."""
+        if not self.opts.queue:
+            return
+        try:
+            mtime = os.stat(self.opts.queue).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.queue_mtime:
+            return
+        self.queue_mtime = mtime
+        entries = read_queue(self.opts.queue)
+        for path, experiment in self.experiments.items():
+            if path not in entries and path not in self.given:
+                experiment.queued = False
+        for path, (weight, priority) in entries.items():
+            self.add(path, weight=weight, priority=priority)
+
+    @property
+    def children(self) -> list:
+        """The runs we started that are still going."""
+        return [c for e in self.experiments.values() for c in e.children]
+
+    def _watch(self, child) -> None:
+        # The reader must go before the fd is closed: a later run may get the
+        # same fd number, and add_reader would not register it again.
+        loop = asyncio.get_running_loop()
+
+        def on_exit():
+            loop.remove_reader(child.fileno())
+            self.wakeup.set()
+
+        if child.fileno() is not None:
+            loop.add_reader(child.fileno(), on_exit)
+            child.on_close = loop.remove_reader
+
+    def refresh(self) -> bool:
+        """Reaps the runs that are over, renews leases, and reads the
+        liftoff-ctl commands. Returns True if some run ended.
+        """
+        self.sampler.sample(self.children)
+        ended = False
+        for experiment in self.experiments.values():
+            index = experiment.index
+            reclaimed = keep_leases(
+                experiment.keeper, experiment.children, index, self.opts.session_id
+            )
+            if index.refresh() or reclaimed:
+                experiment.exhausted = False
+            self.resources.process_commands(experiment.control.read())
+            nrunning = len(experiment.children)
+            experiment.children, _ = refresh_pids(
+                experiment.children,
+                self.resources,
+                index=index,
+                session_id=self.opts.session_id,
+                kill_grace=self.opts.kill_grace,
+            )
+            ended = ended or len(experiment.children) < nrunning
+        guard = self.resources.guard
+        if guard is not None:
+            guard.refresh(self.children)
+            guard.suspend_or_resume(self.children)
+        return ended
+
+    def pick(self, skipped: set) -> Experiment | None:
+        """The experiment that gets the next free slot."""
+        candidates = [
+            experiment
+            for path, experiment in self.experiments.items()
+            if path not in skipped and experiment.open and not experiment.exhausted
+        ]
+        return min(
+            candidates,
+            key=lambda e: (-e.priority, len(e.children) / e.weight),
+            default=None,
+        )
+
+    def launch_some(self) -> int:
+        """Starts runs while there are free slots. Returns how many."""
+        opts = self.opts
+        elapsed = time.time() - self.start
+        if (opts.start_by > 0 and elapsed > opts.start_by) or (
+            opts.end_by > 0 and elapsed > opts.end_by
+        ):
+            print(
+                f"[{time.strftime(time.ctime())}] Cannot launch more processes."
+                " Time limit exceeded."
+            )
+            self.closed = True
+            return 0
+        limit = opts.max_runs - self.run_cnt if opts.max_runs > 0 else math.inf
+        if self.limiter is not None:
+            allowed = self.limiter.allowance(self.children)
+            limit = limit if allowed is None else min(limit, allowed)
+        nstarted, skipped, self.waiting = 0, set(), False
+        while nstarted < limit and self.resources.free_procs() > 0:
+            experiment = self.pick(skipped)
+            if experiment is None:
+                break
+            placed, _, waiting = claim_runs(
+                experiment.index,
+                self.resources,
+                opts.session_id,
+                run_filter=self.run_filter,
+                configs=self.configs,
+                packing=opts.packing,
+                limit=1,
+                lease=opts.lease,
+            )
+            if not placed:
+                skipped.add(experiment.path)
+                experiment.exhausted = not waiting
+                self.waiting = self.waiting or bool(waiting)
+                continue
+            nstarted += self.start_run(experiment, *placed[0])
+        self.run_cnt += nstarted
+        if opts.max_runs > 0 and self.run_cnt >= opts.max_runs:
+            print(
+                f"[{time.strftime(time.ctime())}] Max runs exceeded. {opts.max_runs} "
+            )
+            self.closed = True
+        return nstarted
+
+    def start_run(self, experiment, run_path, request, gpus) -> int:
+        """Starts a run that was placed. Returns 1 if it started."""
+        opts = self.opts
+        cores = self.resources.assign_cores(request)
+        deadlines = [self.hard_end] if self.hard_end is not None else []
+        if opts.run_timeout > 0:
+            deadlines.append(time.time() + opts.run_timeout)
+        end_by = None
+        if opts.end_by > 0:
+            end_by = int(opts.end_by - (time.time() - self.start))
+        child = launch_run(
+            run_path,
+            opts.script,
+            opts.session_id,
+            gpu=gpus if self.resources.gpus else None,
+            do_nohup=not opts.no_detach,
+            optim=opts.optimize,
+            end_by=end_by,
+            cores=cores,
+            lease=opts.lease,
+            deadline=min(deadlines, default=None),
+        )
+        if child is None:
+            os.remove(os.path.join(run_path, ".__lock"))
+            self.resources.free(request, gpus, cores)
+            experiment.index.record(run_path, CRASHED)
+            return 0
+        child.request, child.gpus, child.cores = request, gpus, cores
+        child.title = f"{experiment.path:s}: {child.title}"  # for the logs
+        experiment.children.append(child)
+        experiment.index.record(run_path, STARTED)
+        if self.limiter is not None:
+            self.limiter.launched(child)
+        self._watch(child)
+        return 1
+
+    def held_back(self) -> bool:
+        """Checks if runs wait for memory, other sessions or the launch rate."""
+        guard, host = self.resources.guard, self.resources.host
+        return (
+            (guard is not None and (guard.blocked or guard.nsuspended > 0))
+            or (host is not None and host.blocked)
+            or (self.limiter is not None and self.limiter.holding)
+        )
+
+    def stuck(self) -> bool:
+        """Checks if runs wait for resources nobody will free."""
+        return self.waiting and not self.children and not self.held_back()
+
+    def timeout(self) -> float:
+        """Seconds until we should look around again."""
+        timeouts = [QUEUE_POLL]
+        for experiment in self.experiments.values():
+            if experiment.keeper is not None:
+                timeouts.append(experiment.keeper.timeout())
+        children = self.children
+        if children:
+            timeouts.append(self.sampler.timeout())
+        if self.held_back():
+            timeouts.append(min(POLL_EVERY, HOST_POLL_EVERY))
+            if self.limiter is not None and self.limiter.holding:
+                timeouts.append(self.limiter.timeout())
+        now = time.time()
+        for child in children:
+            due = child.deadline if child.kill_at is None else child.kill_at
+            if due is not None and due < math.inf:
+                timeouts.append(max(due - now, 0.0))
+        return max(min(timeouts), 0.0)
+
+    def over(self) -> bool:
+        """Checks if there is nothing left for us to do."""
+        if self.closed:
+            return not self.children
+        return not self.held_back() and all(e.over for e in self.experiments.values())
+
+    async def run(self) -> None:
+        """The supervisor loop."""
+        self.wakeup = asyncio.Event()
+        for path in [self.opts.config_path, *self.opts.experiments]:
+            if path is not None:
+                self.given.add(os.path.normpath(path))
+                self.add(os.path.normpath(path))
+        while True:
+            self.read_queue()
+            ended = self.refresh()
+            started = 0 if self.closed else self.launch_some()
+            if ended or started:
+                print(
+                    f"[{time.strftime(time.ctime())}] Resources:",
+                    self.resources.state,
+                )
+            if self.stuck():
+                print(
+                    f"[{time.strftime(time.ctime())}] "
+                    + clr("Some runs do not fit in this machine.", "red")
+                )
+                self.closed = True
+            if self.over():
+                break
+            self.wakeup.clear()
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self.wakeup.wait(), self.timeout())
+        self.close()
+
+    def close(self) -> None:
+        """Leaves the experiments and the machine."""
+        for experiment in self.experiments.values():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(experiment.pid_path)
+        if self.resources.host is not None:
+            self.resources.host.leave()
+        duration = time.time() - self.start
+        msg = (
+            f"[{time.strftime(time.ctime())}] {len(self.experiments):d}"
+            f" experiments ended after {duration:.2f}s."
+        )
+        print(clr(msg, attrs=["bold"]))
+
+
+def check_supervisor_opts(opts) -> None:
+    """Refuses the options that work with a single experiment only."""
+    for name, flag in SINGLE_EXPERIMENT_OPTIONS.items():
+        if getattr(opts, name, None):
+            raise ValueError(f"{flag:s} works for a single experiment only")
+    if opts.procs_no == "auto":
+        raise ValueError("--procs-no auto works for a single experiment only")
+
+
+def supervise(opts) -> None:
+    """Runs the experiments given on the command line or in the queue."""
+    check_supervisor_opts(opts)
+    asyncio.run(Supervisor(opts).run())
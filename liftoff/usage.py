@@ -0,0 +1,164 @@
+"""Here we record how much a run used: CPU time, memory and I/O.
+
+While runs are going, liftoff samples `/proc` every few seconds, for all of
+them at once, and keeps the peak RSS of each run's process group (so data
+loader workers and other helpers are counted too) and the bytes it read and
+wrote. When a run is reaped, this is put together with the `os.wait4`
+resource usage of the run and written to its `.__usage` file as one line of
+JSON:
+
+    {"returncode": 0, "wall_s": 61.2, "cpu_s": 58.9, "max_rss_mb": 812.4,
+     "read_mb": 12.0, "write_mb": 3.5, "ready_s": 8.1, "held_s": 0.0,
+     "majflt": 0, "nvcsw": 90, "nivcsw": 41}
+
+`ready_s` is how long the run took to start up and `held_s` how long its
+launch was held back (see `startup`).
+
+liftoff-status --usage sums them up per sub-experiment.
+"""
+
+import json
+import math
+import os
+import time
+
+from .startup import ready_time
+
+USAGE_FILE = ".__usage"
+SAMPLE_EVERY = 5  # seconds
+
+
+def _read_proc(pid: int) -> dict | None:
+    """The RSS and the I/O counters (in bytes) of a process, None if it is
+    gone.
+    """
+    sample = {"rss": 0, "read_bytes": 0, "write_bytes": 0}
+    try:
+        with open(f"/proc/{pid:d}/status") as handler:
+            for line in handler:
+                if line.startswith("VmRSS:"):
+                    sample["rss"] = int(line.split()[1]) * 1024
+                    break
+    except OSError:
+        return None
+    try:
+        with open(f"/proc/{pid:d}/io") as handler:
+            for line in handler:
+                key, _, value = line.partition(":")
+                if key in ("read_bytes", "write_bytes"):
+                    sample[key] = int(value)
+    except OSError:
+        pass  # not ours to read
+    return sample
+
+
+def process_groups() -> dict[int, list[int]]:
+    """Maps the process groups on this machine to their pids."""
+    groups = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name:s}/stat", "rb") as handler:
+                stat = handler.read()
+        except OSError:
+            continue
+        # pid (comm) state ppid pgrp ...; comm may contain anything
+        fields = stat[stat.rfind(b")") + 2 :].split()
+        groups.setdefault(int(fields[2]), []).append(int(name))
+    return groups
+
+
+class UsageSampler:
+    """Samples `/proc` for the running children of a supervisor every
+    `interval` seconds and keeps the peaks in `child.usage`. The first
+    sample is due right away.
+    """
+
+    def __init__(self, interval: float = SAMPLE_EVERY) -> None:
+        self.interval = interval
+        self.last = float("-inf")
+
+    def timeout(self) -> float:
+        """Seconds until the next sample."""
+        return max(0.0, self.last + self.interval - time.monotonic())
+
+    def sample(self, children: list, force: bool = False) -> None:
+        """Samples the children if it is time to."""
+        if not children or (not force and self.timeout() > 0):
+            return
+        self.last = time.monotonic()
+        groups = {}
+        if any(child.pgid is not None for child in children):
+            groups = process_groups()
+        for child in children:
+            pids = [child.pid]
+            if child.pgid is not None:
+                pids = groups.get(child.pgid, pids)
+            total = {"rss": 0, "read_bytes": 0, "write_bytes": 0}
+            for pid in pids:
+                sample = _read_proc(pid)
+                for key, value in (sample or {}).items():
+                    total[key] += value
+            for key, value in total.items():
+                child.usage[key] = max(child.usage.get(key, 0), value)
+
+
+def usage_record(child) -> dict:
+    """What we write in `.__usage` for a child that is over."""
+    rusage, sampled = child.rusage or {}, child.usage
+    max_rss = max(rusage.get("ru_maxrss", 0) * 1024, sampled.get("rss", 0))
+    read_bytes = max(rusage.get("ru_inblock", 0) * 512, sampled.get("read_bytes", 0))
+    write_bytes = max(rusage.get("ru_oublock", 0) * 512, sampled.get("write_bytes", 0))
+    record = {
+        "returncode": child.returncode,
+        "wall_s": round(time.time() - child.started, 3),
+        "cpu_s": None,
+        "max_rss_mb": round(max_rss / 2**20, 1),
+        "read_mb": round(read_bytes / 2**20, 1),
+        "write_mb": round(write_bytes / 2**20, 1),
+        "ready_s": None,
+        "held_s": getattr(child, "held_s", None),
+    }
+    if (ready_at := ready_time(child.run_path)) is not None:
+        record["ready_s"] = round(max(ready_at - child.started, 0.0), 3)
+    if rusage:
+        record["cpu_s"] = round(rusage["ru_utime"] + rusage["ru_stime"], 3)
+        for field in ("majflt", "nvcsw", "nivcsw"):
+            record[field] = rusage[f"ru_{field:s}"]
+    return record
+
+
+def write_usage(run_path: str, record: dict) -> None:
+    """Writes the usage record of a run."""
+    with open(os.path.join(run_path, USAGE_FILE), "w") as handler:
+        handler.write(json.dumps(record) + "\n")
+
+
+def read_usage(run_path: str) -> dict | None:
+    """Reads the usage record of a run, None if it has none."""
+    try:
+        with open(os.path.join(run_path, USAGE_FILE)) as handler:
+            return json.loads(handler.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def summarize(records: list[dict]) -> dict:
+    """Means (and the peak RSS) of several usage records."""
+
+    def mean(key):
+        values = [r[key] for r in records if r.get(key) is not None]
+        return sum(values) / len(values) if values else math.nan
+
+    return {
+        "runs": len(records),
+        "wall_s": mean("wall_s"),
+        "cpu_s": mean("cpu_s"),
+        "mean_rss_mb": mean("max_rss_mb"),
+        "max_rss_mb": max((r.get("max_rss_mb") or 0 for r in records), default=0),
+        "read_mb": mean("read_mb"),
+        "write_mb": mean("write_mb"),
+        "ready_s": mean("ready_s"),
+        "held_s": mean("held_s"),
+    }
@@ -0,0 +1,205 @@
+"""Here we implement the watchers the launcher uses to sleep until something
+interesting happens in an experiment: a run ended or crashed, someone created
+the .STOP file, someone sent a command with liftoff-ctl, or new runs were
+added. Our own writes to the experiment folder (e.g. appends to the index,
+autoscaler and ASHA state) do not wake us up.
+
+InotifyWatcher blocks on inotify events (Linux only) so an idle launcher
+does not wake up at all. PollingWatcher keeps the old behaviour of sleeping
+with an exponential backoff and is used everywhere else. Note that inotify
+does not see changes made from other hosts on network file systems.
+"""
+
+import contextlib
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import time
+
+from .common.run_index import INDEX_FILE
+from .control import CONTROL_FILE
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_ONLYDIR = 0x01000000
+
+# Appends close the file too, so IN_CLOSE_WRITE is enough to see them.
+EXPERIMENT_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ONLYDIR
+RUN_MASK = IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ONLYDIR
+
+EVENT = struct.Struct("iIII")
+
+# Files in the experiment folder worth waking up for.
+EXPERIMENT_FILES = {".STOP", CONTROL_FILE, INDEX_FILE}
+
+
+class PollingWatcher:
+    """Sleeps for a while, longer and longer if nothing happens."""
+
+    def __init__(self, max_sleep: float = 16) -> None:
+        self.max_sleep = max_sleep
+        self.sleep_time = 1
+
+    def watch_experiment(self, experiment_path: str, index=None) -> None:
+        """Nothing to do here, we look at the files after each nap."""
+
+    def watch(self, path: str) -> None:
+        """Nothing to do here, we look at the files after each nap."""
+
+    def unwatch(self, path: str) -> None:
+        """Nothing to do here, we look at the files after each nap."""
+
+    def wait(self, timeout: float = None, fds=()) -> None:
+        """Sleeps `sleep_time` seconds (or less if timeout is given). Wakes up
+        earlier if any of the given file descriptors becomes readable.
+        """
+        if timeout is None or timeout > self.sleep_time:
+            timeout = self.sleep_time
+        fds = [fd for fd in fds if fd.fileno() is not None]
+        if fds:
+            select.select(fds, [], [], timeout)
+        else:
+            time.sleep(timeout)
+
+    def backoff(self) -> None:
+        """Nothing happened, so we'll sleep longer next time."""
+        self.sleep_time = min(self.max_sleep, self.sleep_time * 2)
+
+    def reset(self) -> None:
+        """Something happened, so we go back to short naps."""
+        self.sleep_time = 1
+
+    def close(self) -> None:
+        """Nothing to release."""
+
+
+class InotifyWatcher(PollingWatcher):
+    """Blocks until the kernel tells us that files were created or modified
+    in the experiment folder, its sub-experiments, or the watched runs.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.wds = {}
+        self.paths = {}
+        self.experiment_wds = set()
+        self.index = None
+
+    def _add_watch(self, path: str, mask: int) -> int:
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.wds[path] = wd
+        self.paths[wd] = path
+        return wd
+
+    def watch_experiment(self, experiment_path: str, index=None) -> None:
+        """Watches the experiment folder (for .STOP, commands, the index, and
+        new sub-experiments) and all its sub-experiments (for new runs).
+        Changes to the index made through `index` are ignored.
+        """
+        self.index = index
+        self.experiment_wds.add(self._add_watch(experiment_path, EXPERIMENT_MASK))
+        with os.scandir(experiment_path) as fit:
+            for entry in fit:
+                if not entry.name.startswith(".") and entry.is_dir():
+                    self._add_watch(entry.path, RUN_MASK)
+
+    def watch(self, path: str) -> None:
+        """Watches a run folder for .__end / .__crash."""
+        with contextlib.suppress(FileNotFoundError):
+            self._add_watch(path, RUN_MASK)
+
+    def unwatch(self, path: str) -> None:
+        """Stops watching a run folder."""
+        wd = self.wds.pop(path, None)
+        if wd is not None:
+            self.paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def _is_news(self, name: str) -> bool:
+        """Checks if a file changed in the experiment folder concerns us."""
+        if name not in EXPERIMENT_FILES:
+            return False
+        return (
+            name != INDEX_FILE or self.index is None or not self.index.written_by_us()
+        )
+
+    def _drain(self) -> int:
+        """Reads all pending events and returns how many of them are worth
+        waking up for.
+        """
+        nevents = 0
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return nevents
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size : offset + EVENT.size + length]
+                offset += EVENT.size + length
+                name = os.fsdecode(name.rstrip(b"\0"))
+                if mask & IN_IGNORED:
+                    self.wds.pop(self.paths.pop(wd, None), None)
+                elif wd not in self.experiment_wds:
+                    nevents += 1
+                elif mask & IN_ISDIR:
+                    if not name.startswith("."):
+                        self.watch(os.path.join(self.paths[wd], name))
+                        nevents += 1
+                elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and self._is_news(name):
+                    # Files are looked at once written (creating is not enough).
+                    nevents += 1
+
+    def wait(self, timeout: float = None, fds=()) -> None:
+        """Blocks until some interesting event arrives, one of the given file
+        descriptors becomes readable, or timeout seconds pass.
+        """
+        waitable = [fd for fd in fds if fd.fileno() is not None]
+        if len(waitable) < len(fds):
+            # Some children cannot be waited on, so we poll them.
+            timeout = 1 if timeout is None else min(timeout, 1)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if deadline is not None:
+                timeout = max(deadline - time.monotonic(), 0)
+            readable, _, _ = select.select([self.fd, *waitable], [], [], timeout)
+            if self.fd not in readable:
+                return
+            if self._drain() or len(readable) > 1 or timeout == 0:
+                return
+
+    def backoff(self) -> None:
+        """We don't poll, so there's no backoff."""
+
+    def reset(self) -> None:
+        """We don't poll, so there's no backoff."""
+
+    def close(self) -> None:
+        """Releases the inotify file descriptor."""
+        os.close(self.fd)
+
+
+def make_watcher(use_inotify: bool) -> PollingWatcher:
+    """Returns an inotify watcher if asked and possible, a polling one
+    otherwise.
+    """
+    if use_inotify:
+        try:
+            return InotifyWatcher()
+        except (AttributeError, OSError, TypeError) as exception:
+            print(f"Cannot use inotify ({exception}). Will poll instead.")
+    return PollingWatcher()